@@ -119,6 +119,152 @@ class PCA:
     def vars( self, obs ):
         return self.pc_vars( self.obs_pc(obs) )  # 1000 obs -> 2 principal -> 20 vars
 
+class TruncatedPCA:
+    """ the top k principal components from a randomized range finder
+
+    Halko, Martinsson & Tropp, Finding structure with randomness (2011).
+    A is centered (and scaled, like Center) a block of rows at a time so it
+    is never copied and can stay float32. Only the k components we want are
+    kept. sumvariance is relative to the total variance of A but only
+    covers the top k components
+    """
+    def __init__( self, A, k=2, oversample=10, powerIters=2, scale=True, seed=0, blockSize=100000 ):
+        self.A = A
+        self.blockSize = blockSize
+        (N, dim) = np.shape(A)
+        self.mean = np.zeros(dim)
+        sum_sq = np.zeros(dim)
+        for start in xrange(0, N, blockSize):
+            block = np.asarray(A[start:start+blockSize], dtype=np.float64)
+            self.mean += block.sum(axis=0)
+            sum_sq += (block**2).sum(axis=0)
+        self.mean /= N
+        var = np.clip(sum_sq / N - self.mean**2, 0., None)
+        if scale:
+            std = np.sqrt(var)
+            self.std = np.where( std, std, 1. )
+        else:
+            self.std = np.ones(dim)
+        total_variance = np.sum(var / self.std**2) * N
+
+        # sample the range of A and polish it with a few power iterations
+        l = min(k + oversample, dim, N)
+        RS = np.random.RandomState(seed)
+        Y = self.timesRight( RS.standard_normal((dim, l)) )
+        for i in range(powerIters):
+            Q = np.linalg.qr(Y)[0]
+            Y = self.timesRight( np.linalg.qr(self.leftTimes(Q).T)[0] )
+        Q = np.linalg.qr(Y)[0]
+
+        # A ~= Q . Q^T . A and Q^T . A is small
+        Ub, d, self.Vt = np.linalg.svd( self.leftTimes(Q), full_matrices=False )
+        self.npc = min(k, len(d))
+        self.U = np.dot(Q, Ub[:, :self.npc])
+        self.d = d[:self.npc]
+        self.Vt = self.Vt[:self.npc]
+        # same sign convention as PCA
+        if self.Vt[0,0] < 0:
+            self.Vt *= -1.
+            self.U *= -1.
+        self.eigen = self.d**2
+        self.sumvariance = np.cumsum(self.eigen) / total_variance
+        del self.A
+
+    def scaled( self, start ):
+        """ centered and scaled block of rows of A """
+        return (np.asarray(self.A[start:start+self.blockSize], dtype=np.float64) - self.mean) / self.std
+
+    def timesRight( self, M ):
+        """ A . M """
+        N = np.shape(self.A)[0]
+        out = np.empty((N, np.shape(M)[1]))
+        for start in xrange(0, N, self.blockSize):
+            out[start:start+self.blockSize] = np.dot(self.scaled(start), M)
+        return out
+
+    def leftTimes( self, M ):
+        """ M^T . A """
+        N = np.shape(self.A)[0]
+        out = np.zeros((np.shape(M)[1], np.shape(self.A)[1]))
+        for start in xrange(0, N, self.blockSize):
+            out += np.dot(M[start:start+self.blockSize].T, self.scaled(start))
+        return out
+
+    def pc( self ):
+        """ N x npc U[:, :npc] * d[:npc] """
+        n = self.npc
+        return self.U[:, :n] * self.d[:n]
+
+class IncrementalPCA:
+    """ PCA from running sums which rows can be added to and taken from
+
+    Keeps the column sums and the d x d cross products of all the rows
+    seen so the basis can be updated without going back to the data.
+    Centers (and scales) like Center does. Rows are read a block at a time
+    so A can be float32
+    """
+    def __init__( self, dim, scale=True ):
+        self.n = 0
+        self.sums = np.zeros(dim)
+        self.cross = np.zeros((dim, dim))
+        self.scale = scale
+
+    def add( self, A, blockSize=100000, sign=1 ):
+        for start in xrange(0, len(A), blockSize):
+            block = np.asarray(A[start:start+blockSize], dtype=np.float64)
+            self.n += sign * len(block)
+            self.sums += sign * block.sum(axis=0)
+            self.cross += sign * np.dot(block.T, block)
+
+    def remove( self, A, blockSize=100000 ):
+        self.add(A, blockSize=blockSize, sign=-1)
+
+    def fit( self, fraction=0.80, rtol=1e-6 ):
+        """ work out the basis for the rows we have now
+
+        After many adds and removes cross/n - mean.mean leaves tiny
+        variances on columns which should be constant. Any std smaller
+        than rtol * the biggest one is taken as constant so we don't
+        blow that noise up
+        """
+        self.mean = self.sums / self.n
+        cov = self.cross / self.n - np.outer(self.mean, self.mean)
+        if self.scale:
+            std = np.sqrt(np.clip(np.diag(cov), 0., None))
+            self.std = np.where( std > rtol * np.max(std), std, 1. )
+        else:
+            self.std = np.ones(len(self.mean))
+        cov /= np.outer(self.std, self.std)
+
+        # eigen vectors of the covariance are the right singular vectors
+        evals, evecs = np.linalg.eigh(cov)
+        order = np.argsort(evals)[::-1]
+        self.Vt = evecs[:, order].T
+        if self.Vt[0,0] < 0:
+            self.Vt *= -1.
+        self.d = np.sqrt(np.clip(evals[order], 0., None) * self.n)
+        self.eigen = self.d**2
+        self.sumvariance = np.cumsum(self.eigen)
+        self.sumvariance /= self.sumvariance[-1]
+
+        self.npc = np.searchsorted( self.sumvariance, fraction ) + 1
+        while(self.npc == 1):   # prevents less than 2 pcs being found
+            fraction *= 1.1
+            self.npc = np.searchsorted( self.sumvariance, fraction ) + 1
+        self.npc = min(self.npc, len(self.d))
+        # we only ever project onto the components we need
+        self.Vt = self.Vt[:self.npc]
+        return self
+
+    def project( self, A, blockSize=100000 ):
+        """ rows of A -> npc principal components, same as PCA.pc() for the fitted rows """
+        n = self.npc
+        out = np.empty((len(A), n))
+        for start in xrange(0, len(A), blockSize):
+            block = (np.asarray(A[start:start+blockSize], dtype=np.float64) - self.mean) / self.std
+            out[start:start+blockSize] = np.dot(block, self.Vt[:n].T)
+        return out
+
 class Center:
     """ A -= A.mean() /= A.std(), inplace -- use A.copy() if need be
         uncenter(x) == original A . x
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+###############################################################################
+#                                                                             #
+#    batch.py                                                                 #
+#                                                                             #
+#    Run the GroopM workflow over many databases at once                      #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#          .d8888b.                                    888b     d888          #
+#         d88P  Y88b                                   8888b   d8888          #
+#         888    888                                   88888b.d88888          #
+#         888        888d888 .d88b.   .d88b.  88888b.  888Y88888P888          #
+#         888  88888 888P"  d88""88b d88""88b 888 "88b 888 Y888P 888          #
+#         888    888 888    888  888 888  888 888  888 888  Y8P  888          #
+#         Y88b  d88P 888    Y88..88P Y88..88P 888 d88P 888   "   888          #
+#          "Y8888P88 888     "Y88P"   "Y88P"  88888P"  888       888          #
+#                                             888                             #
+#                                             888                             #
+#                                             888                             #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2012-2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPL3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+
+###############################################################################
+
+import os
+import sys
+import traceback
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+# GroopM imports
+import mstore
+import cluster
+import refine
+import groopmTimekeeper as gtime
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# the stages of the workflow, in order
+BATCH_STAGES = ['parse', 'core', 'refine', 'recruit']
+
+def getFirstIncompleteStage(dbFileName):
+    """Work out where the workflow for a DB is up to
+
+    Returns one of BATCH_STAGES or None if everything has been done
+    """
+    DM = mstore.GMDataManager()
+    if not os.path.exists(dbFileName):
+        return 'parse'
+    try:
+        if not DM.isParsed(dbFileName):
+            return 'parse'
+        DM.getGMDBFormat(dbFileName)
+    except:
+        # half written or not a GroopM DB, start again
+        return 'parse'
+    DM.checkAndUpgradeDB(dbFileName, silent=True)
+    if not DM.isClustered(dbFileName):
+        return 'core'
+    if not DM.isComplete(dbFileName):
+        return 'refine'
+    if not DM.isRecruited(dbFileName):
+        return 'recruit'
+    return None
+
+def runBatchJob(job, settings, results):
+    """Take one DB from wherever it is up to through to the end
+
+    Output is written to <db>.batch.log. A tuple of
+    (dbFileName, stage we stopped at or None, error or None) is put on results
+    """
+    (db_file_name, contigs, bams) = job
+    sys.stdout = open(db_file_name + ".batch.log", 'a', 0)
+    sys.stderr = sys.stdout
+    stage = None
+    try:
+        timer = gtime.TimeKeeper()
+        stage = getFirstIncompleteStage(db_file_name)
+        while stage is not None:
+            print "*******************************************************************************"
+            print " [[GroopM batch]] %s: %s" % (db_file_name, stage)
+            print "*******************************************************************************"
+            if stage == 'parse':
+                DM = mstore.GMDataManager()
+                if not DM.createDB(bams,
+                                   contigs,
+                                   db_file_name,
+                                   settings['parseCutoff'],
+                                   timer,
+                                   force=True,
+                                   threads=1):
+                    raise Exception("could not create DB")
+            elif stage == 'core':
+                CE = cluster.ClusterEngine(db_file_name,
+                                           timer,
+                                           force=True,
+                                           minSize=settings['minSize'],
+                                           minVol=settings['minVol'])
+                CE.makeCores(coreCut=settings['coreCutoff'], resume=True)
+            elif stage == 'refine':
+                mstore.GMDataManager().checkBins(db_file_name, repair=True)
+                RE = refine.RefineEngine(timer,
+                                         dbFileName=db_file_name,
+                                         transform=True,
+                                         bids=[],
+                                         loadContigNames=True)
+                RE.refineBins(timer,
+                              auto=True,
+                              saveBins=True)
+            elif stage == 'recruit':
+                mstore.GMDataManager().checkBins(db_file_name, repair=True)
+                RE = refine.RefineEngine(timer,
+                                         dbFileName=db_file_name,
+                                         getUnbinned=True,
+                                         loadContigNames=False,
+                                         cutOff=settings['recruitCutoff'])
+                RE.recruitWrapper(timer,
+                                  inclusivity=settings['inclusivity'],
+                                  step=settings['step'],
+                                  saveBins=True)
+
+            next_stage = getFirstIncompleteStage(db_file_name)
+            if next_stage == stage:
+                raise Exception("stage '%s' did not finish" % stage)
+            stage = next_stage
+        results.put((db_file_name, None, None))
+    except:
+        traceback.print_exc()
+        results.put((db_file_name, stage, str(sys.exc_info()[1])))
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class BatchRunner:
+    """Run parse, core, refine and recruit over many DBs at once
+
+    Each DB records how far it got in its own metadata so a batch can be
+    stopped and started again and will carry on where it left off
+    """
+    def __init__(self,
+                 manifestFileName,
+                 threads=1,
+                 parseCutoff=500,
+                 coreCutoff=1500,
+                 minSize=10,
+                 minVol=1000000,
+                 recruitCutoff=500,
+                 inclusivity=2.5,
+                 step=200):
+        self.manifestFileName = manifestFileName
+        self.threads = max(1, threads)
+        self.settings = {'parseCutoff' : parseCutoff,
+                         'coreCutoff' : coreCutoff,
+                         'minSize' : minSize,
+                         'minVol' : minVol,
+                         'recruitCutoff' : recruitCutoff,
+                         'inclusivity' : inclusivity,
+                         'step' : step}
+
+    def readManifest(self):
+        """Read the manifest
+
+        One job per line, white space separated:
+        db  contigs.fasta  bam1  bam2  bam3 ...
+        Blank lines and lines starting with '#' are ignored
+        """
+        jobs = []
+        with open(self.manifestFileName, 'r') as fh:
+            for line in fh:
+                line = line.strip()
+                if line == '' or line[0] == '#':
+                    continue
+                fields = line.split()
+                if len(fields) < 5:
+                    raise Exception("Manifest line needs a db, a contig file and at least 3 bams: %s" % line)
+                jobs.append((fields[0], fields[1], fields[2:]))
+        return jobs
+
+    def getJobSize(self, job):
+        """Number of contigs in a job, used to hand out the big ones first"""
+        (db_file_name, contigs, bams) = job
+        try:
+            if getFirstIncompleteStage(db_file_name) != 'parse':
+                return mstore.GMDataManager().getNumCons(db_file_name)
+        except:
+            pass
+        # not parsed yet so count the fasta headers
+        if os.path.exists(contigs + ".fai"):
+            with open(contigs + ".fai", 'r') as fh:
+                return sum(1 for line in fh)
+        GM_open = open
+        if contigs.endswith('.gz'):
+            import gzip
+            GM_open = gzip.open
+        try:
+            with GM_open(contigs, 'r') as fh:
+                return sum(1 for line in fh if line[0] == '>')
+        except IOError:
+            return 0
+
+    def run(self):
+        """Run all the jobs, biggest first, at most self.threads at a time"""
+        jobs = self.readManifest()
+        sizes = dict([(job[0], self.getJobSize(job)) for job in jobs])
+        jobs = sorted(jobs, key=lambda job: sizes[job[0]], reverse=True)
+        print "    Running %d jobs on %d processes" % (len(jobs), self.threads)
+
+        # plain processes rather than a Pool so each job can start its own workers
+        results = Queue()
+        running = {}
+        failed = []
+        while len(jobs) > 0 or len(running) > 0:
+            while len(jobs) > 0 and len(running) < self.threads:
+                job = jobs.pop(0)
+                print "    Starting: %s (%d contigs)" % (job[0], sizes[job[0]])
+                p = Process(target=runBatchJob, args=(job, self.settings, results))
+                p.start()
+                running[job[0]] = p
+
+            try:
+                (db_file_name, stage, error) = results.get(True, 10)
+            except Empty:
+                # look out for jobs which died without telling us
+                for db_file_name in running.keys():
+                    if running[db_file_name].exitcode not in (None, 0):
+                        results.put((db_file_name, None, "exit code %d" % running[db_file_name].exitcode))
+                continue
+            running.pop(db_file_name).join()
+            if error is None:
+                print "    Finished: %s" % db_file_name
+            else:
+                print "    FAILED: %s at stage '%s' (%s). See %s.batch.log" % (db_file_name, stage, error, db_file_name)
+                failed.append(db_file_name)
+
+        if len(failed) > 0:
+            print "    %d jobs failed, re-run the batch to pick them up where they stopped" % len(failed)
+        return len(failed) == 0
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
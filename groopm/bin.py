@@ -485,7 +485,7 @@ class Bin:
         del fig
 
 
-    def plotBin(self, transformedCP, contigGCs, kmerNormPC1, contigLengths, colorMapGC, isLikelyChimeric, fileName="", ignoreContigLengths=False, ET=None):
+    def plotBin(self, transformedCP, contigGCs, kmerNormPC1, contigLengths, colorMapGC, isLikelyChimeric, fileName="", ignoreContigLengths=False, ET=None, ellipsoid=None):
         """Plot a single bin"""
         fig = plt.figure()
         title = self.plotOnFig(fig, 1, 1, 1,
@@ -496,7 +496,8 @@ class Bin:
                                isLikelyChimeric,
                                fileName=fileName,
                                ignoreContigLengths=ignoreContigLengths,
-                               ET=ET)
+                               ET=ET,
+                               ellipsoid=ellipsoid)
 
         plt.title(title)
         if(fileName != ""):
@@ -529,7 +530,8 @@ class Bin:
                   ignoreContigLengths=False,
                   ET=None,
                   plotColorbar=True,
-                  extents=None):
+                  extents=None,
+                  ellipsoid=None):
         ax = fig.add_subplot(plot_rows, plot_cols, plot_num, projection='3d')
         return self.plotOnAx(ax,
                              transformedCP,
@@ -541,7 +543,8 @@ class Bin:
                              ignoreContigLengths=ignoreContigLengths,
                              ET=ET,
                              plotColorbar=plotColorbar,
-                             extents=extents)
+                             extents=extents,
+                             ellipsoid=ellipsoid)
 
     def plotOnAx(self,
                  ax,
@@ -556,10 +559,12 @@ class Bin:
                  ET=None,
                  printID=False,
                  plotColorbar=True,
-                 extents=None):
+                 extents=None,
+                 ellipsoid=None):
         """Plot a bin in a given subplot
 
         If you pass through an EllipsoidTool then it will plot the minimum bounding ellipsoid as well!
+        Pass an (A, center, radii, rotation) ellipsoid to save working it out again
         """
 
         disp_vals = np.array([])
@@ -606,7 +611,10 @@ class Bin:
             mungeCbar(cbar)
 
         if ET != None:
-            (center, radii, rotation) = self.getBoundingEllipsoid(transformedCP, ET=ET)
+            if ellipsoid is None:
+                (center, radii, rotation) = self.getBoundingEllipsoid(transformedCP, ET=ET)
+            else:
+                (_A, center, radii, rotation) = ellipsoid
             centroid_gc = np.mean(contigGCs[self.rowIndices])
             centroid_color = colorMapGC(centroid_gc)
             if printID:
@@ -631,10 +639,11 @@ class Bin:
 
         return title
 
-    def plotMersOnAx(self, ax, kPCA1, kPCA2, contigGCs, contigLengths, colorMapGC, fileName="", ET=None, printID=False, plotColorbar=True):
+    def plotMersOnAx(self, ax, kPCA1, kPCA2, contigGCs, contigLengths, colorMapGC, fileName="", ET=None, printID=False, plotColorbar=True, ellipsoid=None):
         """Plot a bins kmer sig PCAs in a given subplot
 
         If you pass through an EllipsoidTool then it will plot the minimum bounding ellipse as well!
+        Pass an (A, center, radii, rotation) ellipse to save working it out again
         """
         disp_vals = np.array(zip([kPCA1[i] for i in self.rowIndices],
                                  [kPCA2[i] for i in self.rowIndices]))
@@ -656,7 +665,10 @@ class Bin:
             mungeCbar(cbar)
 
         if ET != None:
-            (center, radii, rotation) = ET.getMinVolEllipse(disp_vals)
+            if ellipsoid is None:
+                (center, radii, rotation) = ET.getMinVolEllipse(disp_vals)
+            else:
+                (_A, center, radii, rotation) = ellipsoid
             centroid_gc = np.mean(contigGCs[self.rowIndices])
             centroid_color = colorMapGC(centroid_gc)
             if printID:
@@ -49,6 +49,7 @@ __email__ = "mike@mikeimelfort.com"
 from os.path import join as osp_join
 from sys import exc_info, exit, stdout as sys_stdout
 from operator import itemgetter
+from hashlib import md5
 
 
 import matplotlib.pyplot as plt
@@ -65,6 +66,7 @@ from numpy import (abs as np_abs,
                    ceil as np_ceil,
                    concatenate as np_concatenate,
                    dot as np_dot,
+                   eye as np_eye,
                    log10 as np_log10,
                    max as np_max,
                    mean as np_mean,
@@ -73,6 +75,7 @@ from numpy import (abs as np_abs,
                    ones as np_ones,
                    reshape as np_reshape,
                    seterr as np_seterr,
+                   shape as np_shape,
                    size as np_size,
                    sort as np_sort,
                    sqrt as np_sqrt,
@@ -104,7 +107,8 @@ class BinManager:
                  dbFileName="",
                  pm=None,
                  minSize=10,
-                 minVol=1000000):
+                 minVol=1000000,
+                 useHull=False):
         # data storage
         if(dbFileName != ""):
             self.PM = ProfileManager(dbFileName)
@@ -115,6 +119,13 @@ class BinManager:
         self.nextFreeBinId = 0                      # increment before use!
         self.bins = {}                              # bid -> Bin
 
+        # bounding ellipsoids
+        self.ET = EllipsoidTool()
+        self.ellipsoids = {}                        # (bid, mode) -> (memberKey, hullPoints, ellipsoid)
+        self.savedEllipsoids = None                 # (bid, mode) -> (memberKey, ellipsoid) as stored in the DB
+        self.useHull = useHull                      # fit ellipsoids to the convex hull of the points only
+        self.transformed = True                     # False if transformedCP is really the raw coverage
+
         # misc
         self.minSize=minSize           # Min number of contigs for a bin to be considered legit
         self.minVol=minVol             # Override on the min size, if we have this many BP
@@ -142,6 +153,8 @@ class BinManager:
         """Load data and make bin objects"""
         # build the condition
 
+        in_bids = None
+        binned = None
         if getUnbinned:
             # get everything
             condition = "(length >= %d) " % cutOff
@@ -149,8 +162,10 @@ class BinManager:
             # make sense of bin information
             if bids == []:
                 condition = "((length >= %d) & (bid != 0))" % cutOff
+                binned = True
             else:
-                condition = "((length >= %d) & " % cutOff + " | ".join(["(bid == %d)"%bid for bid in bids])+")"
+                condition = "((length >= %d) & (" % cutOff + " | ".join(["(bid == %d)"%bid for bid in bids])+"))"
+                in_bids = bids
 
         # if we're going to make bins then we'll need kmer sigs
         if(makeBins):
@@ -168,7 +183,10 @@ class BinManager:
                          loadContigNames=loadContigNames,
                          loadContigLengths=loadContigLengths,
                          loadBins=True,
-                         loadLinks=loadLinks
+                         loadLinks=loadLinks,
+                         minLength=cutOff,
+                         inBids=in_bids,
+                         binned=binned
                         )
 
         # exit if no bins loaded
@@ -181,6 +199,7 @@ class BinManager:
             else:
                 if self.PM.numStoits == 3:
                     self.PM.transformedCP = self.PM.covProfiles
+                    self.transformed = False
                 else:
                     print "Number of stoits != 3. You need to transform"
                     self.PM.transformCP(timer, silent=silent)
@@ -237,13 +256,16 @@ class BinManager:
 
         We always overwrite the bins table (It is smallish)
         """
-        # save the bin assignments
-        self.PM.setBinAssignments(
-                                  self.getGlobalBinAssignments(binAssignments), # convert to global indices
-                                  nuke=nuke
-                                  )
-        # overwrite the bins table
-        self.setBinStats()
+        # save the bin assignments and overwrite the bins table
+        # keep the ellipsoids next to the bins they belong to
+        saved = self.getValidEllipsoids()
+        self.PM.saveBins(
+                         self.getGlobalBinAssignments(binAssignments), # convert to global indices
+                         self.makeBinStats(),
+                         nuke=nuke,
+                         ellipsoids=self.makeEllipsoidRows(saved)
+                         )
+        self.savedEllipsoids = saved
 
     def getGlobalBinAssignments(self, binAssignments={}):
         """Merge the bids, raw DB indexes and core information so we can save to disk
@@ -273,15 +295,191 @@ class BinManager:
 
         Note that this call effectively nukes the existing table
         """
+        # keep the ellipsoids next to the bins they belong to
+        saved = self.getValidEllipsoids()
+        self.PM.setBinStats(self.makeBinStats(), ellipsoids=self.makeEllipsoidRows(saved))
+        self.savedEllipsoids = saved
+
+    def makeBinStats(self):
+        """Make the rows of the bins table
 
-        # create and array of tuples:
-        # [(bid, size, likelyChimeric)]
+        returns an array of tuples:
+        [(bid, size, likelyChimeric)]
+        """
         bin_stats = []
         for bid in self.getBids():
             # no point in saving empty bins
             if np_size(self.bins[bid].rowIndices) > 0:
                 bin_stats.append((bid, np_size(self.bins[bid].rowIndices), self.PM.isLikelyChimeric[bid]))
-        self.PM.setBinStats(bin_stats)
+        return bin_stats
+
+#------------------------------------------------------------------------------
+# BOUNDING ELLIPSOIDS
+
+    def getEllipsoidPoints(self, rowIndices, mode):
+        """Get the points an ellipsoid of the given mode is fit to
+
+        mode is one of:
+        'cov'   - transformed coverage
+        'mer'   - first 3 kmer PCs
+        'mer2d' - first 2 kmer PCs (for the flat plots)
+        """
+        if mode == 'cov':
+            return self.PM.transformedCP[rowIndices]
+        elif mode == 'mer':
+            return self.PM.kmerPCs[rowIndices,0:3]
+        elif mode == 'mer2d':
+            return self.PM.kmerPCs[rowIndices,0:2]
+        raise ge.ModeNotAppropriateException("Mode "+str(mode)+" unknown")
+
+    def getMembershipKey(self, bid, mode):
+        """Make a key which changes whenever the members of a bin change
+
+        Uses global indices so it survives calls to reduceIndices
+        and can be compared with keys from earlier sessions. The 'cov'
+        points change if the coverage wasn't transformed and the fit changes
+        if we only use the hull so those go in too
+        """
+        row_indices = np_array(self.bins[bid].rowIndices, dtype=int)
+        key = md5(np_sort(self.PM.indices[row_indices]).tostring())
+        if mode == 'cov' and not self.transformed:
+            key.update("untransformed")
+        if self.useHull:
+            key.update("hull")
+        else:
+            key.update("points")
+        return key.hexdigest()
+
+    def makeEllipsoid(self, points):
+        """Minimum bounding ellipsoid of some points
+
+        returns (A, center, radii, rotation)
+        """
+        if len(points) > 1:
+            return self.ET.getMinVolEllipse(points, retA=True)
+        # minimum bounding ellipse of a point is 0
+        dim = np_shape(points)[1]
+        return (np_zeros((dim,dim)), points[0], np_zeros(dim), np_eye(dim))
+
+    def getBinEllipsoid(self, bid, mode='cov'):
+        """Return the minimum bounding ellipsoid of a bin
+
+        Ellipsoids are cached against the bin's members so we only work
+        them out again if the bin has changed. See getEllipsoidPoints for modes
+
+        returns (A, center, radii, rotation)
+        """
+        member_key = self.getMembershipKey(bid, mode)
+        try:
+            (cached_key, hull_points, ellipsoid) = self.ellipsoids[(bid, mode)]
+            if cached_key == member_key:
+                if ellipsoid is None:
+                    # hull was seeded by a merge
+                    ellipsoid = self.makeEllipsoid(hull_points)
+                    self.ellipsoids[(bid, mode)] = (member_key, hull_points, ellipsoid)
+                return ellipsoid
+        except KeyError:
+            pass
+
+        # perhaps we worked it out in a previous session
+        if self.savedEllipsoids is None:
+            self.savedEllipsoids = self.PM.getBinEllipsoids()
+        try:
+            (saved_key, ellipsoid) = self.savedEllipsoids[(bid, mode)]
+            if saved_key == member_key:
+                self.ellipsoids[(bid, mode)] = (member_key, None, ellipsoid)
+                return ellipsoid
+        except KeyError:
+            pass
+
+        points = self.getEllipsoidPoints(self.bins[bid].rowIndices, mode)
+        hull_points = None
+        if self.useHull:
+            # the ellipsoid only depends on the hull so keep that for merging
+            hull_points = self.ET.getHullPoints(points)
+            points = hull_points
+        ellipsoid = self.makeEllipsoid(points)
+        self.ellipsoids[(bid, mode)] = (member_key, hull_points, ellipsoid)
+        return ellipsoid
+
+    def getMergedHulls(self, parentBid, deadBid):
+        """Combine the cached hulls of two bins which are about to merge
+
+        The hull of the union is the hull of the two hulls so
+        there is no need to go back to all the points
+
+        returns { mode : hullPoints }, empty unless we are using hulls
+        """
+        merged_hulls = {}
+        if not self.useHull:
+            return merged_hulls
+        for (bid, mode) in self.ellipsoids.keys():
+            if bid != parentBid or (deadBid, mode) not in self.ellipsoids:
+                continue
+            (p_key, p_hull, _) = self.ellipsoids[(parentBid, mode)]
+            (d_key, d_hull, _) = self.ellipsoids[(deadBid, mode)]
+            if p_hull is None or d_hull is None:
+                # loaded from the DB, no hull to work with
+                continue
+            if p_key == self.getMembershipKey(parentBid, mode) and d_key == self.getMembershipKey(deadBid, mode):
+                merged_hulls[mode] = self.ET.getHullPoints(np_concatenate([p_hull, d_hull]))
+        return merged_hulls
+
+    def consumeBin(self, parentBin, deadBin, verbose=False):
+        """Have one bin consume another, carrying any cached hulls across"""
+        merged_hulls = self.getMergedHulls(parentBin.id, deadBin.id)
+        parentBin.consume(self.PM.transformedCP,
+                          self.PM.averageCoverages,
+                          self.PM.kmerNormPC1,
+                          self.PM.kmerPCs,
+                          self.PM.contigGCs,
+                          self.PM.contigLengths,
+                          deadBin,
+                          verbose=verbose)
+        for mode in merged_hulls:
+            self.ellipsoids[(parentBin.id, mode)] = (self.getMembershipKey(parentBin.id, mode), merged_hulls[mode], None)
+
+    def dropEllipsoids(self, bid):
+        """Forget any cached ellipsoids for this bin"""
+        for key in self.ellipsoids.keys():
+            if key[0] == bid:
+                del self.ellipsoids[key]
+
+    def saveEllipsoids(self):
+        """Save all the (still valid) cached ellipsoids into the DB
+
+        saveBins and setBinStats do this for you, in the same write
+        """
+        saved = self.getValidEllipsoids()
+        self.PM.setBinEllipsoids(self.makeEllipsoidRows(saved))
+        self.savedEllipsoids = saved
+
+    def getValidEllipsoids(self):
+        """All the cached and saved ellipsoids which still match their bins
+
+        returns { (bid, mode) : (memberKey, ellipsoid) }
+        """
+        if self.savedEllipsoids is None:
+            self.savedEllipsoids = self.PM.getBinEllipsoids()
+        member_keys = {}
+        saved = {}
+        for cache in [self.savedEllipsoids, self.ellipsoids]:
+            for (bid, mode) in cache:
+                if bid not in self.bins:
+                    continue
+                entry = cache[(bid, mode)]
+                if entry[-1] is None:
+                    # merged hull we haven't needed yet
+                    continue
+                if (bid, mode) not in member_keys:
+                    member_keys[(bid, mode)] = self.getMembershipKey(bid, mode)
+                if entry[0] == member_keys[(bid, mode)]:
+                    saved[(bid, mode)] = (entry[0], entry[-1])
+        return saved
+
+    def makeEllipsoidRows(self, saved):
+        """Turn the output of getValidEllipsoids into rows for the DB"""
+        return [(bid, mode, saved[(bid, mode)][0]) + tuple(saved[(bid, mode)][1]) for (bid, mode) in saved]
 
 
 #------------------------------------------------------------------------------
@@ -337,38 +535,20 @@ class BinManager:
     def getLinkingContigs(self, bid):
         """Get all contigs and their bin IDs which link to contigs in this bin"""
         bin2count = {}
-        for row_index in bin.rowIndices:
-            try:
-                #print row_index, len(self.PM.links[row_index]), self.PM.links[row_index], "===",
-                for link in self.PM.links[row_index]:
-                    #print "{{{",link,"}}}",
+        for row_index in self.getBin(bid).rowIndices:
+            (partners, num_reads) = self.PM.getRowLinks(row_index)
+            for link_bid in self.PM.binIds[partners]:
+                if link_bid != bid and link_bid != 0:
                     try:
-                        link_bid = self.PM.binIds[link[0]]
-                        #print ";;", link_bid, bid ,
-                        if link_bid != bid and link_bid != 0:
-                            try:
-                                bin2count[link_bid] += 1.0
-                            except KeyError:
-                                bin2count[link_bid] = 1.0
+                        bin2count[link_bid] += 1.0
                     except KeyError:
-                        pass#print "****\n\n"
-                #print "[[[[\n\n"
-            except KeyError:
-                pass
-        #print bin2count
+                        bin2count[link_bid] = 1.0
         return bin2count
 
     def getConnectedBins(self, rowIndex):
         """Get a  list of bins connected to this contig"""
-        ret_links = []
-        for link in self.PM.links[rowIndex]:
-            cid = link[0]
-            try:
-                bid = self.PM.binIds[cid]
-            except KeyError:
-                bid = 0
-            ret_links.append((cid, bid, link[1]))
-        return ret_links
+        (partners, num_reads) = self.PM.getRowLinks(rowIndex)
+        return zip(partners, self.PM.binIds[partners], num_reads)
 
     def getAllLinks(self):
         """Return a sorted array of all links between all bins"""
@@ -398,16 +578,11 @@ class BinManager:
         """Determine the average number of links between contigs in a bin"""
         links = []
         min_links = 1000000000
-        for row_index in bin.rowIndices:
-            try:
-                for link in self.PM.links[row_index]:
-                    link_bid = self.PM.binIds[link[0]]
-                    if link_bid == bid:
-                        links.append(link[1])
-                        if link[1] < min_links:
-                            min_links = link[1]
-            except KeyError:
-                pass
+        for row_index in self.getBin(bid).rowIndices:
+            (partners, num_reads) = self.PM.getRowLinks(row_index)
+            links.extend(num_reads[self.PM.binIds[partners] == bid])
+        if len(links) > 0:
+            min_links = min(min_links, np_min(links))
         return (np_mean(links), np_std(links), min_links)
 
 #------------------------------------------------------------------------------
@@ -688,7 +863,7 @@ class BinManager:
             dead_bin = self.getBin(bids[0])
             for row_index in dead_bin.rowIndices:
                 self.PM.binIds[row_index] = parent_bin.id
-            parent_bin.consume(self.PM.transformedCP, self.PM.averageCoverages, self.PM.kmerNormPC1, self.PM.kmerPCs, self.PM.contigGCs, self.PM.contigLengths, dead_bin, verbose=verbose)
+            self.consumeBin(parent_bin, dead_bin, verbose=verbose)
             self.deleteBins([bids[0]], force=True)
         else:
             # just use the first given as the parent
@@ -729,14 +904,7 @@ class BinManager:
                 for row_index in dead_bin.rowIndices:
                     self.PM.binIds[row_index] = parent_bin.id
 
-                parent_bin.consume(self.PM.transformedCP,
-                                   self.PM.averageCoverages,
-                                   self.PM.kmerNormPC1,
-                                   self.PM.kmerPCs,
-                                   self.PM.contigGCs,
-                                   self.PM.contigLengths,
-                                   dead_bin,
-                                   verbose=verbose)
+                self.consumeBin(parent_bin, dead_bin, verbose=verbose)
                 self.deleteBins([bids[i]], force=True)
                 some_merged = True
 
@@ -805,6 +973,7 @@ class BinManager:
                         bin_assignment_update[row_index] = 0
                 del self.bins[bid]
                 del self.PM.isLikelyChimeric[bid]
+                self.dropEllipsoids(bid)
             else:
                 raise ge.BinNotFoundException("Cannot find: "+str(bid)+" in bins dicts")
 
@@ -1188,6 +1357,7 @@ class BinManager:
                            self.PM.colorMapGC,
                            self.PM.isLikelyChimeric,
                            ET=ET,
+                           ellipsoid=(self.getBinEllipsoid(bid) if ET is not None else None),
                            printID=True,
                            ignoreContigLengths=ignoreContigLengths,
                            plotColorbar=(num_cols==1 and i==0)
@@ -1214,6 +1384,7 @@ class BinManager:
                                             self.PM.contigLengths,
                                             self.PM.colorMapGC,
                                             ET=ET,
+                                            ellipsoid=(self.getBinEllipsoid(bid, mode='mer2d') if ET is not None else None),
                                             printID=True,
                                             plotColorbar=(i==0)
                                             )
@@ -1378,11 +1549,13 @@ class BinManager:
                     self.bins[bid].plotBin(self.PM.transformedCP, self.PM.contigGCs, self.PM.kmerNormPC1,
                                             self.PM.contigLengths, self.PM.colorMapGC, self.PM.isLikelyChimeric,
                                             fileName=osp_join(folder, FNPrefix+"_"+str(bid)),
-                                            ignoreContigLengths=ignoreContigLengths, ET=ET)
+                                            ignoreContigLengths=ignoreContigLengths, ET=ET,
+                                            ellipsoid=(self.getBinEllipsoid(bid) if ET is not None else None))
                 else:
                     self.bins[bid].plotBin(self.PM.transformedCP, self.PM.contigGCs, self.PM.kmerNormPC1,
                                               self.PM.contigLengths, self.PM.colorMapGC, self.PM.isLikelyChimeric,
-                                              fileName=FNPrefix+"_"+str(bid), ignoreContigLengths=ignoreContigLengths, ET=ET)
+                                              fileName=FNPrefix+"_"+str(bid), ignoreContigLengths=ignoreContigLengths, ET=ET,
+                                              ellipsoid=(self.getBinEllipsoid(bid) if ET is not None else None))
 
     def plotBinCoverage(self, plotEllipses=False, plotContigLengs=False, printID=False):
         """Make plots of all the bins"""
@@ -1460,7 +1633,7 @@ class BinManager:
     def plotSideBySide(self, bids, fileName="", tag="", use_elipses=True, ignoreContigLengths=False):
         """Plot two bins side by side in 3d"""
         if use_elipses:
-            ET = EllipsoidTool()
+            ET = self.ET
         else:
             ET = None
         fig = plt.figure()
@@ -1495,6 +1668,7 @@ class BinManager:
             title = self.bins[bid].plotOnFig(fig, plot_rows, plot_cols, plot_num+1,
                                               self.PM.transformedCP, self.PM.contigGCs, self.PM.contigLengths,
                                               self.PM.colorMapGC, self.PM.isLikelyChimeric, ET=ET, fileName=fileName,
+                                              ellipsoid=(self.getBinEllipsoid(bid) if ET is not None else None),
                                               plotColorbar=(plot_num == len(bids)-1), extents=[xMin, xMax, yMin, yMax, zMin, zMax],
                                               ignoreContigLengths=ignoreContigLengths)
 
@@ -48,6 +48,7 @@ __email__ = "mike@mikeimelfort.com"
 ###############################################################################
 
 from sys import stdout, exit
+from time import time
 
 from colorsys import hsv_to_rgb as htr
 import matplotlib.pyplot as plt
@@ -76,6 +77,7 @@ from numpy import (abs as np_abs,
                    ones as np_ones,
                    pi as np_pi,
                    reshape as np_reshape,
+                   searchsorted as np_searchsorted,
                    seterr as np_seterr,
                    shape as np_shape,
                    sin as np_sin,
@@ -147,8 +149,14 @@ class ClusterEngine:
         self.imageCounter = 1           # when we print many images
         self.roundNumber = 0            # how many times have we tried to make a bin?
         self.subRoundNumber = 0         # measure sub rounds too!
+        self.numBelowCutoff = 0         # how many consecutive attempts have produced small bins
         self.TSpan = 0.                 # dist from centre to the corner
 
+        # checkpointing
+        self.coreCut = 0                # contig length cutoff the data was loaded with
+        self.checkpointInterval = 600   # seconds between checkpoints while making cores (None for never)
+        self.lastCheckpoint = time()
+
     def promptOnOverwrite(self, minimal=False):
         """Check that the user is ok with possibly overwriting the DB"""
         if(self.PM.isClustered()):
@@ -179,14 +187,29 @@ class ClusterEngine:
 #------------------------------------------------------------------------------
 # CORE CONSTRUCTION AND MANAGEMENT
 
-    def makeCores(self, coreCut, gf="", kmerThreshold=0.2, coverageThreshold=0.05):
-        """Cluster the contigs to make bin cores"""
+    def makeCores(self, coreCut, gf="", kmerThreshold=0.2, coverageThreshold=0.05, resume=False):
+        """Cluster the contigs to make bin cores
+
+        The state of the run is checkpointed into the DB every
+        self.checkpointInterval seconds and once the cores are made. If
+        resume is set we carry on from the last checkpoint
+        """
+        checkpoint = None
+        if resume:
+            checkpoint = self.PM.dataManager.getCoreCheckpoint(self.PM.dbFileName)
+            if checkpoint is None:
+                print "    No checkpoint found in", self.PM.dbFileName, "starting from scratch"
+            elif checkpoint['coreCut'] != coreCut:
+                print "    Using the cutoff of the checkpointed run: %d" % checkpoint['coreCut']
+                coreCut = checkpoint['coreCut']
+
         # check that the user is OK with nuking stuff...
-        if(not self.promptOnOverwrite()):
+        if(checkpoint is None and not self.promptOnOverwrite()):
             return False
 
         # get some data
-        self.PM.loadData(self.timer, "length >= "+str(coreCut))
+        self.coreCut = coreCut
+        self.PM.loadData(self.timer, "length >= "+str(coreCut), minLength=coreCut)
         print "    %s" % self.timer.getTimeStamp()
 
         # transform the data
@@ -201,10 +224,16 @@ class ClusterEngine:
 
         print "    %s" % self.timer.getTimeStamp()
 
+        if checkpoint is not None:
+            print "Resuming from checkpoint (%s, round %d)" % (checkpoint['stage'], checkpoint['roundNumber'])
+            self.restoreCheckpoint(checkpoint)
+
         # cluster and bin!
-        print "Create cores"
-        self.initialiseCores(kmerThreshold, coverageThreshold)
-        print "    %s" % self.timer.getTimeStamp()
+        if checkpoint is None or checkpoint['stage'] == 'cores':
+            print "Create cores"
+            self.initialiseCores(kmerThreshold, coverageThreshold, resumed=checkpoint is not None)
+            self.saveCheckpoint('refine')
+            print "    %s" % self.timer.getTimeStamp()
 
         # condense cores
         print "Refine cores [begin: %d]" % len(self.BM.bins)
@@ -217,23 +246,97 @@ class ClusterEngine:
         # Now save all the stuff to disk!
         print "Saving bins"
         self.BM.saveBins(nuke=True)
+        # new cores, so anything done to the old ones needs doing again
+        self.PM.setClustered()
+        self.PM.dataManager.setComplete(self.PM.dbFileName, False)
+        self.PM.dataManager.setRecruited(self.PM.dbFileName, False)
+        self.PM.dataManager.removeCoreCheckpoint(self.PM.dbFileName)
         print "    %s" % self.timer.getTimeStamp()
 
-    def initialiseCores(self, kmerThreshold, coverageThreshold):
-        """Process contigs and form CORE bins"""
-        num_below_cutoff = 0            # how many consecutive attempts have produced small bins
+    def saveCheckpoint(self, stage):
+        """Save enough of the state of a core run into the DB to carry on later
+
+        stage is where the resumed run picks up, 'cores' or 'refine'
+        """
+        members = []
+        member_bids = []
+        for bid in self.BM.getBids():
+            members.append(self.PM.indices[self.BM.bins[bid].rowIndices])
+            member_bids.append(np_ones(len(self.BM.bins[bid].rowIndices), dtype=int) * bid)
+        if len(members) > 0:
+            members = np_concatenate(members)
+            member_bids = np_concatenate(member_bids)
+        restricted = self.PM.indices[np_array(sorted(self.PM.restrictedRowIndices.keys()), dtype=int)]
+        self.PM.dataManager.setCoreCheckpoint(self.PM.dbFileName,
+                                              {'stage' : stage,
+                                               'coreCut' : self.coreCut,
+                                               'roundNumber' : self.roundNumber,
+                                               'subRoundNumber' : self.subRoundNumber,
+                                               'numBelowCutoff' : self.numBelowCutoff,
+                                               'imageCounter' : self.imageCounter,
+                                               'nextFreeBinId' : self.BM.nextFreeBinId,
+                                               'members' : members,
+                                               'memberBids' : member_bids,
+                                               'chimeric' : [bid for bid in self.BM.getBids() if self.PM.isLikelyChimeric.get(bid, False)],
+                                               'restricted' : restricted,
+                                               'imageMaps' : self.imageMaps})
+        self.lastCheckpoint = time()
+
+    def restoreCheckpoint(self, checkpoint):
+        """Put the state saved by saveCheckpoint back
+
+        The data must already be loaded with the checkpointed cutoff
+        """
+        self.roundNumber = checkpoint['roundNumber']
+        self.subRoundNumber = checkpoint['subRoundNumber']
+        self.numBelowCutoff = checkpoint['numBelowCutoff']
+        self.imageCounter = checkpoint['imageCounter']
+
+        # the checkpoint uses global indices, we want row indices
+        member_rows = np_searchsorted(self.PM.indices, checkpoint['members'])
+        bin_members = {}
+        for (row_index, bid) in zip(member_rows, checkpoint['memberBids']):
+            try:
+                bin_members[bid].append(row_index)
+            except KeyError:
+                bin_members[bid] = [row_index]
+        for bid in sorted(bin_members.keys()):
+            bin = self.BM.makeNewBin(rowIndices=np_array(bin_members[bid]), bid=bid)
+            bin.makeBinDist(self.PM.transformedCP, self.PM.averageCoverages, self.PM.kmerNormPC1, self.PM.kmerPCs, self.PM.contigGCs, self.PM.contigLengths)
+            for row_index in bin.rowIndices:
+                self.PM.binIds[row_index] = bid
+                self.PM.binnedRowIndices[row_index] = True
+        for bid in checkpoint['chimeric']:
+            self.PM.isLikelyChimeric[bid] = True
+        self.BM.nextFreeBinId = checkpoint['nextFreeBinId']
+
+        for row_index in np_searchsorted(self.PM.indices, checkpoint['restricted']):
+            self.PM.restrictedRowIndices[row_index] = True
+
+        # the image maps already have the binned and restricted contigs taken out
+        self.mapRowIndices()
+        self.imageMaps = checkpoint['imageMaps']
+
+    def initialiseCores(self, kmerThreshold, coverageThreshold, resumed=False):
+        """Process contigs and form CORE bins
+
+        If resumed is set then the image maps and bins have been restored
+        from a checkpoint and we carry on from there
+        """
         breakout_point = 30            # how many will we allow before we stop this loop
 
         # First we need to find the centers of each blob.
         # We can make a heat map and look for hot spots
-        self.populateImageMaps()
+        if not resumed:
+            self.numBelowCutoff = 0
+            self.populateImageMaps()
         sub_counter = 0
         print "     .... .... .... .... .... .... .... .... .... ...."
         print "%4d" % sub_counter,
         new_line_counter = 0
         num_bins = 0
 
-        while(num_below_cutoff < breakout_point):
+        while(self.numBelowCutoff < breakout_point):
             stdout.flush()
 
             # apply a gaussian blur to each image map to make hot spots
@@ -283,7 +386,7 @@ class ClusterEngine:
                 # did we do anything?
                 num_bids_made = len(bids_made)
                 if(num_bids_made == 0):
-                    num_below_cutoff += 1
+                    self.numBelowCutoff += 1
                     # nuke the lot!
                     for row_indices in partitions:
                         self.restrictRowIndices(row_indices)
@@ -315,6 +418,10 @@ class ClusterEngine:
 
                     except BinNotFoundException: pass
 
+                # the state is consistent between rounds so this is when we checkpoint
+                if self.checkpointInterval is not None and time() - self.lastCheckpoint > self.checkpointInterval:
+                    self.saveCheckpoint('cores')
+
         print "\n     .... .... .... .... .... .... .... .... .... ...."
 
     def findNewClusterCenters(self, kmerThreshold, coverageThreshold):
@@ -885,6 +992,17 @@ class ClusterEngine:
 #------------------------------------------------------------------------------
 # DATA MAP MANAGEMENT
 
+    def mapRowIndices(self):
+        """Relate every point in the image maps back to its contigs"""
+        self.im2RowIndices = {}
+        row_index = -1
+        for point in np_around(self.PM.transformedCP):
+            row_index += 1
+            try:
+                self.im2RowIndices[tuple(point)].append(row_index)
+            except KeyError:
+                self.im2RowIndices[tuple(point)] = [row_index]
+
     def populateImageMaps(self):
         """Load the transformed data into the main image maps"""
         # reset these guys... JIC
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+###############################################################################
+#                                                                             #
+#    distanceStats.py                                                         #
+#                                                                             #
+#    Bounded memory statistics over pairwise distances                        #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#          .d8888b.                                    888b     d888          #
+#         d88P  Y88b                                   8888b   d8888          #
+#         888    888                                   88888b.d88888          #
+#         888        888d888 .d88b.   .d88b.  88888b.  888Y88888P888          #
+#         888  88888 888P"  d88""88b d88""88b 888 "88b 888 Y888P 888          #
+#         888    888 888    888  888 888  888 888  888 888  Y8P  888          #
+#         Y88b  d88P 888    Y88..88P Y88..88P 888 d88P 888   "   888          #
+#          "Y8888P88 888     "Y88P"   "Y88P"  88888P"  888       888          #
+#                                             888                             #
+#                                             888                             #
+#                                             888                             #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2012/2013"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPL3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+
+###############################################################################
+
+from numpy import (arange as np_arange,
+                   array as np_array,
+                   bincount as np_bincount,
+                   clip as np_clip,
+                   concatenate as np_concatenate,
+                   cumsum as np_cumsum,
+                   linspace as np_linspace,
+                   max as np_max,
+                   median as np_median,
+                   min as np_min,
+                   newaxis as np_newaxis,
+                   searchsorted as np_searchsorted,
+                   seterr as np_seterr,
+                   sort as np_sort,
+                   sum as np_sum,
+                   zeros as np_zeros)
+from scipy.spatial.distance import cdist, pdist
+
+np_seterr(all='raise')
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# the most distances we'll hold in memory at any one time (~32MB of floats)
+DIST_BUDGET = 4000000
+
+# number of bins used for each round of histogram refinement
+HIST_BINS = 1024
+
+def medianPdist(X, metric='euclidean', budget=DIST_BUDGET):
+    """Median of pdist(X, metric) without building the whole distance vector
+
+    Returns None if there are fewer than 2 points
+    """
+    num_points = len(X)
+    num_dists = num_points * (num_points - 1) / 2
+    if num_dists == 0:
+        return None
+    if num_dists <= budget:
+        return np_median(pdist(X, metric))
+
+    def chunks():
+        # blocks of rows against everything below them, upper triangle only
+        step = max(1, int(budget / num_points))
+        for i in xrange(0, num_points - 1, step):
+            j = min(num_points, i + step)
+            dists = cdist(X[i:j], X[i:], metric)
+            upper = np_arange(i, num_points)[np_newaxis,:] > np_arange(i, j)[:,np_newaxis]
+            yield dists[upper]
+
+    return chunkedMedian(chunks, num_dists, budget)
+
+def medianCdist(X, Y, metric='euclidean', budget=DIST_BUDGET):
+    """Median of cdist(X, Y, metric) without building the whole distance matrix"""
+    num_dists = len(X) * len(Y)
+    if num_dists <= budget:
+        return np_median(cdist(X, Y, metric))
+
+    def chunks():
+        step = max(1, int(budget / len(Y)))
+        for i in xrange(0, len(X), step):
+            yield cdist(X[i:i+step], Y, metric).ravel()
+
+    return chunkedMedian(chunks, num_dists, budget)
+
+def chunkedMedian(chunks, numVals, budget=DIST_BUDGET, numBins=HIST_BINS):
+    """Exact median of a stream of values using histogram refinement
+
+    chunks is a callable which returns a fresh iterator over arrays of
+    values each time it is called (we make several passes). numVals is
+    the total number of values. We keep narrowing the range which holds
+    the middle rank(s) until what's left fits in budget, then sort it
+    """
+    # the ranks np.median would average
+    ranks = [(numVals - 1) / 2, numVals / 2]
+
+    # first pass, find the range
+    lo = None
+    hi = None
+    for vals in chunks():
+        if len(vals) == 0:
+            continue
+        if lo is None:
+            lo = np_min(vals)
+            hi = np_max(vals)
+        else:
+            lo = min(lo, np_min(vals))
+            hi = max(hi, np_max(vals))
+
+    num_in_range = numVals
+    while num_in_range > budget and hi > lo:
+        edges = np_linspace(lo, hi, numBins + 1)
+        counts = np_zeros(numBins, dtype=int)
+        below = 0
+        for vals in chunks():
+            below += np_sum(vals < lo)
+            in_range = vals[(vals >= lo) & (vals <= hi)]
+            # bins are [e_i, e_i+1) except the last one which holds hi too
+            bin_index = np_clip(np_searchsorted(edges, in_range, side='right') - 1, 0, numBins - 1)
+            counts += np_bincount(bin_index, minlength=numBins)
+
+        cum_counts = below + np_cumsum(counts)
+        first_bin = np_searchsorted(cum_counts, ranks[0], side='right')
+        last_bin = np_searchsorted(cum_counts, ranks[1], side='right')
+        new_lo = edges[first_bin]
+        new_hi = edges[last_bin + 1]
+        if first_bin == 0:
+            num_in_range = cum_counts[last_bin] - below
+        else:
+            num_in_range = cum_counts[last_bin] - cum_counts[first_bin - 1]
+        if new_lo == lo and new_hi == hi:
+            # can't split this range any further
+            break
+        (lo, hi) = (new_lo, new_hi)
+
+    if hi == lo:
+        # everything left is the same value
+        return lo
+
+    # last pass, gather up whatever is left and pick out the middle
+    below = 0
+    kept = []
+    for vals in chunks():
+        below += np_sum(vals < lo)
+        kept.append(vals[(vals >= lo) & (vals <= hi)])
+    kept = np_sort(np_concatenate(kept))
+    return (kept[ranks[0] - below] + kept[ranks[1] - below]) / 2.
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -50,6 +50,8 @@ __email__ = "mike@mikeimelfort.com"
 import matplotlib.pyplot as plt
 import numpy as np
 from numpy import linalg
+from scipy.spatial import ConvexHull
+from scipy.spatial.qhull import QhullError
 
 np.seterr(all='raise')
 
@@ -60,9 +62,12 @@ np.seterr(all='raise')
 
 class EllipsoidTool:
     """Some stuff for playing with ellipsoids"""
-    def __init__(self): pass
+    def __init__(self):
+        # wire frames are the same every time, so make them once
+        self.unitSpheres = {}
+        self.unitCircles = {}
 
-    def getMinVolEllipse(self, P, tolerance=0.01, retA=False):
+    def getMinVolEllipse(self, P, tolerance=0.01, retA=False, useHull=False, retries=0, maxRetries=10):
         """ Find the minimum volume ellipsoid which holds all the points
 
         Based on work by Nima Moshtagh
@@ -76,50 +81,39 @@ class EllipsoidTool:
              [x,y,z],
              [x,y,z]]
 
+        Set useHull to only work with the points on the convex hull
+        (the ellipsoid is the same, there are just fewer points)
+
+        If the points are flat they are jittered and we try again, at most
+        maxRetries times before giving up and returning a degenerate ellipse
+
         Returns:
         (center, radii, rotation)
 
         """
+        P = np.asarray(P, dtype=float)
+        if useHull:
+            P = self.getHullPoints(P)
         (N, d) = np.shape(P)
 
-        # Q will be out working array
-        Q = np.copy(P.T)
-        Q = np.vstack([Q, np.ones(N)])
-        QT = Q.T
-
-        # initializations
-        err = 1 + tolerance
-        u = np.array([1.0 / N for i in range(N)]) # first iteration
-
         # Khachiyan Algorithm
         singular = False
-        while err > tolerance:
-            V = np.dot(Q, np.dot(np.diag(u), QT))
-            try:
-                M = np.diag(np.dot(QT , np.dot(linalg.inv(V), Q)))    # M the diagonal vector of an NxN matrix
-            except linalg.linalg.LinAlgError:
-                # most likely a singular matrix
-                # permute the values a little and then we'll try again
-                from random import random, randint
-                PP = np.copy(P)
-                for i in range(N):
-                    if randint(0,3) == 0:
-                        j = randint(0,2)
-                        if randint(0,1) != 0:
-                            PP[i,j] += random()
-                        else:
-                            PP[i,j] -= random()
-                (A, center, radii, rotation) = self.getMinVolEllipse(PP, retA=True)
-                singular = True
-                break
-
-            j = np.argmax(M)
-            maximum = M[j]
-            step_size = (maximum - d - 1.0) / ((d + 1.0) * (maximum - 1.0))
-            new_u = (1.0 - step_size) * u
-            new_u[j] += step_size
-            err = np.linalg.norm(new_u - u)
-            u = new_u
+        try:
+            u = self.khachiyan(P, tolerance)
+        except linalg.linalg.LinAlgError:
+            # most likely a singular matrix
+            if retries >= maxRetries:
+                return self.getDegenerateEllipse(P, retA)
+            # permute the values a little and then we'll try again
+            # seed on the retry so we get the same answer every time
+            # but don't keep nudging the same values
+            PP = self.jitterPoints(P, seed=retries)
+            (A, center, radii, rotation) = self.getMinVolEllipse(PP,
+                                                                 tolerance=tolerance,
+                                                                 retA=True,
+                                                                 retries=retries+1,
+                                                                 maxRetries=maxRetries)
+            singular = True
 
         if not singular:
             # center of the ellipse
@@ -128,24 +122,12 @@ class EllipsoidTool:
             # the A matrix for the ellipse
             try:
                 A = linalg.inv(
-                               np.dot(P.T, np.dot(np.diag(u), P)) -
-                               np.array([[a * b for b in center] for a in center])
+                               np.dot(P.T * u, P) -
+                               np.outer(center, center)
                                ) / d
             except linalg.linalg.LinAlgError:
                 # the matrix is singular so we need to return a degenerate ellipse
-                #print '[Notice] Degenerate ellipse constructed indicating a bin with extremely small coverage divergence.'
-                center = np.mean(P, axis=0)
-                radii = np.max(P,axis=0) - np.min(P, axis=0)
-
-                if len(P[0]) == 3:
-                    rotation = [[0,0,0],[0,0,0],[0,0,0]]
-                else:
-                    rotation = [[0,0],[0,0]]
-
-                if retA:
-                    return (None, center, radii, rotation)
-                else:
-                    return (center, radii, rotation)
+                return self.getDegenerateEllipse(P, retA)
 
             # Get the values we'd like to return
             try:
@@ -164,6 +146,90 @@ class EllipsoidTool:
         else:
             return (center, radii, rotation)
 
+    def getDegenerateEllipse(self, P, retA=False):
+        """The box around P, for when we can't make a proper ellipse"""
+        #print '[Notice] Degenerate ellipse constructed indicating a bin with extremely small coverage divergence.'
+        center = np.mean(P, axis=0)
+        radii = np.max(P,axis=0) - np.min(P, axis=0)
+
+        if len(P[0]) == 3:
+            rotation = [[0,0,0],[0,0,0],[0,0,0]]
+        else:
+            rotation = [[0,0],[0,0]]
+
+        if retA:
+            return (None, center, radii, rotation)
+        else:
+            return (center, radii, rotation)
+
+    def khachiyan(self, P, tolerance, refresh=100):
+        """Khachiyan iterations, returns the weights u for the points in P
+
+        We never form the NxN matrices. The diagonal of QT.inv(V).Q is
+        worked out with einsum and each step only moves weight onto one
+        point, so inv(V) and the diagonal get rank-one (Sherman-Morrison)
+        updates. Every refresh iterations we recompute from scratch to
+        keep rounding errors in check.
+
+        Raises LinAlgError if V is singular
+        """
+        (N, d) = np.shape(P)
+
+        # Q will be out working array
+        QT = np.hstack([P, np.ones((N,1))])
+
+        # initializations
+        err = 1 + tolerance
+        u = np.ones(N) / N # first iteration
+
+        iteration = 0
+        while err > tolerance:
+            if iteration % refresh == 0:
+                V = np.dot(QT.T * u, QT)
+                V_inv = linalg.inv(V)
+                M = np.einsum('ij,jk,ik->i', QT, V_inv, QT)    # M the diagonal vector of an NxN matrix
+            iteration += 1
+
+            j = np.argmax(M)
+            maximum = M[j]
+            step_size = (maximum - d - 1.0) / ((d + 1.0) * (maximum - 1.0))
+            new_u = (1.0 - step_size) * u
+            new_u[j] += step_size
+            err = np.linalg.norm(new_u - u)
+            u = new_u
+
+            # V <- (1-step)V + step*qq'
+            c = step_size / (1.0 - step_size)
+            V_inv_q = np.dot(V_inv, QT[j])
+            w = np.dot(QT, V_inv_q)
+            denom = 1.0 + c * maximum
+            V_inv = (V_inv - (c / denom) * np.outer(V_inv_q, V_inv_q)) / (1.0 - step_size)
+            M = (M - (c / denom) * w**2) / (1.0 - step_size)
+        return u
+
+    def getHullPoints(self, P):
+        """Return only the points of P which sit on its convex hull
+
+        Falls back to all the points if the hull can't be built
+        (too few points, or they're all flat)
+        """
+        (N, d) = np.shape(P)
+        if N <= 2 * (d + 1):
+            return P
+        try:
+            return P[ConvexHull(P).vertices]
+        except (QhullError, ValueError):
+            return P
+
+    def jitterPoints(self, P, seed=0):
+        """Nudge every value in P by up to +/-1
+
+        Always nudges the same way for the same seed. Every coordinate
+        moves so whichever axis the points are flat along gets spread out
+        """
+        RS = np.random.RandomState(seed)
+        return P + RS.uniform(-1., 1., size=np.shape(P))
+
     def getEllipsoidVolume(self, radii):
         """Calculate the volume of the blob"""
         if len(radii) == 2:
@@ -171,11 +237,12 @@ class EllipsoidTool:
         else:
             return (4.0/3.0)*np.pi*radii[0]*radii[1]*radii[2]
 
-    def doesIntersect3D(self, A, cA, B, cB):
+    def doesIntersect3D(self, A, cA, B, cB, exact=False):
         """Rough test to see if ellipsoids A and B intersect
 
         Not perfect, should work for "well overlapping" ones
         We assume that the volume of B is less than (or =) volume of A
+        Set exact to use the (slower) exact overlap test instead
         """
         #To make things simple, we just check if the points on a wire frame of
         #B lie within A
@@ -188,11 +255,18 @@ class EllipsoidTool:
             if np.dot(p_c.T, np.dot(A, p_c)) <= 1:
                 return True
         except (TypeError, ValueError):
-                return False
+            return False
 
         if A is None or B is None: # degenerate ellipse that can't be processed
             return False
 
+        if exact:
+            try:
+                return self.doesIntersectExact(A, cA, B, cB)
+            except linalg.linalg.LinAlgError:
+                # one of them is flat, fall back to the wire frame
+                pass
+
         U, s, rotation = linalg.svd(B)
         try:
             radii_B = 1.0/np.sqrt(s)
@@ -203,32 +277,16 @@ class EllipsoidTool:
             p_c = cB - cA
             return np.dot(p_c.T, np.dot(A, p_c)) <= 1
 
-        u = np.linspace(0.0, 2.0 * np.pi, 100)
-        v = np.linspace(0.0, np.pi, 100)
-
-        # cartesian coordinates that correspond to the spherical angles:
-        x = radii_B[0] * np.outer(np.cos(u), np.sin(v))
-        y = radii_B[1] * np.outer(np.sin(u), np.sin(v))
-        z = radii_B[2] * np.outer(np.ones_like(u), np.cos(v))
-
-        # rotate accordingly
-        for i in range(len(x)):
-            for j in range(len(x)):
-                # make a point on the wireFrame
-                wire_point = np.dot([x[i,j],y[i,j],z[i,j]], rotation) + cB
-                # test if it's inside
-                # work out (p-c)'A(p-c) and see if it's <= 1
-                p_c = wire_point - cA
-                if np.dot(p_c.T, np.dot(A, p_c)) <= 1:
-                    return True
-
-        return False
+        # points on a wire frame of B, rotated accordingly
+        wire_frame = np.dot(self.getUnitSphere() * radii_B, rotation) + cB
+        return self.anyInside(A, cA, wire_frame)
 
-    def doesIntersect2D(self, A, cA, B, cB):
+    def doesIntersect2D(self, A, cA, B, cB, exact=False):
         """Rough test to see if ellipsoids A and B intersect
 
         Not perfect, should work for "well overlapping" ones
         We assume that the volume of B is less than (or =) volume of A
+        Set exact to use the (slower) exact overlap test instead
         """
         #To make things simple, we just check if the points on a wire frame of
         #B lie within A
@@ -237,12 +295,22 @@ class EllipsoidTool:
         # degenerate cases where B is only a single point or an otherwise
         # degenerate ellipse.
         p_c = cB - cA
-        if np.dot(p_c.T, np.dot(A, p_c)) <= 1:
-            return True
+        try:
+            if np.dot(p_c.T, np.dot(A, p_c)) <= 1:
+                return True
+        except (TypeError, ValueError):
+            return False
 
-        if A == None or B == None:  # degenerate ellipse that can't be processed
+        if A is None or B is None:  # degenerate ellipse that can't be processed
             return False
 
+        if exact:
+            try:
+                return self.doesIntersectExact(A, cA, B, cB)
+            except linalg.linalg.LinAlgError:
+                # one of them is flat, fall back to the wire frame
+                pass
+
         U, s, rotation = linalg.svd(B)
         try:
             radii_B = 1.0/np.sqrt(s)
@@ -253,22 +321,86 @@ class EllipsoidTool:
             p_c = cB - cA
             return np.dot(p_c.T, np.dot(A, p_c)) <= 1
 
-        u = np.linspace(0.0, 2.0 * np.pi, 100)
+        # points on the edge of B, rotated accordingly
+        edge = np.dot(self.getUnitCircle() * radii_B, rotation) + cB
+        return self.anyInside(A, cA, edge)
 
-        # cartesian coordinates that correspond to the spherical angles:
-        x = radii_B[0] * np.cos(u)
-        y = radii_B[1] * np.sin(u)
-        # rotate accordingly
-        for i in range(len(x)):
-            # make a point on the wireFrame
-            edge_point = np.dot([x[i],y[i]], rotation) + cB
-            # test if it's inside
-            # work out (p-c)'A(p-c) and see if it's <= 1
-            p_c = edge_point - cA
-            if np.dot(p_c.T, np.dot(A, p_c)) <= 1:
+    def anyInside(self, A, cA, points, blockSize=1000):
+        """Does any point lie within the ellipsoid A centred on cA?
+
+        Works out (p-c)'A(p-c) for a block of points at a time and
+        stops as soon as one is <= 1
+        """
+        for i in range(0, len(points), blockSize):
+            p_c = points[i:i+blockSize] - cA
+            if np.any(np.einsum('ij,jk,ik->i', p_c, A, p_c) <= 1):
                 return True
         return False
 
+    def doesIntersectExact(self, A, cA, B, cB, tolerance=1e-6):
+        """Exact test to see if ellipsoids A and B intersect
+
+        Uses the separating criterion from Gilitschenski and Hanebeck
+        (A Robust Computational Test for Overlap of Two Arbitrary-dimensional
+        Ellipsoids, 2012). With shape matrices SA = inv(A) and SB = inv(B)
+
+            K(s) = 1 - v'(SA/(1-s) + SB/s)^-1 v,   v = cB - cA
+
+        is convex on (0,1) and the ellipsoids are disjoint iff K(s) < 0
+        somewhere in there. Raises LinAlgError if A or B is singular
+        """
+        S_A = linalg.inv(A)
+        S_B = linalg.inv(B)
+        v = cB - cA
+
+        def K(s):
+            return 1. - np.dot(v, linalg.solve(S_A/(1.-s) + S_B/s, v))
+
+        # golden section search for the minimum of K
+        ratio = (np.sqrt(5.) - 1.) / 2.
+        (lo, hi) = (tolerance, 1. - tolerance)
+        s1 = hi - ratio * (hi - lo)
+        s2 = lo + ratio * (hi - lo)
+        (k1, k2) = (K(s1), K(s2))
+        while hi - lo > tolerance:
+            if k1 < 0 or k2 < 0:
+                # found a separating point
+                return False
+            if k1 < k2:
+                (hi, s2, k2) = (s2, s1, k1)
+                s1 = hi - ratio * (hi - lo)
+                k1 = K(s1)
+            else:
+                (lo, s1, k1) = (s1, s2, k2)
+                s2 = lo + ratio * (hi - lo)
+                k2 = K(s2)
+        return min(k1, k2) >= 0
+
+    def getUnitSphere(self, resolution=100):
+        """Points on a wire frame of the unit sphere as an (N,3) array"""
+        try:
+            return self.unitSpheres[resolution]
+        except KeyError:
+            pass
+        u = np.linspace(0.0, 2.0 * np.pi, resolution)
+        v = np.linspace(0.0, np.pi, resolution)
+
+        # cartesian coordinates that correspond to the spherical angles:
+        self.unitSpheres[resolution] = np.transpose([np.outer(np.cos(u), np.sin(v)).ravel(),
+                                                     np.outer(np.sin(u), np.sin(v)).ravel(),
+                                                     np.outer(np.ones_like(u), np.cos(v)).ravel()])
+        return self.unitSpheres[resolution]
+
+    def getUnitCircle(self, resolution=100):
+        """Points on the unit circle as an (N,2) array"""
+        try:
+            return self.unitCircles[resolution]
+        except KeyError:
+            pass
+        u = np.linspace(0.0, 2.0 * np.pi, resolution)
+        self.unitCircles[resolution] = np.transpose([np.cos(u), np.sin(u)])
+        return self.unitCircles[resolution]
+
     def plotEllipsoid(self, center, radii, rotation, ax=None, plotAxes=False, cageColor='b', cageAlpha=0.2, label=None):
         """Plot an ellipsoid"""
         make_ax = ax == None
@@ -57,6 +57,7 @@ import cluster
 import refine
 import binManager
 import groopmUtils
+import batch
 import groopmTimekeeper as gtime
 from groopmExceptions import ExtractModeNotAppropriateException
 from mstore import GMDataManager
@@ -135,7 +136,8 @@ class GroopMOptionsParser():
             else:
                 gf=options.graphfile
             CE.makeCores(coreCut=options.cutoff,
-                         gf=gf)
+                         gf=gf,
+                         resume=options.resume)
 
         elif(options.subparser_name == 'refine'):
             # refine bin cores
@@ -148,11 +150,15 @@ class GroopMOptionsParser():
             auto = options.auto
             transform=True^options.no_transform
 
+            # fix up any half saved bins before we start
+            GMDataManager().checkBins(options.dbname, repair=True)
             RE = refine.RefineEngine(timer,
                                      dbFileName=options.dbname,
                                      transform=transform,
                                      bids=bids,
-                                     loadContigNames=True)
+                                     loadContigNames=True,
+                                     threads=options.threads,
+                                     exactIntersect=options.exact)
 
             if options.plot:
                 pfx="REFINED"
@@ -170,11 +176,13 @@ class GroopMOptionsParser():
             print "*******************************************************************************"
             print " [[GroopM %s]] Running in bin expansion mode..." % self.GMVersion
             print "*******************************************************************************"
+            GMDataManager().checkBins(options.dbname, repair=True)
             RE = refine.RefineEngine(timer,
                                      dbFileName=options.dbname,
                                      getUnbinned=True,
                                      loadContigNames=False,
-                                     cutOff=options.cutoff)
+                                     cutOff=options.cutoff,
+                                     threads=options.threads)
 
             RE.recruitWrapper(timer,
                               inclusivity=options.inclusivity,
@@ -197,7 +205,8 @@ class GroopMOptionsParser():
                 BX.extractContigs(timer,
                                   fasta=options.data,
                                   prefix=options.prefix,
-                                  cutoff=options.cutoff)
+                                  cutoff=options.cutoff,
+                                  threads=options.threads)
 
             elif(options.mode=='reads'):
                 BX.extractReads(timer,
@@ -223,6 +232,7 @@ class GroopMOptionsParser():
             print "*******************************************************************************"
             print " [[GroopM %s]] Running in bin merging mode..." % self.GMVersion
             print "*******************************************************************************"
+            GMDataManager().checkBins(options.dbname, repair=True)
             BM = binManager.BinManager(dbFileName=options.dbname)
             BM.loadBins(timer, makeBins=True, silent=False)
             BM.merge(options.bids, options.force, saveBins=True)
@@ -232,6 +242,7 @@ class GroopMOptionsParser():
             print "*******************************************************************************"
             print " [[GroopM %s]] Running in bin splitting mode..." % self.GMVersion
             print "*******************************************************************************"
+            GMDataManager().checkBins(options.dbname, repair=True)
             BM = binManager.BinManager(dbFileName=options.dbname)
             BM.loadBins(timer, makeBins=True, silent=False)
             BM.split(options.bid, options.parts, mode=options.mode, saveBins=True, auto=options.force)
@@ -241,6 +252,7 @@ class GroopMOptionsParser():
             print "*******************************************************************************"
             print " [[GroopM %s]] Running in bin deleting mode..." % self.GMVersion
             print "*******************************************************************************"
+            GMDataManager().checkBins(options.dbname, repair=True)
             BM = binManager.BinManager(dbFileName=options.dbname)
             BM.loadBins(timer, makeBins=True, silent=True)#, bids=options.bids)
             BM.deleteBins(options.bids, force=options.force, saveBins=True, freeBinnedRowIndices=True)
@@ -378,7 +390,35 @@ class GroopMOptionsParser():
                         fields,
                         options.outfile,
                         separator,
-                        not options.no_headers)
+                        not options.no_headers,
+                        outFormat=options.format)
+
+        elif(options.subparser_name == 'batch'):
+            print "*******************************************************************************"
+            print " [[GroopM %s]] Running in batch mode..." % self.GMVersion
+            print "*******************************************************************************"
+            BR = batch.BatchRunner(options.manifest,
+                                   threads=options.threads,
+                                   parseCutoff=options.parse_cutoff,
+                                   coreCutoff=options.core_cutoff,
+                                   minSize=options.size,
+                                   minVol=options.bp,
+                                   recruitCutoff=options.recruit_cutoff,
+                                   inclusivity=options.inclusivity,
+                                   step=options.step)
+            BR.run()
+
+        elif(options.subparser_name == 'cache'):
+            print "*******************************************************************************"
+            print " [[GroopM %s]] Running in profile caching mode..." % self.GMVersion
+            print "*******************************************************************************"
+            DM = GMDataManager()
+            if options.remove:
+                DM.removeProfileCache(options.dbname)
+            else:
+                # upgrading touches the DB so do it before we stamp the cache
+                DM.checkAndUpgradeDB(options.dbname)
+                DM.makeProfileCache(options.dbname)
 
         return 0
 
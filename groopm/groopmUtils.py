@@ -73,6 +73,37 @@ from bamm.bamExtractor import BamExtractor as BMBE
 ###############################################################################
 ###############################################################################
 
+def writeBinContigs(job):
+    """Write the contigs of one bin to a fasta file
+
+    job is (file_name, [(cid, location)]) where location is one of
+    (fasta file name, fai entry), (None, seq) or None if we never found it
+    """
+    (file_name, members) = job
+    CP = mstore.ContigParser()
+    handles = {}
+    try:
+        with open(file_name, 'w') as f:
+            for (cid, location) in members:
+                if location is None:
+                    print "These are not the contigs you're looking for. ( %s )" % (cid)
+                elif location[0] is None:
+                    f.write(">%s\n%s\n" % (cid, location[1]))
+                else:
+                    if location[0] not in handles:
+                        handles[location[0]] = open(location[0], 'rb')
+                    f.write(">%s\n%s\n" % (cid, CP.fetchSeq(handles[location[0]], location[1])))
+    except:
+        print "Could not open file for writing:",file_name,sys.exc_info()[0]
+        raise
+    finally:
+        for fh in handles.values():
+            fh.close()
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
 class GMExtractor:
     """Used for extracting reads and contigs based on bin assignments"""
     def __init__(self, dbFileName,
@@ -99,8 +130,14 @@ class GMExtractor:
                        timer,
                        fasta=[],
                        prefix='',
-                       cutoff=0):
-        """Extract contigs and write to file"""
+                       cutoff=0,
+                       threads=1):
+        """Extract contigs and write to file
+
+        Plain fasta files are indexed (.fai) and each bin's contigs are read
+        straight from disk as its file is written. Gzipped or unevenly
+        wrapped files are scanned once and their wanted contigs kept in memory
+        """
         self.BM = binManager.BinManager(dbFileName=self.dbFileName)   # bins
         self.BM.loadBins(timer, makeBins=True,silent=False,bids=self.bids, cutOff=cutoff)
         self.PM = self.BM.PM
@@ -111,9 +148,10 @@ class GMExtractor:
                             .replace(".gm", "") \
                             .replace(".sm", "")
 
-        # load all the contigs which have been assigned to bins
+        # work out where all the contigs which have been assigned to bins live
         CP = mstore.ContigParser()
-        # contigs looks like cid->seq
+        wanted = set(self.PM.contigNames)
+        # contigs looks like cid->(file_name, fai entry) or cid->(None, seq)
         contigs = {}
         import mimetypes
         try:
@@ -128,30 +166,46 @@ class GMExtractor:
                 except:
                     print "Error when guessing contig file mimetype"
                     raise
-                with GM_open(file_name, "r") as f:
-                    contigs = CP.getWantedSeqs(f, self.PM.contigNames, storage=contigs)
+                fai = None
+                if GM_open == open:
+                    fai = CP.getFastaIndex(file_name)
+                if fai is not None:
+                    for cid in wanted:
+                        if cid in fai:
+                            contigs[cid] = (file_name, fai[cid])
+                else:
+                    with GM_open(file_name, "r") as f:
+                        for (cid, seq) in CP.getWantedSeqs(f, wanted, storage={}).iteritems():
+                            contigs[cid] = (None, seq)
         except:
             print "Could not parse contig file:",fasta[0],sys.exc_info()[0]
             raise
 
         # now print out the sequences
         print "Writing files"
+        jobs = []
         for bid in self.BM.getBids():
             if self.BM.PM.isLikelyChimeric[bid]:
                 file_name = os.path.join(self.outDir, "%s_bin_%d.chimeric.fna" % (self.prefix, bid))
             else:
                 file_name = os.path.join(self.outDir, "%s_bin_%d.fna" % (self.prefix, bid))
+            members = []
+            for row_index in self.BM.getBin(bid).rowIndices:
+                cid = self.PM.contigNames[row_index]
+                members.append((cid, contigs.get(cid, None)))
+            jobs.append((file_name, members))
+
+        if threads > 1 and len(jobs) > 1:
+            from multiprocessing import Pool
+            pool = Pool(threads)
             try:
-                with open(file_name, 'w') as f:
-                    for row_index in self.BM.getBin(bid).rowIndices:
-                        cid = self.PM.contigNames[row_index]
-                        if(cid in contigs):
-                            f.write(">%s\n%s\n" % (cid, contigs[cid]))
-                        else:
-                            print "These are not the contigs you're looking for. ( %s )" % (cid)
-            except:
-                print "Could not open file for writing:",file_name,sys.exc_info()[0]
-                raise
+                pool.map(writeBinContigs, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                writeBinContigs(job)
 
     def extractReads(self,
                      timer,
@@ -708,6 +762,7 @@ class BinExplorer:
         self.PM2.loadData(timer,
                           "length >= "+str(coreCut),
                           bids=self.bids,
+                          minLength=coreCut,
                           loadContigNames=False,
                           loadContigLengths=True,
                           )
@@ -45,20 +45,41 @@ __license__ = "GPL3"
 __maintainer__ = "Michael Imelfort"
 __email__ = "mike@mikeimelfort.com"
 
-__current_GMDB_version__ = 5
+__current_GMDB_version__ = 7
+
+# bump this whenever the layout of the profile cache changes
+__current_cache_version__ = 1
+__cache_fields__ = ['names',
+                    'lengths',
+                    'gc',
+                    'coverage',
+                    'averageCoverage',
+                    'normCoverage',
+                    'transCoverage',
+                    'kpca']
 
 ###############################################################################
 
 from sys import exc_info
-from os.path import splitext as op_splitext, basename as op_basename
+from os import (makedirs as os_makedirs,
+                remove as os_remove,
+                rename as os_rename,
+                stat as os_stat)
+from os.path import (splitext as op_splitext,
+                     basename as op_basename,
+                     exists as op_exists,
+                     join as op_join)
+from shutil import rmtree as shutil_rmtree
 from string import maketrans as s_maketrans
+from uuid import uuid4
 
 import tables
 import numpy as np
+from numpy.lib.format import open_memmap
 from scipy.spatial.distance import cdist, squareform
 
 # GroopM imports
-from PCA import PCA, Center
+from PCA import PCA, Center, IncrementalPCA
 
 # BamM imports
 try:
@@ -179,6 +200,8 @@ class GMDataManager:
     'bid'    : tables.Int32Col(pos=1)
     'length' : tables.Int32Col(pos=2)
     'gc'     : tables.FloatCol(pos=3)
+    (the length column is indexed)
+    (attrs.binGeneration, also on bins and meta, see saveBins)
 
     ** Bins **
     table = 'bins'
@@ -192,6 +215,33 @@ class GMDataManager:
     'y' : tables.FloatCol(pos=1)
     'z' : tables.FloatCol(pos=2)
 
+    ** Bin ellipsoids (optional) **
+    table = 'ellipsoids'
+    'bid'       : tables.Int32Col(pos=0)
+    'mode'      : tables.StringCol(8, pos=1)      # cov, mer or mer2d
+    'memberKey' : tables.StringCol(32, pos=2)     # hash of the bin members the ellipsoid bounds
+    'dim'       : tables.Int32Col(pos=3)          # 2 or 3, unused entries are zero
+    'A'         : tables.FloatCol(shape=9, pos=4)
+    'center'    : tables.FloatCol(shape=3, pos=5)
+    'radii'     : tables.FloatCol(shape=3, pos=6)
+    'rotation'  : tables.FloatCol(shape=9, pos=7)
+
+    ------------------------
+     SOM CLASSIFIER (optional)
+    group = '/classifier'
+    ------------------------
+    ** Classifier info **
+    table = 'meta'
+    'binHash' : tables.StringCol(64, pos=0)     # hash of the bin assignments used for training
+    'side'    : tables.Int32Col(pos=1)
+
+    ** Arrays **
+    'weights'         # side x side x SOMDIM
+    'binAssignments'  # side x side
+    'boundaryMask'    # side x side
+    'minz'            # normalisation minimums
+    'maxz'            # normalisation ranges
+
     """
     def __init__(self): pass
 
@@ -229,7 +279,10 @@ class GMDataManager:
             with tables.openFile(dbFileName, mode = "w", title = "GroopM") as h5file:
                 # Create groups under "/" (root) for storing profile information and metadata
                 profile_group = h5file.createGroup("/", 'profile', 'Assembly profiles')
+                self.stampProfiles(profile_group)
                 meta_group = h5file.createGroup("/", 'meta', 'Associated metadata')
+                # set once everything else has been written, see isParsed
+                meta_group._v_attrs.parsed = False
                 links_group = h5file.createGroup("/", 'links', 'Paired read link information')
                 #------------------------
                 # parse contigs
@@ -494,6 +547,9 @@ class GMDataManager:
                     print "Error creating tmp_kpca_variance table:", exc_info()[0]
                     raise
 
+                # this must be the last thing we write
+                meta_group._v_attrs.parsed = True
+
         except:
             print "Error creating database:", dbFileName, exc_info()[0]
             raise
@@ -548,6 +604,8 @@ class GMDataManager:
         upgrade_tasks[(2,3)] = self.upgradeDB_2_to_3
         upgrade_tasks[(3,4)] = self.upgradeDB_3_to_4
         upgrade_tasks[(4,5)] = self.upgradeDB_4_to_5
+        upgrade_tasks[(5,6)] = self.upgradeDB_5_to_6
+        upgrade_tasks[(6,7)] = self.upgradeDB_6_to_7
 
         # we need to apply upgrades in order!
         # keep applying the upgrades as long as we need to
@@ -914,49 +972,139 @@ class GMDataManager:
         self.setGMDBFormat(dbFileName, 5)
         print "*******************************************************************************"
 
+    def upgradeDB_5_to_6(self, dbFileName):
+        """Upgrade a GM db from version 5 to version 6"""
+        print "*******************************************************************************\n"
+        print "              *** Upgrading GM DB from version 5 to version 6 ***"
+        print ""
+        # the change in this version is that the contig length column is indexed
+        print "    Indexing contig lengths"
+        print "    You will not need to re-run parse or core due to this change"
+        try:
+            with tables.openFile(dbFileName, mode='a') as h5file:
+                self.indexContigLengths(h5file.root.meta.contigs)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+        # update the formatVersion field and we're done
+        self.setGMDBFormat(dbFileName, 6)
+        print "*******************************************************************************"
+
+    def upgradeDB_6_to_7(self, dbFileName):
+        """Upgrade a GM db from version 6 to version 7"""
+        print "*******************************************************************************\n"
+        print "              *** Upgrading GM DB from version 6 to version 7 ***"
+        print ""
+        # the change in this version is that the profiles carry an id
+        # which the profile cache is checked against
+        print "    Stamping profiles"
+        print "    You will not need to re-run parse or core due to this change"
+        try:
+            with tables.openFile(dbFileName, mode='a') as h5file:
+                self.stampProfiles(h5file.root.profile)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+        # update the formatVersion field and we're done
+        self.setGMDBFormat(dbFileName, 7)
+        print "*******************************************************************************"
+
+    def stampProfiles(self, profileGroup):
+        """Give the profiles a new id
+
+        Call this whenever the profile tables are (re)written so any
+        profile cache made from the old ones is thrown away
+        """
+        profileGroup._v_attrs.profileId = uuid4().hex
+
+    def getProfileId(self, dbFileName):
+        """The id the profiles were last stamped with ('' if never)"""
+        try:
+            with tables.openFile(dbFileName, mode='r') as h5file:
+                try:
+                    return str(h5file.root.profile._v_attrs.profileId)
+                except AttributeError:
+                    return ''
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def indexContigLengths(self, contigs):
+        """Index the length column of the contigs table
+
+        Lengths never change once parsed so the index costs nothing to keep
+        and turns the length cutoff every load starts with into a lookup
+        """
+        if contigs.cols.length.index is None:
+            contigs.cols.length.createIndex()
+
 
 #------------------------------------------------------------------------------
 # GET LINKS
 
     def restoreLinks(self, dbFileName, indices=[], silent=False):
-        """Restore the links hash for a given set of indices"""
-        full_record = []
+        """Restore the links for a given set of indices
+
+        Returns a structured array (contig1, contig2, numReads, linkType, gap)
+        of the links with both ends in indices
+        """
         try:
             with tables.openFile(dbFileName, mode='r') as h5file:
-                full_record = [list(x) for x in h5file.root.links.links.readWhere("contig1 >= 0")]
+                links = h5file.root.links.links.read()
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
 
-        if indices == []:
+        if len(indices) == 0:
             # get all!
             indices = self.getConditionalIndices(dbFileName, silent=silent)
 
-        links_hash = {}
-        if full_record != []:
-            for record in full_record:
-                # make sure we have storage
-                if record[0] in indices and record[1] in indices:
-                    try:
-                        links_hash[record[0]].append(record[1:])
-                    except KeyError:
-                        links_hash[record[0]] = [record[1:]]
-        return links_hash
+        keep = np.in1d(links['contig1'], indices) & np.in1d(links['contig2'], indices)
+        return links[keep]
 
 #------------------------------------------------------------------------------
 # GET / SET DATA TABLES - PROFILES
 
-    def getConditionalIndices(self, dbFileName, condition='', silent=False, checkUpgrade=True):
-        """return the indices into the db which meet the condition"""
+    def getConditionalIndices(self, dbFileName, condition='', silent=False, checkUpgrade=True, minLength=None, bids=None, binned=None):
+        """return the indices into the db which meet the condition
+
+        If any of minLength, bids or binned are set then condition is ignored
+        and the indices are those of contigs at least minLength long, in one of
+        bids and binned (bid != 0) or unbinned (bid == 0). The length cutoff
+        uses the index on the length column and the bin filters are done on
+        the whole bid column at once
+        """
         # check the DB out and see if we need to change anything about it
         if checkUpgrade:
             self.checkAndUpgradeDB(dbFileName, silent=silent)
 
-        if('' == condition):
-            condition = "cid != ''" # no condition breaks everything!
         try:
             with tables.openFile(dbFileName, mode='r') as h5file:
-                return np.array([x.nrow for x in h5file.root.meta.contigs.where(condition)])
+                contigs = h5file.root.meta.contigs
+                if minLength is None and bids is None and binned is None:
+                    if('' == condition):
+                        condition = "cid != ''" # no condition breaks everything!
+                    return contigs.getWhereList(condition, sort=True).astype(np.int64)
+
+                if minLength is None:
+                    indices = np.arange(contigs.nrows, dtype=np.int64)
+                else:
+                    indices = contigs.getWhereList("length >= %d" % minLength, sort=True).astype(np.int64)
+
+                if bids is not None or binned is not None:
+                    bin_ids = contigs.col('bid')[indices]
+                    keep = np.ones(len(indices), dtype=bool)
+                    if bids is not None:
+                        keep &= np.in1d(bin_ids, np.array(bids, dtype=bin_ids.dtype))
+                    if binned is not None:
+                        if binned:
+                            keep &= (bin_ids != 0)
+                        else:
+                            keep &= (bin_ids == 0)
+                    indices = indices[keep]
+                return indices
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -970,7 +1118,7 @@ class GMDataManager:
                 else:
                     if('' == condition):
                         condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(h5file.root.profile.coverage[x.nrow]) for x in h5file.root.meta.contigs.where(condition)])
+                    return np.array([list(h5file.root.profile.coverage[x]) for x in h5file.root.meta.contigs.getWhereList(condition, sort=True)])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -984,7 +1132,7 @@ class GMDataManager:
                 else:
                     if('' == condition):
                         condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(h5file.root.profile.transCoverage[x.nrow]) for x in h5file.root.meta.contigs.where(condition)])
+                    return np.array([list(h5file.root.profile.transCoverage[x]) for x in h5file.root.meta.contigs.getWhereList(condition, sort=True)])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -998,7 +1146,7 @@ class GMDataManager:
                 else:
                     if('' == condition):
                         condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(h5file.root.profile.normCoverage[x.nrow]) for x in h5file.root.meta.contigs.where(condition)])
+                    return np.array([list(h5file.root.profile.normCoverage[x]) for x in h5file.root.meta.contigs.getWhereList(condition, sort=True)])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -1006,9 +1154,97 @@ class GMDataManager:
     def nukeBins(self, dbFileName):
         """Reset all bin information, completely"""
         print "    Clearing all old bin information from",dbFileName
-        self.setBinStats(dbFileName, [])
-        self.setNumBins(dbFileName, 0)
-        self.setBinAssignments(dbFileName, updates={}, nuke=True)
+        self.saveBins(dbFileName, {}, [], nuke=True)
+
+    def saveBins(self, dbFileName, updates, binStats, nuke=False, ellipsoids=None):
+        """Save per-contig bins, the bins table and numBins in one go
+
+        updates is a dictionary which looks like:
+        { tableRow : binValue }
+        binStats is a list of tuples which looks like:
+        [ (bid, numMembers, isLikelyChimeric) ]
+        ellipsoids, if given, are as for setBinEllipsoids and are written
+        in the same session with the same generation
+
+        meta/contigs, meta/bins and meta/meta each carry a bin generation
+        attribute. All three are bumped together here so if a save is cut
+        short they won't match the next time the bins are loaded
+        """
+        try:
+            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+                mg = h5file.getNode('/', name='meta')
+                generation = max(self.getBinGeneration(mg.contigs),
+                                 self.getBinGeneration(mg.bins),
+                                 self.getBinGeneration(mg.meta)) + 1
+
+                # contigs first, they are what we rebuild from
+                self.updateBinColumn(mg.contigs, updates, nuke=nuke)
+                mg.contigs.attrs.binGeneration = generation
+                mg.contigs.flush()
+
+                self.writeBinStats(h5file, binStats, generation=generation)
+                if ellipsoids is not None:
+                    self.writeBinEllipsoids(h5file, ellipsoids, generation=generation)
+
+                meta_data = list(mg.meta.read()[0])
+                meta_data[6] = len(binStats)
+                self.setMeta(h5file, tuple(meta_data), overwrite=True, binGeneration=generation)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def getBinGeneration(self, node):
+        """The bin generation a node was last saved with (0 if never)"""
+        try:
+            return int(node.attrs.binGeneration)
+        except AttributeError:
+            return 0
+
+    def checkBins(self, dbFileName, repair=False):
+        """Were the bins saved completely last time?
+
+        If not, and repair is set, rebuild the bins table. Only do this from
+        commands which are going to write to the DB anyway
+        """
+        try:
+            with tables.openFile(dbFileName, mode='r') as h5file:
+                mg = h5file.root.meta
+                generations = set([self.getBinGeneration(mg.contigs),
+                                   self.getBinGeneration(mg.bins),
+                                   self.getBinGeneration(mg.meta)])
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+        if len(generations) == 1:
+            return True
+        if repair:
+            self.repairBins(dbFileName)
+        return False
+
+    def rebuildBinStats(self, dbFileName):
+        """Work out the rows of the bins table from the per-contig bins
+
+        The bin ids in meta/contigs are written first so they are the most
+        up to date. Nothing is written to the DB
+        """
+        bins = self.getBins(dbFileName)
+        old_stats = self.getBinStats(dbFileName, check=False)
+        bin_stats = []
+        if len(bins) > 0:
+            counts = np.bincount(bins)
+            for bid in np.flatnonzero(counts):
+                if bid != 0:
+                    # keep what we knew about chimeras if we can
+                    bin_stats.append((bid, counts[bid], bid in old_stats and old_stats[bid][1]))
+        return bin_stats
+
+    def repairBins(self, dbFileName):
+        """Rebuild the bins table and numBins from the per-contig bins
+
+        Used when a save of the bins was cut short
+        """
+        print "    Bins in",dbFileName,"were not saved completely, rebuilding bin stats"
+        self.saveBins(dbFileName, {}, self.rebuildBinStats(dbFileName))
 
     def initBinStats(self, storage):
         '''Initialise the bins table
@@ -1038,44 +1274,64 @@ class GMDataManager:
 
         updates is a list of tuples which looks like:
         [ (bid, numMembers, isLikelyChimeric) ]
+        Use saveBins to keep the bins table in step with everything else
         """
+        try:
+            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+                self.writeBinStats(h5file, updates)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def writeBinStats(self, h5file, updates, generation=None):
+        """Overwrite the bins table of an open DB
 
+        The new table gets the bin generation given, or that of the table
+        it replaces
+        """
         db_desc = [('bid', int),
                    ('numMembers', int),
                    ('isLikelyChimeric', bool)]
         bd = np.array(updates, dtype=db_desc)
 
-        try:
-            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
-                mg = h5file.getNode('/', name='meta')
-                # nuke any previous failed attempts
-                try:
-                    h5file.removeNode(mg, 'tmp_bins')
-                except:
-                    pass
+        mg = h5file.getNode('/', name='meta')
+        if generation is None:
+            generation = self.getBinGeneration(mg.bins)
 
-                try:
-                    h5file.createTable(mg,
-                                       'tmp_bins',
-                                       bd,
-                                       title="Bin information",
-                                       expectedrows=1)
-                except:
-                    print "Error creating META table:", exc_info()[0]
-                    raise
+        # nuke any previous failed attempts
+        try:
+            h5file.removeNode(mg, 'tmp_bins')
+        except:
+            pass
 
-                # rename the tmp table to overwrite
-                h5file.renameNode(mg, 'bins', 'tmp_bins', overwrite=True)
+        try:
+            tmp_bins = h5file.createTable(mg,
+                                          'tmp_bins',
+                                          bd,
+                                          title="Bin information",
+                                          expectedrows=1)
         except:
-            print "Error opening DB:",dbFileName, exc_info()[0]
+            print "Error creating META table:", exc_info()[0]
             raise
+        tmp_bins.attrs.binGeneration = generation
 
-    def getBinStats(self, dbFileName):
+        # rename the tmp table to overwrite
+        h5file.renameNode(mg, 'bins', 'tmp_bins', overwrite=True)
+
+    def getBinStats(self, dbFileName, check=True):
         """Load data from bins table
 
         Returns a dict of type:
         { bid : [numMembers, isLikelyChimeric] }
+
+        If check is set and the last save of the bins didn't finish then the
+        stats are worked out from the per-contig bins instead. The DB is
+        not touched, see checkBins for fixing it
         """
+        if check and not self.checkBins(dbFileName):
+            print "    WARNING: bins in",dbFileName,"were not saved completely, using the per-contig bins"
+            return dict([(row[0], [row[1], row[2]]) for row in self.rebuildBinStats(dbFileName)])
+
         try:
             with tables.openFile(dbFileName, mode='r') as h5file:
                 ret_dict = {}
@@ -1089,6 +1345,114 @@ class GMDataManager:
             raise
         return {}
 
+    def setBinEllipsoids(self, dbFileName, ellipsoids):
+        """Set the bin ellipsoids table
+
+        ellipsoids is a list of tuples which looks like:
+        [ (bid, mode, memberKey, A, center, radii, rotation) ]
+        A is None for degenerate ellipsoids
+        Note that this call nukes the existing table. Use saveBins to
+        save them along with the bins
+        """
+        try:
+            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+                self.writeBinEllipsoids(h5file, ellipsoids)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def writeBinEllipsoids(self, h5file, ellipsoids, generation=None):
+        """Overwrite the bin ellipsoids table of an open DB
+
+        The table is stamped with the bin generation given, or that of the
+        current bins, so ellipsoids left over from a save which was cut
+        short can be spotted and ignored
+        """
+        db_desc = [('bid', int),
+                   ('mode', '|S8'),
+                   ('memberKey', '|S32'),
+                   ('dim', int),
+                   ('degenerate', bool),
+                   ('A', float, (9,)),
+                   ('center', float, (3,)),
+                   ('radii', float, (3,)),
+                   ('rotation', float, (9,))]
+        rows = []
+        for (bid, mode, member_key, A, center, radii, rotation) in ellipsoids:
+            dim = len(center)
+            # pad everything out to 3D
+            pA = np.zeros((3,3))
+            if A is not None:
+                pA[:dim,:dim] = A
+            p_rot = np.zeros((3,3))
+            p_rot[:dim,:dim] = rotation
+            p_center = np.zeros(3)
+            p_center[:dim] = center
+            p_radii = np.zeros(3)
+            p_radii[:dim] = radii
+            rows.append((bid, mode, member_key, dim, A is None, pA.ravel(), p_center, p_radii, p_rot.ravel()))
+        ed = np.array(rows, dtype=db_desc)
+
+        mg = h5file.getNode('/', name='meta')
+        if generation is None:
+            generation = self.getBinGeneration(mg.contigs)
+
+        # nuke any previous failed attempts
+        try:
+            h5file.removeNode(mg, 'tmp_ellipsoids')
+        except:
+            pass
+
+        try:
+            tmp_ellipsoids = h5file.createTable(mg,
+                                                'tmp_ellipsoids',
+                                                ed,
+                                                title="Bin ellipsoids",
+                                                expectedrows=len(rows)+1)
+        except:
+            print "Error creating META table:", exc_info()[0]
+            raise
+        tmp_ellipsoids.attrs.binGeneration = generation
+
+        # rename the tmp table to overwrite
+        h5file.renameNode(mg, 'ellipsoids', 'tmp_ellipsoids', overwrite=True)
+
+    def getBinEllipsoids(self, dbFileName):
+        """Load data from the bin ellipsoids table
+
+        Returns a dict of type:
+        { (bid, mode) : (memberKey, (A, center, radii, rotation)) }
+        which is empty if no ellipsoids have been saved. A is None for
+        degenerate ellipsoids. Ellipsoids which weren't saved with the
+        current bins are ignored
+        """
+        try:
+            with tables.openFile(dbFileName, mode='r') as h5file:
+                ret_dict = {}
+                try:
+                    ellipsoids = h5file.root.meta.ellipsoids
+                except tables.NoSuchNodeError:
+                    return ret_dict
+                if 'binGeneration' in ellipsoids.attrs._v_attrnames and \
+                   self.getBinGeneration(ellipsoids) != self.getBinGeneration(h5file.root.meta.contigs):
+                    return ret_dict
+                all_rows = ellipsoids.read()
+                for row in all_rows:
+                    dim = row['dim']
+                    A = np.reshape(row['A'], (3,3))[:dim,:dim]
+                    # older tables have no degenerate column, they stored NaNs
+                    if ('degenerate' in all_rows.dtype.names and row['degenerate']) or np.any(np.isnan(A)):
+                        A = None
+                    ret_dict[(row['bid'], row['mode'])] = (row['memberKey'],
+                                                           (A,
+                                                            row['center'][:dim],
+                                                            row['radii'][:dim],
+                                                            np.reshape(row['rotation'], (3,3))[:dim,:dim]))
+                return ret_dict
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
     def getBins(self, dbFileName, condition='', indices=np.array([])):
         """Load per-contig bins"""
         try:
@@ -1098,7 +1462,8 @@ class GMDataManager:
                 else:
                     if('' == condition):
                         condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(x)[1] for x in h5file.root.meta.contigs.readWhere(condition)]).ravel()
+                    contigs = h5file.root.meta.contigs
+                    return contigs.col('bid')[contigs.getWhereList(condition, sort=True)]
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -1109,53 +1474,33 @@ class GMDataManager:
         updates is a dictionary which looks like:
         { tableRow : binValue }
         if updates is set then storage is the
-        path to the hdf file
+        path to the hdf file. Only the bid column is
+        touched and it is changed in place
 
         image is a list of tuples which look like:
         [(cid, bid, len, gc)]
         if image is set then storage is a tuple of type:
         (h5file, group)
         """
-        db_desc = [('cid', '|S512'),
-                   ('bid', int),
-                   ('length', int),
-                   ('gc', float)]
-        closeh5 = False
         if updates is not None:
-            # we need to build the image
             dbFileName = storage
-            contig_names = self.getContigNames(dbFileName)
-            contig_lengths = self.getContigLengths(dbFileName)
-            contig_gcs = self.getContigGCs(dbFileName)
-            num_cons = len(contig_lengths)
-            if nuke:
-                # clear all bin assignments
-                bins = [0]*num_cons
-            else:
-                bins = self.getBins(dbFileName)
-
-            # now apply the updates
-            for tr in updates.keys():
-                bins[tr] = updates[tr]
-
-            # and build the image
-            image = np.array(zip(contig_names, bins, contig_lengths, contig_gcs),
-                             dtype=db_desc)
-
             try:
-                h5file = tables.openFile(dbFileName, mode='a')
+                with tables.openFile(dbFileName, mode='a') as h5file:
+                    self.updateBinColumn(h5file.root.meta.contigs, updates, nuke=nuke)
             except:
                 print "Error opening DB:",dbFileName, exc_info()[0]
                 raise
-            meta_group = h5file.getNode('/', name='meta')
-            closeh5 = True
+            return
 
         elif image is not None:
             h5file = storage[0]
             meta_group = storage[1]
             num_cons = len(image)
             image = np.array(image,
-                             dtype=db_desc)
+                             dtype=[('cid', '|S512'),
+                                    ('bid', int),
+                                    ('length', int),
+                                    ('gc', float)])
         else:
             print "get with the program dude"
             return
@@ -1168,19 +1513,48 @@ class GMDataManager:
             pass
 
         try:
-            h5file.createTable(meta_group,
-                               'tmp_contigs',
-                               image,
-                               title="Contig information",
-                               expectedrows=num_cons)
+            tmp_contigs = h5file.createTable(meta_group,
+                                             'tmp_contigs',
+                                             image,
+                                             title="Contig information",
+                                             expectedrows=num_cons)
         except:
             print "Error creating CONTIG table:", exc_info()[0]
             raise
+        try:
+            tmp_contigs.attrs.binGeneration = self.getBinGeneration(h5file.getNode(meta_group, 'contigs'))
+        except tables.NoSuchNodeError:
+            # brand new DB
+            pass
 
         # rename the tmp table to overwrite
         h5file.renameNode(meta_group, 'contigs', 'tmp_contigs', overwrite=True)
-        if closeh5:
-            h5file.close()
+        self.indexContigLengths(h5file.getNode(meta_group, 'contigs'))
+
+    def updateBinColumn(self, contigs, updates, nuke=False):
+        """Write bin ids straight into the bid column of an open contigs table
+
+        updates is a dictionary which looks like:
+        { tableRow : binValue }
+        Only the span of rows between the first and last update is
+        read and written (the whole column if we nuke)
+        """
+        if nuke:
+            start = 0
+            stop = contigs.nrows
+            bins = np.zeros(stop, dtype=int)
+        elif len(updates) == 0:
+            return
+
+        if len(updates) > 0:
+            rows = np.fromiter(updates.keys(), dtype=int, count=len(updates))
+            bids = np.fromiter(updates.values(), dtype=int, count=len(updates))
+            if not nuke:
+                start = np.min(rows)
+                stop = np.max(rows) + 1
+                bins = contigs.read(start=start, stop=stop, field='bid')
+            bins[rows - start] = bids
+        contigs.modifyColumn(start=start, stop=stop, column=bins, colname='bid')
 
     def getContigNames(self, dbFileName, condition='', indices=np.array([])):
         """Load contig names"""
@@ -1191,7 +1565,8 @@ class GMDataManager:
                 else:
                     if('' == condition):
                         condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(x)[0] for x in h5file.root.meta.contigs.readWhere(condition)]).ravel()
+                    contigs = h5file.root.meta.contigs
+                    return contigs.col('cid')[contigs.getWhereList(condition, sort=True)]
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -1205,7 +1580,8 @@ class GMDataManager:
                 else:
                     if('' == condition):
                         condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(x)[2] for x in h5file.root.meta.contigs.readWhere(condition)]).ravel()
+                    contigs = h5file.root.meta.contigs
+                    return contigs.col('length')[contigs.getWhereList(condition, sort=True)]
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -1219,7 +1595,8 @@ class GMDataManager:
                 else:
                     if('' == condition):
                         condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(x)[3] for x in h5file.root.meta.contigs.readWhere(condition)]).ravel()
+                    contigs = h5file.root.meta.contigs
+                    return contigs.col('gc')[contigs.getWhereList(condition, sort=True)]
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -1233,7 +1610,7 @@ class GMDataManager:
                 else:
                     if('' == condition):
                         condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(h5file.root.profile.kms[x.nrow]) for x in h5file.root.meta.contigs.where(condition)])
+                    return np.array([list(h5file.root.profile.kms[x]) for x in h5file.root.meta.contigs.getWhereList(condition, sort=True)])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -1247,7 +1624,7 @@ class GMDataManager:
                 else:
                     if('' == condition):
                         condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(h5file.root.profile.kpca[x.nrow]) for x in h5file.root.meta.contigs.where(condition)])
+                    return np.array([list(h5file.root.profile.kpca[x]) for x in h5file.root.meta.contigs.getWhereList(condition, sort=True)])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -1273,10 +1650,11 @@ class GMDataManager:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
 
-    def setMeta(self, h5file, metaData, overwrite=False):
+    def setMeta(self, h5file, metaData, overwrite=False, binGeneration=None):
         """Write metadata into the table
 
-        metaData should be a tuple of values
+        metaData should be a tuple of values. When overwriting, the bin
+        generation is carried over from the old table unless one is given
         """
         db_desc = [('stoitColNames', '|S512'),
                    ('numStoits', int),
@@ -1300,18 +1678,22 @@ class GMDataManager:
                 h5file.removeNode(mg, 'tmp_meta')
             except:
                 pass
+            if binGeneration is None:
+                binGeneration = self.getBinGeneration(h5file.getNode(mg, 'meta'))
         else:
             t_name = 'meta'
 
         try:
-            h5file.createTable(mg,
-                               t_name,
-                               md,
-                               "Descriptive data",
-                               expectedrows=1)
+            meta_table = h5file.createTable(mg,
+                                            t_name,
+                                            md,
+                                            "Descriptive data",
+                                            expectedrows=1)
         except:
             print "Error creating META table:", exc_info()[0]
             raise
+        if binGeneration is not None:
+            meta_table.attrs.binGeneration = binGeneration
 
         if overwrite:
             # rename the tmp table to overwrite
@@ -1469,79 +1851,459 @@ class GMDataManager:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
 
+    def isParsed(self, dbFileName):
+        """Did createDB finish writing this DB?
+
+        DBs made before the parsed flag existed count as parsed if all
+        the tables createDB makes are there
+        """
+        try:
+            with tables.openFile(dbFileName, mode='r') as h5file:
+                try:
+                    return bool(h5file.root.meta._v_attrs.parsed)
+                except AttributeError:
+                    pass
+                for (group, name) in [('/profile', 'kms'),
+                                      ('/profile', 'kpca'),
+                                      ('/profile', 'coverage'),
+                                      ('/profile', 'transCoverage'),
+                                      ('/profile', 'normCoverage'),
+                                      ('/meta', 'contigs'),
+                                      ('/meta', 'bins'),
+                                      ('/meta', 'meta'),
+                                      ('/meta', 'transCoverageCorners'),
+                                      ('/meta', 'kpca_variance'),
+                                      ('/links', 'links')]:
+                    try:
+                        h5file.getNode(group, name)
+                    except tables.NoSuchNodeError:
+                        return False
+                return True
+        except:
+            print "Error opening database:", dbFileName, exc_info()[0]
+            raise
+
+    def isRecruited(self, dbFileName):
+        """Have unbinned contigs been recruited into the bins?"""
+        try:
+            with tables.openFile(dbFileName, mode='r') as h5file:
+                try:
+                    return bool(h5file.root.meta._v_attrs.recruited)
+                except AttributeError:
+                    return False
+        except:
+            print "Error opening database:", dbFileName, exc_info()[0]
+            raise
+
+    def setRecruited(self, dbFileName, state):
+        """Set the state of recruitment
+
+        Kept as an attribute of the meta group so we don't have to change
+        the meta table
+        """
+        try:
+            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+                h5file.root.meta._v_attrs.recruited = state
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+#------------------------------------------------------------------------------
+# GET / SET SOM CLASSIFIER
+
+    def setSOMClassifier(self, dbFileName, binHash, weights, binAssignments, boundaryMask, minz, maxz, pc1Bounds):
+        """Store a trained SOM classifier
+
+        binHash identifies the bin assignments the SOM was trained on
+        pc1Bounds is the raw kmer PC1 range kmerNormPC1 was normalised over
+        Note that this call nukes any previously stored classifier
+        """
+        db_desc = [('binHash', '|S64'),
+                   ('side', int)]
+        cm = np.array([(binHash, np.shape(weights)[0])], dtype=db_desc)
+
+        try:
+            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+                # nuke any previous failed attempts
+                try:
+                    h5file.removeNode('/', 'tmp_classifier', recursive=True)
+                except:
+                    pass
+
+                try:
+                    cg = h5file.createGroup('/', 'tmp_classifier', 'SOM classifier')
+                    h5file.createTable(cg,
+                                       'meta',
+                                       cm,
+                                       title="Classifier information",
+                                       expectedrows=1)
+                    h5file.createArray(cg, 'weights', np.array(weights), "SOM weights")
+                    h5file.createArray(cg, 'binAssignments', np.array(binAssignments), "SOM bin assignments")
+                    h5file.createArray(cg, 'boundaryMask', np.array(boundaryMask), "SOM boundary mask")
+                    h5file.createArray(cg, 'minz', np.array(minz), "Normalisation minimums")
+                    h5file.createArray(cg, 'maxz', np.array(maxz), "Normalisation ranges")
+                    h5file.createArray(cg, 'pc1Bounds', np.array(pc1Bounds), "Kmer PC1 normalisation bounds")
+                except:
+                    print "Error creating classifier group:", exc_info()[0]
+                    raise
+
+                # rename the tmp group to overwrite
+                h5file.renameNode('/', 'classifier', 'tmp_classifier', overwrite=True)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def getSOMClassifier(self, dbFileName):
+        """Load a stored SOM classifier
+
+        Returns None if there is no stored classifier, otherwise a tuple of:
+        (binHash, weights, binAssignments, boundaryMask, minz, maxz, pc1Bounds)
+        pc1Bounds is None for classifiers stored before we kept it
+        """
+        try:
+            with tables.openFile(dbFileName, mode='r') as h5file:
+                try:
+                    cg = h5file.getNode('/', name='classifier')
+                except tables.NoSuchNodeError:
+                    return None
+                try:
+                    pc1_bounds = cg.pc1Bounds.read()
+                except tables.NoSuchNodeError:
+                    pc1_bounds = None
+                return (cg.meta.read()['binHash'][0],
+                        cg.weights.read(),
+                        cg.binAssignments.read(),
+                        cg.boundaryMask.read(),
+                        cg.minz.read(),
+                        cg.maxz.read(),
+                        pc1_bounds)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+#------------------------------------------------------------------------------
+# GET / SET CORE CHECKPOINT
+
+    def setCoreCheckpoint(self, dbFileName, checkpoint):
+        """Store the state of a core run so it can be resumed
+
+        checkpoint is a dict which looks like:
+        { 'stage' : 'cores' or 'refine',    # where to pick up from
+          'coreCut' : int,
+          'roundNumber' : int,
+          'subRoundNumber' : int,
+          'numBelowCutoff' : int,
+          'imageCounter' : int,
+          'nextFreeBinId' : int,
+          'members' : global indices of binned contigs,
+          'memberBids' : the bins they are in,
+          'chimeric' : bids of likely chimeric bins,
+          'restricted' : global indices of restricted contigs,
+          'imageMaps' : the image maps }
+        Note that this call nukes any previous checkpoint
+        """
+        db_desc = [('stage', '|S16'),
+                   ('coreCut', int),
+                   ('roundNumber', int),
+                   ('subRoundNumber', int),
+                   ('numBelowCutoff', int),
+                   ('imageCounter', int),
+                   ('nextFreeBinId', int)]
+        cm = np.array([tuple([checkpoint[field[0]] for field in db_desc])], dtype=db_desc)
+
+        try:
+            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+                # nuke any previous failed attempts
+                try:
+                    h5file.removeNode('/', 'tmp_checkpoint', recursive=True)
+                except:
+                    pass
+
+                try:
+                    cg = h5file.createGroup('/', 'tmp_checkpoint', 'Core checkpoint')
+                    h5file.createTable(cg,
+                                       'meta',
+                                       cm,
+                                       title="Checkpoint information",
+                                       expectedrows=1)
+                    # pytables won't store empty arrays so pad with a -1
+                    for name in ['members', 'memberBids', 'chimeric', 'restricted']:
+                        h5file.createArray(cg, name, np.append(-1, np.array(checkpoint[name], dtype=int)), name)
+                    h5file.createArray(cg, 'imageMaps', np.array(checkpoint['imageMaps']), "Image maps")
+                except:
+                    print "Error creating checkpoint group:", exc_info()[0]
+                    raise
+
+                # rename the tmp group to overwrite
+                h5file.renameNode('/', 'checkpoint', 'tmp_checkpoint', overwrite=True)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def getCoreCheckpoint(self, dbFileName):
+        """Load the state of a core run
+
+        Returns None if there is no checkpoint, otherwise a dict as described
+        in setCoreCheckpoint
+        """
+        try:
+            with tables.openFile(dbFileName, mode='r') as h5file:
+                try:
+                    cg = h5file.getNode('/', name='checkpoint')
+                except tables.NoSuchNodeError:
+                    return None
+                meta = cg.meta.read()
+                checkpoint = dict([(name, meta[name][0]) for name in meta.dtype.names])
+                for name in ['members', 'memberBids', 'chimeric', 'restricted']:
+                    checkpoint[name] = h5file.getNode(cg, name).read()[1:]
+                checkpoint['imageMaps'] = cg.imageMaps.read()
+                return checkpoint
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def removeCoreCheckpoint(self, dbFileName):
+        """Get rid of any core checkpoint"""
+        try:
+            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+                for name in ['checkpoint', 'tmp_checkpoint']:
+                    try:
+                        h5file.removeNode('/', name, recursive=True)
+                    except tables.NoSuchNodeError:
+                        pass
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+#------------------------------------------------------------------------------
+# PROFILE CACHE
+
+    def getCachePath(self, dbFileName):
+        """Where the profile cache for this DB lives"""
+        return dbFileName + ".cache"
+
+    def getCacheStamp(self, dbFileName):
+        """The stamp a cache built from the DB as it is right now would carry
+
+        Uses the id the profiles were stamped with so saving bins etc. doesn't
+        make the cache stale. DBs which haven't been upgraded yet have no id
+        so we fall back to the time and size of the file
+        """
+        profile_id = self.getProfileId(dbFileName)
+        if profile_id == '':
+            db_stat = os_stat(dbFileName)
+            profile_id = "%r %d" % (db_stat.st_mtime, db_stat.st_size)
+        return "%d %s %d" % (__current_cache_version__,
+                             profile_id,
+                             self.getGMDBFormat(dbFileName))
+
+    def hasProfileCache(self, dbFileName):
+        """Has a cache been made for this DB (stale or not)"""
+        return op_exists(op_join(self.getCachePath(dbFileName), 'stamp'))
+
+    def getProfileCache(self, dbFileName, rebuild=True, silent=False):
+        """Memory map the profile cache of a DB
+
+        Returns { field : read only array } or None if there is no cache.
+        If the cache is stale (the profiles have been rewritten since) it is
+        rebuilt when rebuild is set, otherwise None is returned
+        """
+        if not self.hasProfileCache(dbFileName):
+            return None
+        cache_path = self.getCachePath(dbFileName)
+        try:
+            with open(op_join(cache_path, 'stamp'), 'r') as fh:
+                stamp = fh.read().strip()
+        except IOError:
+            stamp = ''
+        if stamp != self.getCacheStamp(dbFileName):
+            if not rebuild:
+                return None
+            try:
+                self.makeProfileCache(dbFileName, silent=silent)
+            except (IOError, OSError):
+                # can't write next to the DB, just load it the slow way
+                if not silent:
+                    print "    Could not refresh profile cache:", cache_path, exc_info()[1]
+                return None
+        try:
+            return dict([(field, np.load(op_join(cache_path, field + '.npy'), mmap_mode='r'))
+                         for field in __cache_fields__])
+        except (IOError, ValueError):
+            return None
+
+    def makeProfileCache(self, dbFileName, silent=False):
+        """Write the per-contig profiles of a DB out as contiguous .npy files
+
+        Floats are stored as float32. The stamp is written last so a half made
+        cache is never used
+        """
+        if not silent:
+            print "    Making profile cache:", self.getCachePath(dbFileName)
+        cache_path = self.getCachePath(dbFileName)
+        if not op_exists(cache_path):
+            os_makedirs(cache_path)
+        stamp_file = op_join(cache_path, 'stamp')
+        if op_exists(stamp_file):
+            os_remove(stamp_file)
+
+        # the stamp must describe the DB we read from
+        stamp = self.getCacheStamp(dbFileName)
+        try:
+            with tables.openFile(dbFileName, mode='r') as h5file:
+                contigs = h5file.root.meta.contigs
+                names = contigs.col('cid')
+                coverage = self.tableToArray(h5file.root.profile.coverage.read())
+                num_stoits = np.shape(coverage)[1]
+                arrays = {'names' : names.astype('|S%d' % max(1, max([len(n) for n in names] + [0]))),
+                          'lengths' : contigs.col('length'),
+                          'gc' : contigs.col('gc').astype(np.float32),
+                          'coverage' : coverage,
+                          'averageCoverage' : (coverage.sum(axis=1) / num_stoits).astype(np.float32),
+                          'normCoverage' : self.tableToArray(h5file.root.profile.normCoverage.read()).ravel(),
+                          'transCoverage' : self.tableToArray(h5file.root.profile.transCoverage.read()),
+                          'kpca' : self.tableToArray(h5file.root.profile.kpca.read())}
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+        for field in __cache_fields__:
+            tmp_file = op_join(cache_path, field + '.tmp.npy')
+            np.save(tmp_file, np.ascontiguousarray(arrays[field]))
+            os_rename(tmp_file, op_join(cache_path, field + '.npy'))
+
+        tmp_file = stamp_file + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            fh.write(stamp + "\n")
+        os_rename(tmp_file, stamp_file)
+
+    def removeProfileCache(self, dbFileName):
+        """Get rid of the profile cache of a DB"""
+        cache_path = self.getCachePath(dbFileName)
+        if op_exists(cache_path):
+            shutil_rmtree(cache_path)
+
+    def tableToArray(self, data):
+        """Record array of float columns -> 2D float32 array"""
+        return np.column_stack([data[name] for name in data.dtype.names]).astype(np.float32)
+
 #------------------------------------------------------------------------------
 # FILE / IO
 
-    def dumpData(self, dbFileName, fields, outFile, separator, useHeaders):
-        """Dump data to file"""
-        header_strings = []
-        data_arrays = []
+    def dumpData(self, dbFileName, fields, outFile, separator, useHeaders, outFormat='csv', blockSize=50000):
+        """Dump data to file
 
+        Rows are read and written a block at a time so memory use doesn't
+        grow with the size of the DB.
+
+        outFormat is one of:
+        'csv' - delimited text written through a buffered file
+        'npy' - one .npy file per field named <outFile stem>_<field>.npy
+                (plus <outFile stem>_columns.csv holding the column names
+                if useHeaders is set)
+        """
         if fields == ['all']:
             fields = ['names', 'lengths', 'gc', 'bins', 'coverage', 'tcoverage', 'ncoverage', 'mers']
 
-        num_fields = len(fields)
-        data_converters = []
-
-        for field in fields:
-            if field == 'names':
-                header_strings.append('cid')
-                data_arrays.append(self.getContigNames(dbFileName))
-                data_converters.append(lambda x : x)
-
-            elif field == 'lengths':
-                header_strings.append('length')
-                data_arrays.append(self.getContigLengths(dbFileName))
-                data_converters.append(lambda x : str(x))
-
-            elif field == 'gc':
-                header_strings.append('GCs')
-                data_arrays.append(self.getContigGCs(dbFileName))
-                data_converters.append(lambda x : str(x))
-
-            elif field == 'bins':
-                header_strings.append('bid')
-                data_arrays.append(self.getBins(dbFileName))
-                data_converters.append(lambda x : str(x))
-
-            elif field == 'coverage':
-                stoits = self.getStoitColNames(dbFileName).split(',')
-                for stoit in stoits:
-                    header_strings.append(stoit)
-                data_arrays.append(self.getCoverageProfiles(dbFileName))
-                data_converters.append(lambda x : separator.join(["%0.4f" % i for i in x]))
-
-            elif field == 'tcoverage':
-                header_strings.append('transformedCoverageX')
-                header_strings.append('transformedCoverageY')
-                header_strings.append('transformedCoverageZ')
-                data_arrays.append(self.getTransformedCoverageProfiles(dbFileName))
-                data_converters.append(lambda x : separator.join(["%0.4f" % i for i in x]))
-
-            elif field == 'ncoverage':
-                header_strings.append('normalisedCoverage')
-                data_arrays.append(self.getNormalisedCoverageProfiles(dbFileName))
-                data_converters.append(lambda x : separator.join(["%0.4f" % i for i in x]))
-
-            elif field == 'mers':
-                mers = self.getMerColNames(dbFileName).split(',')
-                for mer in mers:
-                    header_strings.append(mer)
-                data_arrays.append(self.getKmerSigs(dbFileName))
-                data_converters.append(lambda x : separator.join(["%0.4f" % i for i in x]))
+        try:
+            with tables.openFile(dbFileName, mode='r') as h5file:
+                # (node, column of meta/contigs or None for a whole profile table)
+                sources = {'names'     : (h5file.root.meta.contigs, 'cid'),
+                           'lengths'   : (h5file.root.meta.contigs, 'length'),
+                           'gc'        : (h5file.root.meta.contigs, 'gc'),
+                           'bins'      : (h5file.root.meta.contigs, 'bid'),
+                           'coverage'  : (h5file.root.profile.coverage, None),
+                           'tcoverage' : (h5file.root.profile.transCoverage, None),
+                           'ncoverage' : (h5file.root.profile.normCoverage, None),
+                           'mers'      : (h5file.root.profile.kms, None)}
+                num_rows = h5file.root.meta.contigs.nrows
+
+                header_strings = []
+                for field in fields:
+                    header_strings.append(self.getDumpHeaders(h5file, field))
+
+                if outFormat == 'npy':
+                    self.dumpNpy(sources, fields, header_strings, num_rows, outFile, useHeaders, blockSize)
+                else:
+                    self.dumpText(sources, fields, header_strings, num_rows, outFile, separator, useHeaders, blockSize)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
 
+    def getDumpHeaders(self, h5file, field):
+        """Column names for a dumped field"""
+        if field == 'names':
+            return ['cid']
+        elif field == 'lengths':
+            return ['length']
+        elif field == 'gc':
+            return ['GCs']
+        elif field == 'bins':
+            return ['bid']
+        elif field == 'coverage':
+            return h5file.root.meta.meta.read()['stoitColNames'][0].split(',')
+        elif field == 'tcoverage':
+            return ['transformedCoverageX', 'transformedCoverageY', 'transformedCoverageZ']
+        elif field == 'ncoverage':
+            return ['normalisedCoverage']
+        elif field == 'mers':
+            return h5file.root.meta.meta.read()['merColNames'][0].split(',')
+
+    def readDumpBlock(self, source, start, stop):
+        """Read rows [start, stop) of a field as a 1D or 2D array"""
+        (node, column) = source
+        if column is not None:
+            return node.read(start=start, stop=stop, field=column)
+        block = node.read(start=start, stop=stop)
+        return np.column_stack([block[name] for name in block.dtype.names])
+
+    def dumpText(self, sources, fields, headerStrings, numRows, outFile, separator, useHeaders, blockSize):
+        """Write fields out as delimited text, one block of rows at a time"""
+        formats = {'names' : '%s',
+                   'lengths' : '%d',
+                   'gc' : '%.12g',
+                   'bins' : '%d'}
+        row_format = separator.join([separator.join([formats.get(field, '%0.4f')] * len(headerStrings[i]))
+                                     for (i, field) in enumerate(fields)]) + "\n"
         try:
-            with open(outFile, 'w') as fh:
+            with open(outFile, 'w', 1048576) as fh:
                 if useHeaders:
-                    header = separator.join(header_strings) + "\n"
+                    header = separator.join([separator.join(hs) for hs in headerStrings]) + "\n"
                     fh.write(header)
 
-                num_rows = len(data_arrays[0])
-                for i in range(num_rows):
-                    fh.write(data_converters[0](data_arrays[0][i]))
-                    for j in range(1, num_fields):
-                        fh.write(separator+data_converters[j](data_arrays[j][i]))
-                    fh.write('\n')
+                for start in xrange(0, numRows, blockSize):
+                    stop = min(start + blockSize, numRows)
+                    columns = []
+                    for field in fields:
+                        block = self.readDumpBlock(sources[field], start, stop)
+                        if block.ndim == 1:
+                            columns.append(block.tolist())
+                        else:
+                            columns += block.T.tolist()
+                    fh.write("".join([row_format % row for row in zip(*columns)]))
+        except:
+            print "Error opening output file %s for writing" % outFile
+            raise
+
+    def dumpNpy(self, sources, fields, headerStrings, numRows, outFile, useHeaders, blockSize):
+        """Write each field to its own .npy file, one block of rows at a time"""
+        stem = op_splitext(outFile)[0]
+        try:
+            for (i, field) in enumerate(fields):
+                first = self.readDumpBlock(sources[field], 0, min(blockSize, numRows))
+                shape = (numRows,) + np.shape(first)[1:]
+                out = open_memmap("%s_%s.npy" % (stem, field), mode='w+', dtype=first.dtype, shape=shape)
+                out[:len(first)] = first
+                for start in xrange(len(first), numRows, blockSize):
+                    stop = min(start + blockSize, numRows)
+                    out[start:stop] = self.readDumpBlock(sources[field], start, stop)
+                out.flush()
+                del out
+
+            if useHeaders:
+                with open("%s_columns.csv" % stem, 'w') as fh:
+                    for (i, field) in enumerate(fields):
+                        fh.write(",".join([field] + list(headerStrings[i])) + "\n")
         except:
             print "Error opening output file %s for writing" % outFile
             raise
@@ -1602,29 +2364,123 @@ class ContigParser:
 
       return float(gc) / (gc + at)
 
-    def PCAKSigs(self, kSigs, variance = 0.8):
+    def PCAKSigs(self, kSigs, variance = 0.8, method='cov'):
         """PCA kmer sig data. All PCs require to capture the specified variance are returned.
 
+        method 'cov' builds the covariance matrix a block of contigs at a time and
+        projects the same way so kSigs is never copied. Matches 'svd' (the old
+        full decomposition of a centered copy) up to the sign of each PC
+
         returns an array of tuples [(pc11, pc21, ..., pcN1), (pc12, pc22, ..., pnN2), ...]
         """
+        if method == 'svd':
+            # make a copy
+            data = np.copy(kSigs)
+
+            Center(data,verbose=0)
+            p = PCA(data, fraction=variance)
+            components = p.pc()
 
-        # make a copy
-        data = np.copy(kSigs)
+            return [tuple(i) for i in components], p.sumvariance[0:len(components[0])]
 
-        Center(data,verbose=0)
-        p = PCA(data, fraction=variance)
-        components = p.pc()
+        p = IncrementalPCA(np.shape(kSigs)[1])
+        p.add(kSigs)
+        p.fit(fraction=variance)
+        components = p.project(kSigs)
 
-        return [tuple(i) for i in components], p.sumvariance[0:len(components[0])]
+        return [tuple(i) for i in components], p.sumvariance[0:p.npc]
 
     def getWantedSeqs(self, contigFile, wanted, storage={}):
         """Do the heavy lifting of parsing"""
         print "Parsing contigs"
+        wanted = set(wanted)
         for cid,seq in self.readFasta(contigFile):
             if(cid in wanted):
                 storage[cid] = seq
         return storage
 
+    def getFastaIndex(self, fastaFileName):
+        """Load the .fai index of a fasta file, making it if need be
+
+        Returns { cid : (length, offset, lineBases, lineWidth) } or None if
+        the file can't be indexed (uneven line lengths). The index is the same
+        as the one samtools faidx makes so either can be reused
+        """
+        fai_file_name = fastaFileName + ".fai"
+        if op_exists(fai_file_name) and os_stat(fai_file_name).st_mtime >= os_stat(fastaFileName).st_mtime:
+            fai = {}
+            with open(fai_file_name, 'r') as fh:
+                for line in fh:
+                    fields = line.rstrip().split("\t")
+                    fai[fields[0]] = tuple([int(i) for i in fields[1:5]])
+            return fai
+
+        print "Indexing contigs:", fastaFileName
+        fai = self.buildFastaIndex(fastaFileName)
+        if fai is None:
+            return None
+        try:
+            with open(fai_file_name, 'w') as fh:
+                for (cid, entry) in fai[1]:
+                    fh.write("%s\t%d\t%d\t%d\t%d\n" % ((cid,) + entry))
+        except IOError:
+            # not being able to keep the index is no big deal
+            pass
+        return fai[0]
+
+    def buildFastaIndex(self, fastaFileName):
+        """Scan a fasta file once to work out where each sequence starts
+
+        Returns ({ cid : entry }, [(cid, entry)] in file order) or None
+        """
+        fai = {}
+        ordered = []
+        offset = 0
+        cid = None
+        with open(fastaFileName, 'rb') as fh:
+            for line in fh:
+                if line[0] == '>':
+                    if cid is not None:
+                        entry = (length, seq_offset, line_bases, line_width)
+                        fai[cid] = entry
+                        ordered.append((cid, entry))
+                    cid = line.rstrip()[1:].partition(" ")[0]
+                    seq_offset = offset + len(line)
+                    length = 0
+                    line_bases = 0
+                    line_width = 0
+                    last_bases = None
+                elif cid is not None:
+                    bases = len(line.rstrip("\r\n"))
+                    if last_bases is not None and last_bases != line_bases:
+                        # only the last line of a sequence can be short
+                        return None
+                    if line_bases == 0:
+                        if bases == 0:
+                            return None
+                        line_bases = bases
+                        line_width = len(line)
+                    elif bases > line_bases:
+                        return None
+                    length += bases
+                    last_bases = bases
+                offset += len(line)
+        if cid is not None:
+            entry = (length, seq_offset, line_bases, line_width)
+            fai[cid] = entry
+            ordered.append((cid, entry))
+        return (fai, ordered)
+
+    def fetchSeq(self, fh, entry):
+        """Read the sequence at an .fai entry from an open fasta file"""
+        (length, offset, line_bases, line_width) = entry
+        if length == 0:
+            return ""
+        num_lines = (length - 1) / line_bases
+        fh.seek(offset)
+        raw = fh.read(num_lines * line_width + length - num_lines * line_bases)
+        return raw.replace("\n", "").replace("\r", "")
+
 ###############################################################################
 ###############################################################################
 ###############################################################################
@@ -1880,12 +2736,18 @@ class CoverageTransformer:
     def small2indices(self, index, side):
         """Return the indices of the comparative items
         when given an index into a condensed distance matrix
+
+        side is one less than the number of items
         """
-        step = 0
-        while index >= (side-step):
-            index = index - side + step
-            step += 1
-        return (step, step + index + 1)
+        # row i starts at i*side - i*(i-1)/2, solve for the last row starting at or before index
+        b = 2 * side + 1
+        row = int((b - np.sqrt(b * b - 8 * index)) / 2)
+        # mop up any floating point slop
+        while row > 0 and row * side - row * (row - 1) / 2 > index:
+            row -= 1
+        while (row + 1) * side - (row + 1) * row / 2 <= index:
+            row += 1
+        return (row, index - (row * side - row * (row - 1) / 2) + row + 1)
 
     def shuffleBAMs(self, ordering=None):
         """Make the data transformation deterministic by reordering the bams"""
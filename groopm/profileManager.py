@@ -64,10 +64,12 @@ from numpy import (abs as np_abs,
                    argmin as np_argmin,
                    argsort as np_argsort,
                    array as np_array,
+                   bincount as np_bincount,
                    ceil as np_ceil,
                    concatenate as np_concatenate,
                    copy as np_copy,
                    cos as np_cos,
+                   cumsum as np_cumsum,
                    delete as np_delete,
                    diag as np_diag,
                    eye as np_eye,
@@ -77,7 +79,9 @@ from numpy import (abs as np_abs,
                    median as np_median,
                    min as np_min,
                    pi as np_pi,
+                   ravel as np_ravel,
                    reshape as np_reshape,
+                   searchsorted as np_searchsorted,
                    seterr as np_seterr,
                    shape as np_shape,
                    sin as np_sin,
@@ -112,32 +116,49 @@ class ProfileManager:
     """Interacts with the groopm DataManager and local data fields
 
     Mostly a wrapper around a group of numpy arrays and a pytables quagmire
+
+    The per contig fields in lazyFields are not read from the DB until they
+    are first used. The load* flags of loadData just fetch them up front
     """
+    # field -> the method which loads it for the current indices
+    lazyFields = {'covProfiles' : 'loadCovProfiles',
+                  'normCoverages' : 'loadNormCoverages',
+                  'averageCoverages' : 'loadAverageCoverages',
+                  'kmerSigs' : 'loadKmerSigs',
+                  'kmerPCs' : 'loadKmerPCs',
+                  'kmerNormPC1' : 'loadKmerNormPC1',
+                  'kmerVarPC' : 'loadKmerVarPC',
+                  'contigNames' : 'loadContigNames',
+                  'contigLengths' : 'loadContigLengths',
+                  'contigGCs' : 'loadContigGCs'}
+    # lazy fields which are not per contig and don't care about indices
+    globalFields = ['kmerVarPC']
+
     def __init__(self, dbFileName, force=False, scaleFactor=1000):
         # data
         self.dataManager = GMDataManager()  # most data is saved to hdf
         self.dbFileName = dbFileName        # db containing all the data we'd like to use
         self.condition = ""                 # condition will be supplied at loading time
+        self.profileCache = None            # memory mapped sidecar arrays, if the DB has a cache
 
         # --> NOTE: ALL of the arrays in this section are in sync
         # --> each one holds information for an individual contig
         self.indices = np_array([])         # indices into the data structure based on condition
-        self.covProfiles = np_array([])     # coverage based coordinates
         self.transformedCP = np_array([])   # the munged data points
         self.corners = np_array([])         # the corners of the tranformed space
         self.TCentre = 0.                   # the centre of the coverage space
         self.transRadius = 0.               # distance from corner to centre of transformed space
-        self.averageCoverages = np_array([])# average coverage across all stoits
-        self.normCoverages = np_array([])   # norm of the raw coverage vectors
-        self.kmerSigs = np_array([])        # raw kmer signatures
-        self.kmerNormPC1 = np_array([])     # First PC of kmer sigs normalized to [0, 1]
-        self.kmerPCs = np_array([])         # PCs of kmer sigs capturing specified variance
-        self.kmerVarPC = np_array([])       # variance of each PC
         self.stoitColNames = np_array([])
-        self.contigNames = np_array([])
-        self.contigLengths = np_array([])
-        self.contigGCs = np_array([])
         self.colorMapGC = None
+        # loaded on first use (see lazyFields):
+        # covProfiles       coverage based coordinates
+        # averageCoverages  average coverage across all stoits
+        # normCoverages     norm of the raw coverage vectors
+        # kmerSigs          raw kmer signatures
+        # kmerNormPC1       First PC of kmer sigs normalized to [0, 1]
+        # kmerPCs           PCs of kmer sigs capturing specified variance
+        # kmerVarPC         variance of each PC
+        # contigNames, contigLengths, contigGCs
 
         self.binIds = np_array([])          # list of bin IDs
         # --> end section
@@ -150,8 +171,12 @@ class ProfileManager:
         self.numContigs = 0                 # this depends on the condition given
         self.numStoits = 0                  # this depends on the data which was parsed
 
-        # contig links
-        self.links = {}
+        # contig links, CSR style. See getLinks
+        self.linkIndptr = np_zeros(1, dtype=int)    # links of row i are in [linkIndptr[i], linkIndptr[i+1])
+        self.linkPartners = np_array([], dtype=int) # row index of the linked contig
+        self.linkReads = np_array([], dtype=int)    # number of reads supporting the link
+        self.linkTypes = np_array([], dtype=int)    # the type of the link (SS, SE, ES, EE)
+        self.linkGaps = np_array([], dtype=int)     # the estimated gap between the contigs
 
         # misc
         self.forceWriting = force           # overwrite existng values silently?
@@ -172,7 +197,10 @@ class ProfileManager:
                  loadContigLengths=True,
                  loadContigGCs=True,
                  loadBins=False,
-                 loadLinks=False):
+                 loadLinks=False,
+                 minLength=None,            # if any of these three are set then they are used
+                 inBids=None,               # to select contigs instead of condition, which is
+                 binned=None):              # then just for show. See getConditionalIndices
         """Load pre-parsed data"""
 
         timer.getTimeStamp()
@@ -184,9 +212,13 @@ class ProfileManager:
         try:
             self.numStoits = self.getNumStoits()
             self.condition = condition
+            self.dropLazyFields()
             self.indices = self.dataManager.getConditionalIndices(self.dbFileName,
                                                                   condition=condition,
-                                                                  silent=silent)
+                                                                  silent=silent,
+                                                                  minLength=minLength,
+                                                                  bids=inBids,
+                                                                  binned=binned)
             if(verbose):
                 print "    Loaded indices with condition:", condition
             self.numContigs = len(self.indices)
@@ -198,48 +230,42 @@ class ProfileManager:
             if(not silent):
                 print "    Working with: %d contigs" % self.numContigs
 
+            self.profileCache = self.dataManager.getProfileCache(self.dbFileName, silent=silent)
+            if(verbose and self.profileCache is not None):
+                print "    Using profile cache"
+
             if(loadCovProfiles):
                 if(verbose):
                     print "    Loading coverage profiles"
-                self.covProfiles = self.dataManager.getCoverageProfiles(self.dbFileName, indices=self.indices)
-                self.normCoverages = self.dataManager.getNormalisedCoverageProfiles(self.dbFileName, indices=self.indices)
-
-                # work out average coverages
-                self.averageCoverages = np_array([sum(i)/self.numStoits for i in self.covProfiles])
+                self.prefetch(['covProfiles', 'normCoverages', 'averageCoverages'])
 
             if loadRawKmers:
                 if(verbose):
                     print "    Loading RAW kmer sigs"
-                self.kmerSigs = self.dataManager.getKmerSigs(self.dbFileName, indices=self.indices)
+                self.prefetch(['kmerSigs'])
 
             if(loadKmerPCs):
-                self.kmerPCs = self.dataManager.getKmerPCAs(self.dbFileName, indices=self.indices)
-
+                self.prefetch(['kmerPCs', 'kmerNormPC1'])
                 if(verbose):
                     print "    Loading PCA kmer sigs (" + str(len(self.kmerPCs[0])) + " dimensional space)"
 
-                self.kmerNormPC1 = np_copy(self.kmerPCs[:,0])
-                self.kmerNormPC1 -= np_min(self.kmerNormPC1)
-                self.kmerNormPC1 /= np_max(self.kmerNormPC1)
-
             if(loadKmerVarPC):
-                self.kmerVarPC = self.dataManager.getKmerVarPC(self.dbFileName, indices=self.indices)
-
+                self.prefetch(['kmerVarPC'])
                 if(verbose):
                     print "    Loading PCA kmer variance (total variance: %.2f" % np_sum(self.kmerVarPC) + ")"
 
             if(loadContigNames):
                 if(verbose):
                     print "    Loading contig names"
-                self.contigNames = self.dataManager.getContigNames(self.dbFileName, indices=self.indices)
+                self.prefetch(['contigNames'])
 
             if(loadContigLengths):
-                self.contigLengths = self.dataManager.getContigLengths(self.dbFileName, indices=self.indices)
+                self.prefetch(['contigLengths'])
                 if(verbose):
                     print "    Loading contig lengths (Total: %d BP)" % ( sum(self.contigLengths) )
 
             if(loadContigGCs):
-                self.contigGCs = self.dataManager.getContigGCs(self.dbFileName, indices=self.indices)
+                self.prefetch(['contigGCs'])
                 if(verbose):
                     print "    Loading contig GC ratios (Average GC: %0.3f)" % ( np_mean(self.contigGCs) )
 
@@ -292,6 +318,102 @@ class ProfileManager:
             print "Error loading DB:", self.dbFileName, exc_info()[0]
             raise
 
+    def __getattr__(self, field):
+        """Load lazy fields the first time they are asked for
+
+        Only called when field is not already set on the instance
+        """
+        try:
+            loader = self.lazyFields[field]
+        except KeyError:
+            raise AttributeError(field)
+        if field not in self.globalFields and len(self.__dict__.get('indices', [])) == 0:
+            # nothing loaded yet, don't hang on to this
+            return np_array([])
+        value = getattr(self, loader)()
+        setattr(self, field, value)
+        return value
+
+    def prefetch(self, fields):
+        """Load lazy fields now rather than when they are first used"""
+        for field in fields:
+            getattr(self, field)
+
+    def dropLazyFields(self):
+        """Forget any lazy fields we've loaded. They will be reloaded for the current indices"""
+        for field in self.lazyFields:
+            self.__dict__.pop(field, None)
+        self.__dict__.pop('kmerPC1Bounds', None)
+
+    def isLoaded(self, field):
+        """Has this lazy field been loaded yet?"""
+        return field in self.__dict__
+
+    def loadCovProfiles(self):
+        if self.profileCache is not None:
+            return self.fromCache('coverage')
+        return self.dataManager.getCoverageProfiles(self.dbFileName, indices=self.indices)
+
+    def loadNormCoverages(self):
+        if self.profileCache is not None:
+            return self.fromCache('normCoverage')
+        # the DB hands these back as a column, the cache keeps them flat
+        return np_ravel(self.dataManager.getNormalisedCoverageProfiles(self.dbFileName, indices=self.indices))
+
+    def loadAverageCoverages(self):
+        if self.profileCache is not None:
+            return self.fromCache('averageCoverage')
+        return np_array([sum(i)/self.numStoits for i in self.covProfiles])
+
+    def loadKmerSigs(self):
+        return self.dataManager.getKmerSigs(self.dbFileName, indices=self.indices)
+
+    def loadKmerPCs(self):
+        if self.profileCache is not None:
+            kmer_PCs = self.fromCache('kpca')
+        else:
+            kmer_PCs = self.dataManager.getKmerPCAs(self.dbFileName, indices=self.indices)
+        # remember the PC1 range now so kmerNormPC1 doesn't change if
+        # the indices are reduced before it is first read
+        self.kmerPC1Bounds = (np_min(kmer_PCs[:,0]), np_max(kmer_PCs[:,0]))
+        return kmer_PCs
+
+    def loadKmerNormPC1(self):
+        kmer_PCs = self.kmerPCs
+        (lower, upper) = self.kmerPC1Bounds
+        kmer_norm_PC1 = np_copy(kmer_PCs[:,0])
+        kmer_norm_PC1 -= lower
+        kmer_norm_PC1 /= (upper - lower)
+        return kmer_norm_PC1
+
+    def loadKmerVarPC(self):
+        return self.dataManager.getKmerVarPC(self.dbFileName, indices=self.indices)
+
+    def loadContigNames(self):
+        if self.profileCache is not None:
+            return self.fromCache('names')
+        return self.dataManager.getContigNames(self.dbFileName, indices=self.indices)
+
+    def loadContigLengths(self):
+        if self.profileCache is not None:
+            return self.fromCache('lengths')
+        return self.dataManager.getContigLengths(self.dbFileName, indices=self.indices)
+
+    def loadContigGCs(self):
+        if self.profileCache is not None:
+            return self.fromCache('gc')
+        return self.dataManager.getContigGCs(self.dbFileName, indices=self.indices)
+
+    def fromCache(self, field):
+        """The rows of a cached array which belong to the loaded contigs
+
+        When every contig is loaded this is the (read only) memory map itself
+        """
+        data = self.profileCache[field]
+        if len(self.indices) == len(data):
+            return data
+        return data[self.indices]
+
     def reduceIndices(self, deadRowIndices):
         """purge indices from the data structures
 
@@ -299,14 +421,20 @@ class ProfileManager:
         """
         # strip out the other values
         self.indices = np_delete(self.indices, deadRowIndices, axis=0)
-        self.covProfiles = np_delete(self.covProfiles, deadRowIndices, axis=0)
         self.transformedCP = np_delete(self.transformedCP, deadRowIndices, axis=0)
-        self.contigNames = np_delete(self.contigNames, deadRowIndices, axis=0)
-        self.contigLengths = np_delete(self.contigLengths, deadRowIndices, axis=0)
-        self.contigGCs = np_delete(self.contigGCs, deadRowIndices, axis=0)
-        #self.kmerSigs = np_delete(self.kmerSigs, deadRowIndices, axis=0)
-        self.kmerPCs = np_delete(self.kmerPCs, deadRowIndices, axis=0)
         self.binIds = np_delete(self.binIds, deadRowIndices, axis=0)
+        # lazy fields which haven't been loaded yet will be loaded for the new indices
+        for field in ['covProfiles',
+                      'normCoverages',
+                      'averageCoverages',
+                      'kmerSigs',
+                      'kmerPCs',
+                      'kmerNormPC1',
+                      'contigNames',
+                      'contigLengths',
+                      'contigGCs']:
+            if self.isLoaded(field):
+                setattr(self, field, np_delete(getattr(self, field), deadRowIndices, axis=0))
 
 #------------------------------------------------------------------------------
 # GET / SET
@@ -360,19 +488,41 @@ class ProfileManager:
         """Save that the db has been completely clustered"""
         self.dataManager.setComplete(self.dbFileName, True)
 
+    def isRecruited(self):
+        """Have unbinned contigs been recruited already"""
+        return self.dataManager.isRecruited(self.dbFileName)
+
+    def setRecruited(self):
+        """Save that unbinned contigs have been recruited"""
+        self.dataManager.setRecruited(self.dbFileName, True)
+
     def getBinStats(self):
         """Go through all the "bins" array and make a list of unique bin ids vs number of contigs"""
         return self.dataManager.getBinStats(self.dbFileName)
 
-    def setBinStats(self, binStats):
+    def setBinStats(self, binStats, ellipsoids=None):
         """Store the valid bin Ids and number of members
 
         binStats is a list of tuples which looks like:
         [ (bid, numMembers, isLikelyChimeric) ]
         Note that this call effectively nukes the existing table
         """
-        self.dataManager.setBinStats(self.dbFileName, binStats)
-        self.setNumBins(len(binStats))
+        self.dataManager.saveBins(self.dbFileName, {}, binStats, ellipsoids=ellipsoids)
+
+    def getBinEllipsoids(self):
+        """Load any saved bin ellipsoids
+
+        { (bid, mode) : (memberKey, (A, center, radii, rotation)) }
+        """
+        return self.dataManager.getBinEllipsoids(self.dbFileName)
+
+    def setBinEllipsoids(self, ellipsoids):
+        """Save bin ellipsoids into the DB
+
+        ellipsoids is a list of tuples which looks like:
+        [ (bid, mode, memberKey, A, center, radii, rotation) ]
+        """
+        self.dataManager.setBinEllipsoids(self.dbFileName, ellipsoids)
 
     def setBinAssignments(self, assignments, nuke=False):
         """Save our bins into the DB"""
@@ -380,31 +530,75 @@ class ProfileManager:
                                            assignments,
                                            nuke=nuke)
 
+    def saveBins(self, assignments, binStats, nuke=False, ellipsoids=None):
+        """Save bin assignments, bin stats and the number of bins in one go
+
+        assignments is { global_index : bid }
+        binStats is a list of tuples which looks like:
+        [ (bid, numMembers, isLikelyChimeric) ]
+        ellipsoids (optional) are saved along with them, see setBinEllipsoids
+        """
+        self.dataManager.saveBins(self.dbFileName,
+                                  assignments,
+                                  binStats,
+                                  nuke=nuke,
+                                  ellipsoids=ellipsoids)
+
+    def getSOMClassifier(self):
+        """Load the stored SOM classifier, None if there isn't one"""
+        return self.dataManager.getSOMClassifier(self.dbFileName)
+
+    def setSOMClassifier(self, binHash, weights, binAssignments, boundaryMask, minz, maxz, pc1Bounds):
+        """Save a trained SOM classifier into the DB"""
+        self.dataManager.setSOMClassifier(self.dbFileName,
+                                          binHash,
+                                          weights,
+                                          binAssignments,
+                                          boundaryMask,
+                                          minz,
+                                          maxz,
+                                          pc1Bounds)
+
+    def getKmerPC1Bounds(self):
+        """The raw PC1 range kmerNormPC1 is normalised over"""
+        self.kmerPCs        # make sure it's loaded
+        return self.kmerPC1Bounds
+
     def loadLinks(self):
         """Extra wrapper 'cause I am dumb"""
-        self.links = self.getLinks()
+        (self.linkIndptr,
+         self.linkPartners,
+         self.linkReads,
+         self.linkTypes,
+         self.linkGaps) = self.getLinks()
 
     def getLinks(self):
-        """Get contig links"""
-        # first we get the absolute links
-        absolute_links = self.dataManager.restoreLinks(self.dbFileName, self.indices)
-        # now convert this into plain old row_indices
-        reverse_index_lookup = {}
-        for i in range(len(self.indices)):
-            reverse_index_lookup[self.indices[i]] = i
-
-        # now convert the absolute links to local ones
-        relative_links = {}
-        for cid in self.indices:
-            local_cid = reverse_index_lookup[cid]
-            relative_links[local_cid] = []
-            try:
-                for link in absolute_links[cid]:
-                    relative_links[local_cid].append([reverse_index_lookup[link[0]], link[1], link[2], link[3]])
-            except KeyError: # not everyone is linked
-                pass
+        """Get contig links as a CSR adjacency over row indices
 
-        return relative_links
+        Returns (indptr, partners, numReads, linkTypes, gaps). The links of
+        row i are partners[indptr[i]:indptr[i+1]] and so on
+        """
+        # first we get the absolute links
+        links = self.dataManager.restoreLinks(self.dbFileName, self.indices)
+
+        # indices are sorted so this converts them into plain old row_indices
+        rows = np_searchsorted(self.indices, links['contig1'])
+        order = np_argsort(rows, kind='mergesort')
+        links = links[order]
+        indptr = np_zeros(len(self.indices)+1, dtype=int)
+        if len(rows) > 0:
+            indptr[1:] = np_cumsum(np_bincount(rows, minlength=len(self.indices)))
+        return (indptr,
+                np_searchsorted(self.indices, links['contig2']),
+                links['numReads'],
+                links['linkType'],
+                links['gap'])
+
+    def getRowLinks(self, rowIndex):
+        """(partner row indices, numReads) of the links of one contig"""
+        start = self.linkIndptr[rowIndex]
+        end = self.linkIndptr[rowIndex+1]
+        return (self.linkPartners[start:end], self.linkReads[start:end])
 
 #------------------------------------------------------------------------------
 # DATA TRANSFORMATIONS
@@ -498,32 +692,14 @@ class ProfileManager:
         """Do the main transformation on the coverage profile data"""
         if(not silent):
             print "    Reticulating splines"
-        self.transformedCP = self.dataManager.getTransformedCoverageProfiles(self.dbFileName, indices=self.indices)
+        if self.profileCache is not None:
+            self.transformedCP = self.fromCache('transCoverage')
+        else:
+            self.transformedCP = self.dataManager.getTransformedCoverageProfiles(self.dbFileName, indices=self.indices)
         self.corners = self.dataManager.getTransformedCoverageCorners(self.dbFileName)
         self.TCentre = np_mean(self.corners, axis=0)
         self.transRadius = np_norm(self.corners[0] - self.TCentre)
 
-#------------------------------------------------------------------------------
-# DEBUG CRUFT
-
-    def rewriteBins(self):
-        """rewrite the bins table in hdf5 based on numbers in meta-contigs"""
-        bins = self.dataManager.getBins(self.dbFileName)
-        bin_store = {}
-        for c in bins:
-            if c != 0:
-                try:
-                    bin_store[c] += 1
-                except KeyError:
-                    bin_store[c] = 1
-
-        bin_stats = []
-        for bid in bin_store:
-            # [(bid, size, likelyChimeric)]
-            bin_stats.append((bid, bin_store[bid], False))
-
-        self.setBinStats(bin_stats)
-
 #------------------------------------------------------------------------------
 # IO and IMAGE RENDERING
 
@@ -609,7 +785,7 @@ class ProfileManager:
 
     def plotUnbinned(self, timer, coreCut, transform=True, ignoreContigLengths=False):
         """Plot all contigs over a certain length which are unbinned"""
-        self.loadData(timer, "((length >= "+str(coreCut)+") & (bid == 0))")
+        self.loadData(timer, "((length >= "+str(coreCut)+") & (bid == 0))", minLength=coreCut, binned=False)
 
         if transform:
             self.transformCP(timer)
@@ -639,7 +815,7 @@ class ProfileManager:
 
     def plotAll(self, timer, coreCut, transform=True, ignoreContigLengths=False):
         """Plot all contigs over a certain length which are unbinned"""
-        self.loadData(timer, "((length >= "+str(coreCut)+"))")
+        self.loadData(timer, "((length >= "+str(coreCut)+"))", minLength=coreCut)
         if transform:
             self.transformCP(timer)
         else:
@@ -53,45 +53,58 @@ import sys
 from sys import stdout as sys_stdout
 
 import math
+import hashlib
+from heapq import heapify, heappop, heappush
 
 from colorsys import hsv_to_rgb as htr
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
 from numpy import (abs as np_abs,
                    append as np_append,
                    arange as np_arange,
                    arccos as np_arccos,
-                   argmin as np_argmin,
                    argsort as np_argsort,
                    around as np_around,
                    array as np_array,
+                   clip as np_clip,
                    concatenate as np_concatenate,
                    copy as np_copy,
+                   cumsum as np_cumsum,
                    dot as np_dot,
+                   in1d as np_in1d,
+                   logical_not as np_logical_not,
                    max as np_max,
                    mean as np_mean,
                    median as np_median,
                    min as np_min,
+                   newaxis as np_newaxis,
+                   nonzero as np_nonzero,
                    ones as np_ones,
+                   ravel as np_ravel,
                    reshape as np_reshape,
+                   searchsorted as np_searchsorted,
                    seterr as np_seterr,
+                   shape as np_shape,
+                   sort as np_sort,
                    sqrt as np_sqrt,
                    std as np_std,
                    sum as np_sum,
+                   triu_indices as np_triu_indices,
                    where as np_where,
                    zeros as np_zeros)
 from numpy.linalg import norm as np_norm
-from numpy.random import (randint as randint,
-                          shuffle as shuffle)
+from numpy.random import RandomState
 
 from scipy.spatial import KDTree as kdt
-from scipy.spatial.distance import cdist, squareform, pdist
+from scipy.spatial.distance import cdist
 
 # GroopM imports
 from binManager import BinManager
+from distanceStats import DIST_BUDGET, medianCdist, medianPdist
 from ellipsoid import EllipsoidTool
-from PCA import PCA, Center
+from PCA import PCA, Center, IncrementalPCA, TruncatedPCA
 import groopmExceptions as ge
-from som import SOM
+from som import SOM, trainWeights
 np_seterr(all='raise')
 
 ###############################################################################
@@ -112,7 +125,9 @@ class RefineEngine:
                  getUnbinned=False,
                  loadContigNames=False,
                  cutOff=0,
-                 bids=[]):
+                 bids=[],
+                 threads=1,
+                 exactIntersect=False):
 
         # worker classes
         if BM is None:
@@ -139,6 +154,14 @@ class RefineEngine:
 
         self.transform = transform        # are we going to transform the data
 
+        self.binSamples = {}              # (bid, sample size) => (rowIndices, evenly spaced sample)
+
+        self.threads = threads            # how many workers to use when retraining the SOM or testing mergers
+
+        self.exactIntersect = exactIntersect  # use the exact ellipsoid overlap test when merging
+
+        self.rePCAStates = {}             # mode => (global index => row, running PCA) from the last rePCA
+
 #------------------------------------------------------------------------------
 # REFINING
 
@@ -181,6 +204,7 @@ class RefineEngine:
 
             if saveBins:
                 self.BM.saveBins(nuke=True)
+                self.PM.setComplete()
         else:
             self.plotterRefineBins(ignoreRanges=ignoreRanges)
 
@@ -579,8 +603,15 @@ class RefineEngine:
 
         return num_bins_removed
 
-    def findMergeGroups(self, kCutMedian, kCutStd, cCutMedian, cCutStd, verbose=False):
-        """Identify groups of contigs which could be merged"""
+    def findMergeGroups(self, kCutMedian, kCutStd, cCutMedian, cCutStd, verbose=False, threads=None):
+        """Identify groups of contigs which could be merged
+
+        With more than one thread every candidate pair is tested up front
+        in parallel and the verdicts are played back in bid order. Otherwise
+        pairs are only tested when we get to them. Either way each pair is
+        tested with the same base / query orientation as testing in turn so
+        we make exactly the same merge decisions
+        """
         cov_tdm = []                # these are used in the neighbor search
         kmer_tdm = []
 
@@ -594,13 +625,9 @@ class RefineEngine:
             K = len(self.BM.getNonChimericBinIds())
 
         # keep track of what gets merged where
-        merged_bins = {}                # oldId => newId
+        merge_roots = {}                # bid => bid it merges into, smallest bid is the root
         processed_pairs = {}            # keep track of pairs we've analysed
-        bin_c_lengths = {}              # bid => [len,len,...]
-        bin_c_ellipsoid_volumes = {}    # volume of the minimum bounding COVERAGE ellipsoid
-        bin_c_ellipsoids = {}           # the matrix A representing the bins COVERAGE ellipsiod
-        bin_k_ellipse_areas = {}        # area of the minimum bounding KMER ellipse
-        bin_k_ellipses = {}             # the matrix A representing the bins KMER ellipse
+        bin_profiles = {}               # bid => everything testMergePair needs to know about a bin
 
 #-----
 # PREP DATA STRUCTURES
@@ -621,16 +648,18 @@ class RefineEngine:
             kmer_tdm.append(bin.kMedian)
 
             # work out the volume of the minimum bounding coverage ellipsoid and kmer ellipse
-            (bin_c_ellipsoids[bid], bin_c_ellipsoid_volumes[bid]) = bin.getBoundingCEllipsoidVol(self.PM.transformedCP,
-                                                                                                 ET=self.ET,
-                                                                                                 retA=True)
-
-            BP = self.PM.kmerPCs[bin.rowIndices,0:3]
-            (bin_k_ellipses[bid], bin_k_ellipse_areas[bid]) = bin.getBoundingKEllipseArea(BP,
-                                                                                          ET=self.ET,
-                                                                                          retA=True)
-
-            bin_c_lengths[bid] = self.PM.contigLengths[bin.rowIndices]
+            # the BM caches these so we only redo the bins which have changed
+            (cA, c_center, c_radii, _rotation) = self.BM.getBinEllipsoid(bid, mode='cov')
+            (kA, k_center, k_radii, _rotation) = self.BM.getBinEllipsoid(bid, mode='mer')
+
+            bin_profiles[bid] = (bin.binSize,
+                                 self.PM.contigLengths[bin.rowIndices],
+                                 self.PM.kmerPCs[bin.rowIndices],
+                                 self.getUnitCoverages(self.getBinSamplePts(bin)),
+                                 (kA, k_center),
+                                 self.ET.getEllipsoidVolume(k_radii),
+                                 (cA, c_center),
+                                 self.ET.getEllipsoidVolume(c_radii))
 
             bid_2_tdm_index[bid] = index
             tdm_index_2_bid[index] = bid
@@ -641,7 +670,7 @@ class RefineEngine:
             processed_pairs[self.BM.makeBidKey(bid, bid)] = True
 
 #-----
-# ALL Vs ALL
+# CANDIDATE PAIRS
 
         # make a search tree from whitened coverage medians and kmer medians
         cp_cov_tdm = np_copy(cov_tdm)
@@ -652,38 +681,68 @@ class RefineEngine:
 
         cov_search_tree = kdt(c_whiten_tdm)
         kmer_search_tree = kdt(kmer_tdm)
-        for bid in self.BM.getNonChimericBinIds():
-            # get the base bid and trace the chain up through mergers...
-            merged_base_bid = bid
-            base_bid = bid
-            while merged_base_bid in merged_bins:
-                merged_base_bid = merged_bins[merged_base_bid]
-            base_bin = self.BM.bins[base_bid]
+        cov_neighbors = cov_search_tree.query(c_whiten_tdm, k=K)[1]
+        kmer_neighbors = kmer_search_tree.query(kmer_tdm, k=K)[1]
 
-            # get the K closest bins in coverage and kmer space
-            cov_neighbor_list = [tdm_index_2_bid[i] for i in cov_search_tree.query(c_whiten_tdm[bid_2_tdm_index[bid]], k=K)[1]]
-            kmer_neighbor_list = [tdm_index_2_bid[i] for i in kmer_search_tree.query(kmer_tdm[bid_2_tdm_index[bid]], k=K)[1]]
-            common_neighbors = set(cov_neighbor_list).intersection(set(kmer_neighbor_list))
+        # get the K closest bins in coverage and kmer space
+        common_neighbors = {}           # bid => bids close in both spaces, in the order we test them
+        pair_orients = []               # (base bid, query bid) of each pair, the way round we first see it
+        seen_keys = dict(processed_pairs)
+        for bid in self.BM.getNonChimericBinIds():
+            cov_neighbor_list = [tdm_index_2_bid[i] for i in np_reshape(cov_neighbors[bid_2_tdm_index[bid]], (-1,))]
+            kmer_neighbor_list = [tdm_index_2_bid[i] for i in np_reshape(kmer_neighbors[bid_2_tdm_index[bid]], (-1,))]
+            common_neighbors[bid] = list(set(cov_neighbor_list).intersection(set(kmer_neighbor_list)))
 
             if verbose:
                 print "++++++++++"
                 print bid, cov_neighbor_list
                 print bid, kmer_neighbor_list
-                print bid, common_neighbors
+                print bid, common_neighbors[bid]
+
+            for query_bid in common_neighbors[bid]:
+                seen_key = self.BM.makeBidKey(bid, query_bid)
+                if seen_key not in seen_keys:
+                    seen_keys[seen_key] = True
+                    pair_orients.append((bid, query_bid))
+
+#-----
+# PAIR TESTS
+
+        # the tests on each pair don't depend on any other pair
+        # (base bid, query bid) => verdict, the tests aren't symmetric on ties
+        pair_verdicts = {}
+        if threads is None:
+            threads = self.threads
+        if threads > 1 and not verbose and len(pair_orients) > 1:
+            jobs = [(bin_profiles[bid1], bin_profiles[bid2], kCutMedian, cCutMedian, self.exactIntersect) for (bid1, bid2) in pair_orients]
+            pool = Pool(threads)
+            try:
+                verdicts = pool.map(testMergePair, jobs, chunksize=max(1, len(jobs)/(4*threads)))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+            pair_verdicts = dict(zip(pair_orients, verdicts))
+
+#-----
+# PLAY BACK THE VERDICTS
+
+        for bid in self.BM.getNonChimericBinIds():
+            # get the base bid and trace the chain up through mergers...
+            base_bid = bid
+            merged_base_bid = self.findMergeRoot(merge_roots, base_bid)
+            base_bin = self.BM.bins[base_bid]
 
             # test each neighbor in turn
-            for i, neighbor_index in enumerate(common_neighbors):
+            for query_bid in common_neighbors[bid]:
                 # get the query bid and trace the chain up through mergers...
-                query_bid = neighbor_index
-                merged_query_bid = query_bid
-                while merged_query_bid in merged_bins:
-                    merged_query_bid = merged_bins[merged_query_bid]
+                merged_query_bid = self.findMergeRoot(merge_roots, query_bid)
 
                 if verbose:
                     print "++++++++++"
                     print base_bid, query_bid, merged_base_bid, merged_query_bid
-#-----
-# TIME WASTERS
 
                 # process each BID pair once only (takes care of self comparisons too!)
                 seen_key = self.BM.makeBidKey(base_bid, query_bid)
@@ -694,62 +753,26 @@ class RefineEngine:
                 processed_pairs[seen_key] = True
 
                 query_bin = self.BM.bins[query_bid]
+                try:
+                    verdict = pair_verdicts[(base_bid, query_bid)]
+                except KeyError:
+                    # not tested yet, or tested the other way round
+                    verdict = testMergePair((bin_profiles[base_bid], bin_profiles[query_bid], kCutMedian, cCutMedian, self.exactIntersect),
+                                            GT=self.GT,
+                                            ET=self.ET)
+                (lengths_wrong, k_dist_bw, c_dist_bw, k_intersects, c_intersects) = verdict
 
-#-----
-# CONTIG LENGTH SANITY
-                # Test the smaller bin against the larger
-                if query_bin.binSize < base_bin.binSize:
-                    lengths_wrong = self.GT.isMaxOutlier(np_median(bin_c_lengths[query_bid]),
-                                                         bin_c_lengths[base_bid]
-                                                         )
-                else:
-                    lengths_wrong = self.GT.isMaxOutlier(np_median(bin_c_lengths[base_bid]),
-                                                         bin_c_lengths[query_bid]
-                                                         )
                 if lengths_wrong:
                     if verbose:
                         print "LW"
                     continue
 
-#-----
-# K and C SPACE SIMILARITY CHECK
-                # If the bins are highly similar in their coverage and kmer distances
-                # compared to other core bins than just merge them now
-                k_dist_bw = self.kDistBetweenBins(base_bin, query_bin)
-                c_dist_bw = self.cDistBetweenBins(base_bin, query_bin)
-
                 if verbose:
                     print 'k_dist_bw, c_dist_bw'
                     print k_dist_bw, c_dist_bw
                     print '---------------------'
 
-
-                if k_dist_bw < kCutMedian and c_dist_bw < cCutMedian:
-                    if verbose:
-                        print 'MERGED'
-                        print '---------------------'
-
-                    if merged_query_bid < merged_base_bid:
-                        merged_bins[merged_base_bid] = merged_query_bid
-                        break # we just nuked the base bid
-                    else:
-                        merged_bins[merged_query_bid] = merged_base_bid
-                        continue
-
-#-----
-# KMER ELLIPSE OVERLAP
-                if (bin_k_ellipse_areas[base_bid] <= bin_k_ellipse_areas[query_bid]):
-                    INTT = self.ET.doesIntersect3D(bin_k_ellipses[query_bid][0],
-                                                   bin_k_ellipses[query_bid][1],
-                                                   bin_k_ellipses[base_bid][0],
-                                                   bin_k_ellipses[base_bid][1])
-                else:
-                    INTT = self.ET.doesIntersect3D(bin_k_ellipses[base_bid][0],
-                                                   bin_k_ellipses[base_bid][1],
-                                                   bin_k_ellipses[query_bid][0],
-                                                   bin_k_ellipses[query_bid][1])
-
-                if verbose:
+                if k_intersects is not None and verbose:
                     fig = plt.figure()
                     ax = fig.add_subplot(1, 1, 1)
                     base_bin.plotMersOnAx(ax,
@@ -766,90 +789,70 @@ class RefineEngine:
                                            self.PM.contigLengths,
                                            self.PM.colorMapGC,
                                            ET=self.ET)
-                    plt.title("MERGE: %d -> %d (%d)" % (base_bid, query_bid, INTT))
+                    plt.title("MERGE: %d -> %d (%d)" % (base_bid, query_bid, k_intersects))
                     plt.show()
                     plt.close(fig)
                     del fig
 
-                if not INTT:
+                if k_intersects == False:
                     if verbose:
                         print "KINTT"
                     continue
-#-----
-# MINIMUM BOUNDING COVERAGE ELLIPSOID
-
-                # determine if intersection exists
-                if bin_c_ellipsoid_volumes[base_bid] <= bin_c_ellipsoid_volumes[query_bid]:
-                    intersects = self.ET.doesIntersect3D(bin_c_ellipsoids[query_bid][0],
-                                                         bin_c_ellipsoids[query_bid][1],
-                                                         bin_c_ellipsoids[base_bid][0],
-                                                         bin_c_ellipsoids[base_bid][1])
-                else:
-                    intersects = self.ET.doesIntersect3D(bin_c_ellipsoids[base_bid][0],
-                                                         bin_c_ellipsoids[base_bid][1],
-                                                         bin_c_ellipsoids[query_bid][0],
-                                                         bin_c_ellipsoids[query_bid][1])
 
-                if verbose:
+                if c_intersects is not None and verbose:
                     fig = plt.figure()
                     ax = fig.add_subplot(1, 1, 1, projection='3d')
-                    base_bin.plotOnAx(ax, self.PM.transformedCP, self.PM.contigGCs, self.PM.contigLengths, self.PM.colorMapGC, self.PM.isLikelyChimeric, ET=self.ET)
-                    query_bin.plotOnAx(ax, self.PM.transformedCP, self.PM.contigGCs, self.PM.contigLengths, self.PM.colorMapGC, self.PM.isLikelyChimeric, ET=self.ET)
-                    plt.title("MERGE: %d -> %d (%d)" % (base_bid, query_bid, intersects))
+                    base_bin.plotOnAx(ax, self.PM.transformedCP, self.PM.contigGCs, self.PM.contigLengths, self.PM.colorMapGC, self.PM.isLikelyChimeric, ET=self.ET, ellipsoid=self.BM.getBinEllipsoid(base_bid))
+                    query_bin.plotOnAx(ax, self.PM.transformedCP, self.PM.contigGCs, self.PM.contigLengths, self.PM.colorMapGC, self.PM.isLikelyChimeric, ET=self.ET, ellipsoid=self.BM.getBinEllipsoid(query_bid))
+                    plt.title("MERGE: %d -> %d (%d)" % (base_bid, query_bid, c_intersects))
                     plt.show()
                     plt.close(fig)
                     del fig
 
-                if not intersects:
+                if c_intersects == False:
                     if verbose:
                         print "CINTT"
                     continue
 
+                if verbose:
+                    print 'MERGED'
+                    print '---------------------'
+
                 # We only get here if we're going to merge the bins
                 if merged_query_bid < merged_base_bid:
-                    merged_bins[merged_base_bid] = merged_query_bid
+                    merge_roots[merged_base_bid] = merged_query_bid
                     # we just nuked the base bid
                     break
                 else:
-                    merged_bins[merged_query_bid] = merged_base_bid
+                    merge_roots[merged_query_bid] = merged_base_bid
+
 #-----
 # CREATE FINAL MERGE GROUPS
 
-        # now make a bunch of possible mergers
-        mergers = []
-        processed_bids = {}     # bid => index in mergers
-        for bid in merged_bins:
-
-            # trace this guy until the end
-            merging_bid = merged_bins[bid]
-            while merging_bid in merged_bins:
-                merging_bid = merged_bins[merging_bid]
-
+        # everything which shares a root is one group
+        groups = {}
+        for bid in merge_roots:
+            root = self.findMergeRoot(merge_roots, bid)
             try:
-                merge_list_id_1 = processed_bids[bid]
+                groups[root].append(bid)
             except KeyError:
-                merge_list_id_1 = -1
+                groups[root] = [root, bid]
 
-            try:
-                merge_list_id_2 = processed_bids[merging_bid]
-            except KeyError:
-                merge_list_id_2 = -1
-
-            if merge_list_id_1 == -1:
-                if merge_list_id_2 == -1:
-                    # all new
-                    index = len(mergers)
-                    processed_bids[merging_bid] = index
-                    processed_bids[bid] = index
-                    mergers.append([bid, merging_bid])
-                else:
-                    processed_bids[bid] = merge_list_id_2
-                    mergers[merge_list_id_2].append(bid)
-            elif merge_list_id_2 == -1:
-                processed_bids[merging_bid] = merge_list_id_1
-                mergers[merge_list_id_1].append(merging_bid)
+        return [sorted(groups[root]) for root in sorted(groups.keys())]
+
+    def findMergeRoot(self, mergeRoots, bid):
+        """Find the bid at the end of a chain of mergers
 
-        return mergers
+        Short circuits the chain as we go so later look ups are quick
+        """
+        root = bid
+        while root in mergeRoots:
+            root = mergeRoots[root]
+        while bid != root:
+            next_bid = mergeRoots[bid]
+            mergeRoots[bid] = root
+            bid = next_bid
+        return root
 
     def combineMergers(self, bidList, kCutMedian, kCutStd, cCutMedian, cCutStd, graph=None):
         """Merge similar bins in the given list"""
@@ -905,44 +908,44 @@ class RefineEngine:
 
         return merged_bids
 
-    def small2indices(self, index, side):
-        """Return the indices of the comparative items
-        when given an index into a condensed distance matrix
-        """
-        step = 0
-        while index >= (side-step):
-            index = index - side + step
-            step += 1
-        return (step, step + index + 1)
-
     def combineMergersMike(self, bidList, kCut, cCut, graph=None):
-        """Try to merge similar bins in the given list"""
+        """Try to merge similar bins in the given list
+
+        Closest pairs come off a heap. When a bin changes we push its new
+        distances and the old ones are thrown away as they surface
+        """
 
         merged_bids = []
-        too_big = 10000
 
         # PCA kmers to find out who is most similar to whom
         (bin_mer_PCAs, mer_con_PCAs) = self.rePCA(bidList, doBoth=True)
         side = len(bidList)
         sq_dists = cdist(bin_mer_PCAs, bin_mer_PCAs, 'cityblock')
-        dists = squareform(sq_dists)
+
+        # (dist, i, j, version of i, version of j) with i < j
+        versions = [0] * side
+        alive = [True] * side
+        rejected = {}               # (i, j) => True for pairs we won't check again
+        pair_heap = [(sq_dists[i,j], i, j, 0, 0) for i in range(side) for j in range(i+1, side)]
+        heapify(pair_heap)
+        del sq_dists
 
         # raw coverage averages for each bin
         raw_coverage_centroids = {}
 
-        while True:
+        while len(pair_heap) > 0:
             # find the closest pair
-            closest = np_argmin(dists)
-            if dists[closest] == too_big:
-                break
-            (i,j) = self.PM.small2indices(closest, side-1)
+            (dist, i, j, version_i, version_j) = heappop(pair_heap)
+            if not (alive[i] and alive[j]) or version_i != versions[i] or version_j != versions[j]:
+                # stale
+                continue
             bid1 = bidList[i]
             bid2 = bidList[j]
             should_merge = False
 
             # test if the mer dist is teensy tiny.
             # this is a time saver...
-            k_diff = np_median(cdist(self.PM.kmerPCs[self.BM.bins[bid1].rowIndices], self.PM.kmerPCs[self.BM.bins[bid2].rowIndices], 'cityblock'))
+            k_diff = self.kDistBetweenBins(self.BM.bins[bid1], self.BM.bins[bid2])
 
             #if VVB:
             #    print bid1, bid2, k_diff,
@@ -960,13 +963,13 @@ class RefineEngine:
                 try:
                     c1 = raw_coverage_centroids[bid1]
                 except KeyError:
-                    c1 = np_mean([self.PM.covProfiles[row_index] for row_index in self.BM.bins[bid1].rowIndices], axis=0)
+                    c1 = np_mean(self.PM.covProfiles[self.BM.bins[bid1].rowIndices], axis=0)
                     raw_coverage_centroids[bid1] = c1
 
                 try:
                     c2 = raw_coverage_centroids[bid2]
                 except KeyError:
-                    c2 = np_mean([self.PM.covProfiles[row_index] for row_index in self.BM.bins[bid2].rowIndices], axis=0)
+                    c2 = np_mean(self.PM.covProfiles[self.BM.bins[bid2].rowIndices], axis=0)
                     raw_coverage_centroids[bid2] = c2
                 try:
                     ang = np_arccos(np_dot(c1,c2) / np_norm(c1) / np_norm(c2))
@@ -999,27 +1002,99 @@ class RefineEngine:
 
                 # we use the weighted average of the two previous pca positions
                 # to determine where the newly merged bin should reside
-                bin_mer_PCAs[i] = (bin_mer_PCAs[i] * b1_size + bin_mer_PCAs[j] * b2_size) / (b1_size + b2_size)
+                bin_mer_PCAs[i] *= b1_size
+                bin_mer_PCAs[i] += bin_mer_PCAs[j] * b2_size
+                bin_mer_PCAs[i] /= (b1_size + b2_size)
                 raw_coverage_centroids[bid1] = (raw_coverage_centroids[bid1] * b1_size + raw_coverage_centroids[bid2] * b2_size) / (b1_size + b2_size)
 
+                # j is gone and all of i's old distances are out of date
+                alive[j] = False
+                versions[i] += 1
+
                 # re-calc the distances
-                new_dists = cdist([bin_mer_PCAs[i]], bin_mer_PCAs, 'cityblock')
-
-                # we need to fix the distance matrix
-                sq_dists[j,:] = too_big
-                sq_dists[:,j] = too_big
-                sq_dists[j,j] = 0.0
-                sq_dists[i,:] = np_where(sq_dists[i,:] == too_big, sq_dists[i,:], new_dists)
-                sq_dists[:,i] = np_where(sq_dists[:,i] == too_big, sq_dists[:,i], new_dists)
-                dists = squareform(sq_dists)
+                new_dists = cdist([bin_mer_PCAs[i]], bin_mer_PCAs, 'cityblock')[0]
+                for k in range(side):
+                    if k == i or not alive[k]:
+                        continue
+                    key = (min(i, k), max(i, k))
+                    if key in rejected:
+                        continue
+                    heappush(pair_heap, (new_dists[k], key[0], key[1], versions[key[0]], versions[key[1]]))
             else:
                 # we won't check this again
-                sq_dists[i,j] = too_big
-                sq_dists[j,i] = too_big
-                dists = squareform(sq_dists)
+                rejected[(i, j)] = True
 
         return merged_bids
 
+    def getSOMClassifier(self, timer, silent=False):
+        """Load a SOM classifier from the DB, or build (and save) a new one
+
+        The stored SOM is only reused when it was trained on exactly
+        the same bin assignments as we have now. It doesn't matter which
+        contigs are loaded, the returned minz and maxz map whatever we
+        have loaded into the space the SOM was trained in
+        """
+        bin_hash = self.makeBinHash()
+        pc1_bounds = self.PM.getKmerPC1Bounds()
+        stored = self.PM.getSOMClassifier()
+        if stored is not None and stored[0] == bin_hash and stored[6] is not None:
+            if not silent:
+                print "    Using stored SOM classifier"
+            (bin_hash, weights, bin_assignments, boundary_mask, minz, maxz, trained_bounds) = stored
+            som_side = len(weights)
+            SS = SOM(som_side, SOMDIM)
+            SS.loadWeights(weights)
+            SS.weights.fixFlatNodes()
+            SS.binAssignments = bin_assignments
+            SS.boundaryMask = boundary_mask
+            (minz, maxz) = self.movePC1Normalisation(minz, maxz, trained_bounds, pc1_bounds)
+            return (SS, minz, maxz, som_side)
+
+        (SS, minz, maxz, som_side) = self.buildSOM(timer,
+                                                   maskBoundaries=True,
+                                                   defineBins=True,
+                                                   retrain=True,
+                                                   silent=silent)
+        self.PM.setSOMClassifier(bin_hash,
+                                 SS.weights.nodes,
+                                 SS.binAssignments,
+                                 SS.boundaryMask,
+                                 minz,
+                                 maxz,
+                                 pc1_bounds)
+        return (SS, minz, maxz, som_side)
+
+    def movePC1Normalisation(self, minz, maxz, trainedBounds, loadedBounds):
+        """Fold a change of kmerNormPC1 bounds into the last dimension of minz / maxz
+
+        kmerNormPC1 is normalised over the loaded contigs. A SOM trained when a
+        different set was loaded (refine vs recruit) saw PC1 scaled by
+        trainedBounds, so (kmerNormPC1 - minz) / maxz has to put it back there
+        """
+        (trained_lower, trained_upper) = trainedBounds
+        (loaded_lower, loaded_upper) = loadedBounds
+        scale = (trained_upper - trained_lower) / (loaded_upper - loaded_lower)
+        minz = np_copy(minz)
+        maxz = np_copy(maxz)
+        minz[-1] = (trained_lower + minz[-1] * (trained_upper - trained_lower) - loaded_lower) / (loaded_upper - loaded_lower)
+        maxz[-1] *= scale
+        return (minz, maxz)
+
+    def makeBinHash(self):
+        """Make a hash which identifies the current bin assignments
+
+        Only the bin membership and whether the coverage was transformed go in.
+        The kmerNormPC1 bounds the SOM was trained with are stored alongside it
+        instead, so refine and recruit (which load different contigs) can share
+        """
+        bin_hash = hashlib.md5()
+        bin_hash.update("transform=%s" % self.transform)
+        for bid in sorted(self.BM.getBids()):
+            members = np_sort(self.PM.indices[self.BM.bins[bid].rowIndices])
+            bin_hash.update(np_array([bid, len(members)], dtype='int64').tostring())
+            bin_hash.update(np_array(members, dtype='int64').tostring())
+        return bin_hash.hexdigest()
+
     def buildSOM(self,
                  timer,
                  maskBoundaries=False,
@@ -1027,8 +1102,12 @@ class RefineEngine:
                  retrain=False,
                  render=False,
                  silent=False,
-                 animateFilePrefix=""):
-        """Build, train and return a SOM for the given bids"""
+                 animateFilePrefix="",
+                 threads=None):
+        """Build, train and return a SOM for the given bids
+
+        set threads > 1 to retrain bin regions in parallel
+        """
         # produce the actual training data
         # this is the bin centroid values
         bids = self.BM.getBids()
@@ -1103,18 +1182,61 @@ class RefineEngine:
             # retrain bin regions using contigs from the bin
             if not silent:
                 print "    Retraining SOM classifier"
-            for i in range(len(bids)):
-                bid = bids[i]
-                sys_stdout.write("\r    Retraining on bin: %d (%d of %d)" % (bid, i+1, len(bids)))
-                sys_stdout.flush()
-                self.retrainSOM(SS,
-                                bid,
-                                SS.makeBinMask(training_data[i]),
-                                som_side,
-                                minz,
-                                maxz,
-                                silent=silent,
-                                render=render)
+            if threads is None:
+                threads = self.threads
+            if threads > 1 and not render:
+                # each bin only touches its own flood filled region of the
+                # torus so we can train them all at once. The masks are all
+                # made from the untrained SOM, so a node claimed by one bin is
+                # left out of every later mask. Otherwise a later bin's patch,
+                # trained from stale weights, would overwrite it. NOTE: the
+                # serial path makes each mask after the earlier bins have been
+                # applied, so the two can give slightly different SOMs
+                claimed = np_zeros((som_side, som_side), dtype=bool)
+                jobs = []
+                for i in range(len(bids)):
+                    bid = bids[i]
+                    (mask_rows, mask_cols) = SS.makeBinMask(training_data[i])
+                    free = np_logical_not(claimed[mask_rows, mask_cols])
+                    mask_points = (mask_rows[free], mask_cols[free])
+                    if len(mask_points[0]) == 0:
+                        # nothing left for this guy
+                        continue
+                    claimed[mask_points] = True
+                    jobs.append((bid,
+                                 mask_points,
+                                 self.makeRetrainJob(SS,
+                                                     bid,
+                                                     mask_points,
+                                                     minz,
+                                                     maxz)))
+                pool = Pool(threads)
+                try:
+                    patches = pool.imap(trainSOMPatch, [job for (bid, mask_points, job) in jobs])
+                    for i in range(len(jobs)):
+                        sweights = patches.next()
+                        sys_stdout.write("\r    Retrained bin: %d (%d of %d)" % (jobs[i][0], i+1, len(jobs)))
+                        sys_stdout.flush()
+                        self.applySOMPatch(SS, jobs[i][1], sweights)
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                for i in range(len(bids)):
+                    bid = bids[i]
+                    sys_stdout.write("\r    Retraining on bin: %d (%d of %d)" % (bid, i+1, len(bids)))
+                    sys_stdout.flush()
+                    self.retrainSOM(SS,
+                                    bid,
+                                    SS.makeBinMask(training_data[i]),
+                                    som_side,
+                                    minz,
+                                    maxz,
+                                    silent=silent,
+                                    render=render)
             if render:
                 SS.renderWeights("gg")
             print "    --"
@@ -1135,6 +1257,26 @@ class RefineEngine:
                    silent=False,
                    render=False):
         """Further training of a SOM built using bin means"""
+        sweights = trainSOMPatch(self.makeRetrainJob(SS,
+                                                     bid,
+                                                     maskPoints,
+                                                     minz,
+                                                     maxz))
+        self.applySOMPatch(SS, maskPoints, sweights)
+
+        if render:
+            SS.renderWeights("S_%d"%bid)
+
+    def makeRetrainJob(self,
+                       SS,
+                       bid,
+                       maskPoints,
+                       minz,
+                       maxz):
+        """Cut out the patch of SOM weights covering this bin's region
+
+        Returns everything trainSOMPatch needs to retrain the patch
+        """
         bin = self.BM.bins[bid]
 
         # make a training set of just this node's contigs
@@ -1148,40 +1290,30 @@ class RefineEngine:
 
         # now we'd like to centre the weights and mask within an
         # appropriately sized square
-        min_p = np_min(maskPoints.keys(), axis=0)
-        max_p = np_max(maskPoints.keys(), axis=0)
+        (mask_rows, mask_cols) = maskPoints
+        min_p = np_array([np_min(mask_rows), np_min(mask_cols)])
+        max_p = np_array([np_max(mask_rows), np_max(mask_cols)])
         diffs = max_p - min_p
         small_side = np_min(diffs)
         sweights = np_copy(SS.weights.nodes[min_p[0]:min_p[0]+diffs[0]+1,min_p[1]:min_p[1]+diffs[1]+1])
         #SS.weights.renderSurface("C_%d.png"%bid, nodes=sweights)
 
         # shift and mask out all other bins
-        shifted_mask_points = {}
+        shifted_mask_points = (mask_rows - min_p[0], mask_cols - min_p[1])
         shifted_bin_mask = np_ones((diffs[0]+1,diffs[1]+1))
-        for (r,c) in maskPoints.keys():
-            shift = maskPoints[(r,c)] - min_p
-            shifted_bin_mask[shift[0],shift[1]] = 0
-            shifted_mask_points[(shift[0], shift[1])] = shift
+        shifted_bin_mask[shifted_mask_points] = 0
         SS.maskBoundaries(weights=sweights, mask=shifted_bin_mask)
 
-        # train on the set of dummy weights
-        sweights = SS.train(block,
-                            weights=sweights,
-                            iterations=50,
-                            mask=shifted_mask_points,
-                            radius=small_side/3,
-                            influenceRate=0.1)
+        return (block, sweights, shifted_mask_points, small_side, SS.radius)
 
-        #SS.weights.renderSurface("D_%d.png"%bid, nodes=sweights)
+    def applySOMPatch(self, SS, maskPoints, sweights):
+        """Write a retrained patch back onto the torus"""
+        (mask_rows, mask_cols) = maskPoints
         # update the torusMesh values appropriately
-        for (r,c) in maskPoints.keys():
-            shift = maskPoints[(r,c)] - min_p
-            SS.weights.nodes[r,c] = sweights[shift[0], shift[1]]
+        SS.weights.nodes[mask_rows, mask_cols] = sweights[mask_rows - np_min(mask_rows),
+                                                          mask_cols - np_min(mask_cols)]
         SS.weights.fixFlatNodes()
 
-        if render:
-            SS.renderWeights("S_%d"%bid)
-
 
     def shuffleRefineContigs(self, timer, inclusivity=2):
         """refine bins by shuffling contigs around"""
@@ -1193,10 +1325,7 @@ class RefineEngine:
         for bid in bids:
             bin_c_lengths[bid] = [self.PM.contigLengths[row_index] for row_index in self.BM.bins[bid].rowIndices]
 
-        (SS, minz, maxz, side) = self.buildSOM(timer,
-                                               maskBoundaries=True,
-                                               defineBins=True,
-                                               retrain=True)
+        (SS, minz, maxz, side) = self.getSOMClassifier(timer)
 
         print "    %s" % timer.getTimeStamp()
 
@@ -1361,11 +1490,19 @@ class RefineEngine:
               doBoth=False,
               doContigs=False,
               addZeros=False,
-              addOnes=False):
+              addOnes=False,
+              method='incremental'):
         """Re-calculate PCA coords for a collection of bins
 
         mode may be 'mer', 'cov' or 'trans'
 
+        method may be:
+        'svd'         - full SVD of the whole (centered) signal
+        'truncated'   - randomized SVD for just the top 2 components
+        'incremental' - update a running PCA with the contigs which have
+                        come or gone since the last call (exact, and cheap
+                        when only a handful of bins change)
+
         If do contigs is set then it returns a n X 2 array
         of PC1, PC2 for all contigs in all bins in bidList
         The ordering is bidList -> rowIndices.
@@ -1382,10 +1519,7 @@ class RefineEngine:
         addOnes adds a ones vector as the second last entry.
         addOnes implies addZeros
         """
-        signal = []
-        both_tmp = {}
         both_ret = {}
-        num_ss = 0
         if mode == 'mer':
             data = self.PM.kmerSigs
         elif mode == 'cov':
@@ -1395,37 +1529,34 @@ class RefineEngine:
         else:
             raise ge.ModeNotAppropriateException("Invlaid mode " + type)
 
-        pc_len = len(data[self.BM.bins[bidList[0]].rowIndices[0]])
-        if doBoth:
-            # the eventual goal is to produce a dict of RI -> kPCA
-            # we just need to shuffle things about for a second here...
-            for bid in bidList:
-                for row_index in self.BM.bins[bid].rowIndices:
-                    signal.append(data[row_index])
-                    both_tmp[num_ss] = row_index
-                    num_ss += 1
-        else:
-            for bid in bidList:
-                for row_index in self.BM.bins[bid].rowIndices:
-                    signal.append(data[row_index])
-                    num_ss += 1
+        pc_len = np_shape(data)[1]
+        # the eventual goal is to produce a dict of RI -> kPCA
+        row_indices = np_concatenate([self.BM.bins[bid].rowIndices for bid in bidList])
+        signal = [data[np_array(row_indices, dtype=int)]]
+        # keys for the running PCA, fake rows get negative keys
+        keys = list(self.PM.indices[np_array(row_indices, dtype=int)])
 
         if addOnes:
             addZeros = True
-            signal.append(np_ones(pc_len))
-            num_ss += 1
+            signal.append(np_ones((1, pc_len)))
+            keys.append(-1)
 
         if addZeros:
-            signal.append(np_zeros(pc_len))
-            num_ss += 1
-
-        signal = np_reshape(signal, (num_ss, pc_len))
+            signal.append(np_zeros((1, pc_len)))
+            keys.append(-2)
 
+        signal = np_concatenate(signal)
+        num_ss = len(signal)
 
         # do the PCA analysis
-        Center(signal,verbose=0)
-        p = PCA(signal)
-        components = p.pc()
+        if method == 'svd':
+            Center(signal,verbose=0)
+            p = PCA(signal)
+            components = p.pc()
+        elif method == 'truncated':
+            components = TruncatedPCA(signal, k=2).pc()
+        else:
+            components = self.updateIncrementalPCA(mode, data, keys, signal).project(signal)
 
         # now make the color profile based on PC1
         PC1 = np_array([float(i) for i in components[:,0]])
@@ -1442,8 +1573,8 @@ class RefineEngine:
                               (num_ss,2))
         if doBoth:
             # make the actual return dict
-            for i in range(num_ss):
-                both_ret[both_tmp[i]] = np_array([PC1[i], PC2[i]])
+            for i in range(len(row_indices)):
+                both_ret[row_indices[i]] = np_array([PC1[i], PC2[i]])
 
         # else work out the average for each bin
         ml_2d = np_array([])
@@ -1476,6 +1607,53 @@ class RefineEngine:
                 return (np_reshape(ml_2d, (len(bidList),2)), both_ret)
             return np_reshape(ml_2d, (len(bidList),2))
 
+    def updateIncrementalPCA(self, mode, data, keys, signal):
+        """Bring the running PCA for this mode into line with the rows of signal
+
+        keys holds the global index of each row in signal (negative for fake rows).
+        Rows which have come or gone since last time are added to or taken
+        from the running sums, everything else is left alone
+        """
+        try:
+            (old_keys, IP) = self.rePCAStates[mode]
+        except KeyError:
+            (old_keys, IP) = (np_array([], dtype=int), None)
+
+        new_keys = np_array(keys, dtype=int)
+        added = np_nonzero(~np_in1d(new_keys, old_keys))[0]
+        gone = old_keys[~np_in1d(old_keys, new_keys)]
+
+        gone_rows = []
+        if IP is not None and len(gone) > 0:
+            # we need the old values to take them away
+            pc_len = np_shape(data)[1]
+            if -1 in gone:
+                gone_rows.append(np_ones((1, pc_len)))
+            if -2 in gone:
+                gone_rows.append(np_zeros((1, pc_len)))
+            # PM.indices is sorted so we can look the real rows up directly
+            gone_real = gone[gone >= 0]
+            gone_row_indices = np_searchsorted(self.PM.indices, gone_real)
+            in_range = gone_row_indices < len(self.PM.indices)
+            if not in_range.all() or (self.PM.indices[gone_row_indices] != gone_real).any():
+                # some of these contigs have been unloaded, start again
+                IP = None
+            else:
+                gone_rows.append(data[gone_row_indices])
+
+        if IP is None or len(added) + len(gone) >= len(keys):
+            # cheaper to start from scratch
+            IP = IncrementalPCA(np_shape(signal)[1])
+            IP.add(signal)
+        else:
+            if len(gone_rows) > 0:
+                IP.remove(np_concatenate(gone_rows))
+            if len(added) > 0:
+                IP.add(signal[added])
+
+        self.rePCAStates[mode] = (new_keys, IP)
+        return IP.fit()
+
     def getKCut(self):
         """Work out the easy cutoff for kmerVal distance"""
         median_k_vals = []
@@ -1488,65 +1666,75 @@ class RefineEngine:
         return np_median(median_k_vals), np_std(median_k_vals)
 
     def kDist(self, row_indices):
-        bin_k_vals = self.PM.kmerPCs[row_indices]
-        k_dist = pdist(bin_k_vals, 'cityblock')
-        if len(k_dist) > 0:
-            return np_median(k_dist)
-
-        return None
+        # None if there are less than two contigs
+        return medianPdist(self.PM.kmerPCs[row_indices], 'cityblock')
 
     def kDistMergedBins(self, bin1, bin2):
         merged_indices = np_concatenate((bin1.rowIndices, bin2.rowIndices))
         return self.kDist(merged_indices)
 
     def kDistBetweenBins(self, bin1, bin2):
-        return np_median(cdist(self.PM.kmerPCs[bin1.rowIndices], self.PM.kmerPCs[bin2.rowIndices], 'cityblock'))
+        return medianCdist(self.PM.kmerPCs[bin1.rowIndices], self.PM.kmerPCs[bin2.rowIndices], 'cityblock')
 
     def getEvenlySpacedPtsZ(self, row_indices, sample_size):
         # select samples evenly along Z-axis of coverage space
         # (this makes the program deterministic while getting a good 'random' spread of points)
         sorted_indices = np_argsort(self.PM.transformedCP[row_indices, -1])
         step_size = float(len(row_indices)) / sample_size
-        si = []
-        index = 0.0
-        for _i in xrange(0, sample_size):
-            si.append(row_indices[sorted_indices[int(index)]])
-            index += step_size
+        # accumulate the steps one at a time so we land on exactly the same points
+        steps = np_zeros(sample_size)
+        steps[1:] = step_size
+        si = np_array(row_indices)[sorted_indices[np_cumsum(steps).astype(int)]]
+
+        return si
 
+    def getBinSamplePts(self, bin, maxInBin=100):
+        """Evenly spaced sample of the row indices in a bin
+
+        Samples are cached per bin and reused until the bin changes
+        """
+        if len(bin.rowIndices) <= maxInBin:
+            return bin.rowIndices
+        try:
+            (row_indices, si) = self.binSamples[(bin.id, maxInBin)]
+            if row_indices is bin.rowIndices:
+                return si
+        except KeyError:
+            pass
+        si = self.getEvenlySpacedPtsZ(bin.rowIndices, maxInBin)
+        self.binSamples[(bin.id, maxInBin)] = (bin.rowIndices, si)
         return si
 
+    def getUnitCoverages(self, row_indices):
+        """Coverage profiles scaled to unit length"""
+        norms = np_reshape(self.PM.normCoverages[row_indices], (len(row_indices), 1))
+        return self.PM.covProfiles[row_indices] / norms
+
     def getCCut(self):
         """Work out the easy cutoff for coverage angle difference"""
         median_angles = []
         for bid in self.BM.getNonChimericBinIds():
-            if len(self.BM.getBin(bid).rowIndices) > 1:
-                cdistance = self.cDist(self.BM.getBin(bid).rowIndices)
+            bin = self.BM.getBin(bid)
+            if len(bin.rowIndices) > 1:
+                cdistance = self.cDist(bin.rowIndices, sampleIndices=self.getBinSamplePts(bin))
                 median_angles.append(cdistance)
 
         return np_median(median_angles), np_std(median_angles)
 
-    def cDist(self, row_indices):
+    def cDist(self, row_indices, sampleIndices=None):
         max_in_bin = 100
 
-        if len(row_indices) > max_in_bin:
-            sample_size = max_in_bin
+        if sampleIndices is not None:
+            si = sampleIndices
+        elif len(row_indices) > max_in_bin:
             si = self.getEvenlySpacedPtsZ(row_indices, max_in_bin)
         else:
-            sample_size = len(row_indices)
             si = row_indices
 
-        # select a few at random
-        angles = []
-        for i in range(sample_size):
-            for j in range(i+1, sample_size):
-                r1 = si[i]
-                r2 = si[j]
-                try:
-                    ang = np_arccos(np_dot(self.PM.covProfiles[r1],self.PM.covProfiles[r2]) /
-                                             (self.PM.normCoverages[r1]*self.PM.normCoverages[r2]))
-                    angles.append(ang)
-                except FloatingPointError:
-                    pass
+        # angles between every pair of sampled contigs
+        unit_covs = self.getUnitCoverages(si)
+        cos_angles = np_clip(np_dot(unit_covs, unit_covs.T), -1., 1.)
+        angles = np_arccos(cos_angles[np_triu_indices(len(si), 1)])
 
         return np_median(angles)
 
@@ -1555,32 +1743,15 @@ class RefineEngine:
         return self.cDist(merged_indices)
 
     def cDistBetweenBins(self, bin1, bin2):
-        max_in_bin = 100
-
-        if len(bin1.rowIndices) > max_in_bin:
-            indices1 = self.getEvenlySpacedPtsZ(bin1.rowIndices, max_in_bin)
-        else:
-            indices1 = bin1.rowIndices
-
-        if len(bin2.rowIndices) > max_in_bin:
-            indices2 = self.getEvenlySpacedPtsZ(bin2.rowIndices, max_in_bin)
-        else:
-            indices2 = bin2.rowIndices
+        indices1 = self.getBinSamplePts(bin1)
+        indices2 = self.getBinSamplePts(bin2)
 
-        angles = []
-        for i in xrange(0, min(len(bin1.rowIndices), max_in_bin)):
-            r1 = indices1[i]
+        cos_angles = np_clip(np_dot(self.getUnitCoverages(indices1),
+                                    self.getUnitCoverages(indices2).T),
+                             -1.,
+                             1.)
 
-            for j in xrange(0, min(len(bin2.rowIndices), max_in_bin)):
-                r2 = indices2[j]
-                try:
-                    ang = np_arccos(np_dot(self.PM.covProfiles[r1], self.PM.covProfiles[r2]) /
-                                             (self.PM.normCoverages[r1]*self.PM.normCoverages[r2]))
-                    angles.append(ang)
-                except FloatingPointError:
-                    pass
-
-        return np_median(angles)
+        return np_median(np_arccos(cos_angles))
 
 #-----------------------------
 # MERGE TESTING BASED ON KMERS
@@ -1591,160 +1762,154 @@ class RefineEngine:
                      merPCAs,
                      maxSample = 200,
                      confidence=0.97,
-                     verbose=False):
-        """Determine if a merge makes sense in mer land"""
-        null_loops = 99
+                     verbose=False,
+                     seed=0):
+        """Determine if a merge makes sense in mer land
+
+        merPCAs is a dict (or array) of row index => kmer PCA coords
+        """
         front_RIs = self.BM.bins[bid1].rowIndices
         rear_RIs = self.BM.bins[bid2].rowIndices
+        points = np_array([merPCAs[row_index] for row_index in np_concatenate([front_RIs, rear_RIs])])
 
-        front_RIs_size = len(front_RIs)
-        rear_RIs_size = len(rear_RIs)
-
-        # generate a NULL distribution of alpha splits
-        x = np_concatenate([front_RIs, rear_RIs])
-        shuffle(x)
-        x_size = len(x)
+        return self.permutationTest(len(front_RIs),
+                                    len(rear_RIs),
+                                    lambda I1, I2: np_sum(np_abs(points[I1] - points[I2]), axis=-1),
+                                    np_shape(points)[1],
+                                    maxSample=maxSample,
+                                    confidence=confidence,
+                                    seed=seed)
 
-        # sub sample the total space
-        if maxSample != 0:
-            front_sample_size = np_min([maxSample, front_RIs_size])
-            rear_sample_size = np_min([maxSample, rear_RIs_size])
-        else:
-            front_sample_size = front_RIs_size
-            rear_sample_size = rear_RIs_size
+#-----------------------------
+# MERGE TESTING BASED ON COVERAGE
 
-        # we do different things here depending on the size of the samples
-        if front_sample_size < 64:
-            # We should brute force this guy
-            F_funct = self.calculateMerAlphaPart
-        else:
-            # take a sampling approach
-            F_funct = self.calculateMerAlphaPartSampleNoSame
+    def testMergeCoverage(self,
+                          bid1,
+                          bid2,
+                          maxSample = 200,
+                          confidence=0.97,
+                          verbose=False,
+                          seed=0):
+        """Determine if a merge based on kmer PCAs makes sense in coverage land
 
-        if rear_sample_size < 64:
-            R_funct = self.calculateMerAlphaPart
-        else:
-            R_funct = self.calculateMerAlphaPartSampleNoSame
+        Calculates a t-score which measures the coverage separation of the two groups
+        Higher t-scores indicate greater separation between the groups.
+        """
+        front_RIs = self.BM.bins[bid1].rowIndices
+        rear_RIs = self.BM.bins[bid2].rowIndices
+        row_indices = np_array(np_concatenate([front_RIs, rear_RIs]), dtype=int)
+        covs = self.PM.covProfiles[row_indices]
+        # flat, so the norm products line up with the dot products
+        norms = np_ravel(self.PM.normCoverages[row_indices])
+
+        return self.permutationTest(len(front_RIs),
+                                    len(rear_RIs),
+                                    lambda I1, I2: self.covAngles(covs[I1], covs[I2], norms[I1]*norms[I2]),
+                                    np_shape(covs)[1],
+                                    maxSample=maxSample,
+                                    confidence=confidence,
+                                    seed=seed)
+
+    def covAngles(self, C1, C2, normProducts):
+        """Angles between pairs of coverage profiles
+
+        Pairs we can't work out an angle for (zero coverage or
+        rounding error) are given an angle of 0
+        """
+        dots = np_sum(C1 * C2, axis=-1)
+        ok = normProducts > 0
+        cos_angles = dots / np_where(ok, normProducts, 1.)
+        ok &= (cos_angles >= -1.) & (cos_angles <= 1.)
+        return np_where(ok, np_arccos(np_where(ok, cos_angles, 1.)), 0.)
 
-        if front_sample_size * rear_sample_size < 2000:
-            C_funct = self.calculateMerAlphaPart
-        else:
-            C_funct = self.calculateMerAlphaPartSample
+#-----------------------------
+# PERMUTATION TESTING
+
+    def permutationTest(self,
+                        numFront,
+                        numRear,
+                        pairDists,
+                        dim,
+                        maxSample=200,
+                        confidence=0.97,
+                        nullLoops=99,
+                        seed=0):
+        """Compare a split of some points with random splits of the same points
+
+        The first numFront points are one side of the split, the next numRear are
+        the other. pairDists(I1, I2) returns the distances between the points at
+        the (equally shaped) index arrays I1 and I2, dim is the dimension of the points
+
+        Calculates t = INTER_DIST / (INTRA_FRONT_DIST + INTRA_REAR_DIST) for the
+        given split and for nullLoops random splits. All the splits are drawn at
+        once and each part is worked out for all of them together. Seeded, so we
+        get the same answer every time
+
+        returns (test t-score, null t-score at confidence)
+        """
+        RS = RandomState(seed)
+        x_size = numFront + numRear
 
-        merAlphas={}
-        # test the given split against it
+        # sub sample the total space
         if maxSample != 0:
-            shuffle(front_RIs)
-            shuffle(rear_RIs)
-            FRI = front_RIs[:front_sample_size]
-            RRI = rear_RIs[:rear_sample_size]
+            front_sample_size = np_min([maxSample, numFront])
+            rear_sample_size = np_min([maxSample, numRear])
         else:
-            FRI = front_RIs
-            RRI = rear_RIs
-        test_T_score = C_funct(FRI,RRI,merPCAs,merAlphas) / ( F_funct(FRI,FRI,merPCAs,merAlphas) + R_funct(RRI,RRI,merPCAs,merAlphas))
-
-        T_scores = []
-        index_array = np_arange(x_size)
-        fsi = np_arange(front_sample_size)
-        rsi = np_arange(front_sample_size, front_sample_size+rear_sample_size)
-        for i in range(null_loops):
-            # select two sets of bins at random
-            shuffle(index_array)
-            FRI = x[index_array[fsi]]
-            RRI = x[index_array[rsi]]
-            T_scores.append(C_funct(FRI,RRI,merPCAs,merAlphas) / ( F_funct(FRI,FRI,merPCAs,merAlphas) + R_funct(RRI,RRI,merPCAs,merAlphas)))
-
-        T_scores = sorted(T_scores)
-        index = int(np_around(float(null_loops+1)*confidence))
-
-        return (test_T_score, T_scores[index])
-
-    def calculateMerAlphaPartSampleNoSame(self, RI1, RI2, profile, alphas, sampleSize=2000):
-        """Calculate one part of an alpha score
-
-        Subsample of all vs all, assumes RI1 == RI2"""
-        lr1 = len(RI1)
-        lr2 = len(RI2)
-        score = 0.0
-        samples_selected = {}
-        num_samples_complete = 0
-        while num_samples_complete < sampleSize:
-            combo = (randint(lr1), randint(lr2))
-            while (combo in samples_selected) or (combo[0] == combo[1]):
-                combo = (randint(lr1), randint(lr2))
-            samples_selected[combo] = True
-            r1 = RI1[combo[0]]
-            r2 = RI2[combo[1]]
-            num_samples_complete += 1
-            try:
-                # try to pull the value out
-                score += alphas[(r1,r2)]
-            except KeyError:
-                try:
-                    # try to pull the value out
-                    score += alphas[(r1,r2)]
-                except KeyError:
-                    # calculate it if it's not there...
-                    # inline this because we call it alot!
-                    dist = np_sum(np_abs(profile[r1] - profile[r2]))
-                    alphas[(r1,r2)] = dist
-                    score += dist
-        return score / sampleSize
+            front_sample_size = numFront
+            rear_sample_size = numRear
+        split_size = front_sample_size + rear_sample_size
+
+        # row 0 is the given split, every other row is a null split
+        splits = np_zeros((nullLoops+1, split_size), dtype=int)
+        splits[0,:front_sample_size] = RS.permutation(numFront)[:front_sample_size]
+        splits[0,front_sample_size:] = numFront + RS.permutation(numRear)[:rear_sample_size]
+        splits[1:] = np_argsort(RS.random_sample((nullLoops, x_size)), axis=1)[:,:split_size]
+        FRI = splits[:,:front_sample_size]
+        RRI = splits[:,front_sample_size:]
 
-    def calculateMerAlphaPartSample(self, RI1, RI2, profile, alphas, sampleSize=2000):
-        """Calculate one part of an alpha score
+        # we do different things here depending on the size of the samples
+        # small sets are brute forced, big ones are sampled
+        inters = self.meanPairDists(FRI, RRI, pairDists, dim, RS, allPairs=(front_sample_size * rear_sample_size < 2000))
+        front_intras = self.meanPairDists(FRI, FRI, pairDists, dim, RS, allPairs=(front_sample_size < 64), same=True)
+        rear_intras = self.meanPairDists(RRI, RRI, pairDists, dim, RS, allPairs=(rear_sample_size < 64), same=True)
+        T_scores = inters / (front_intras + rear_intras)
 
-        Subsample of all vs all, assumes RI1 != RI2
-        """
-        lr1 = len(RI1)
-        lr2 = len(RI2)
-        score = 0.0
-        samples_selected = {}
-        num_samples_complete = 0
-        while num_samples_complete < sampleSize:
-            combo = (randint(lr1), randint(lr2))
-            while combo in samples_selected:
-                combo = (randint(lr1), randint(lr2))
-            samples_selected[combo] = True
-            r1 = RI1[combo[0]]
-            r2 = RI2[combo[1]]
-            num_samples_complete += 1
-            try:
-                # try to pull the value out
-                score += alphas[(r1,r2)]
-            except KeyError:
-                try:
-                    # try to pull the value out
-                    score += alphas[(r1,r2)]
-                except KeyError:
-                    # calculate it if it's not there...
-                    # inline this because we call it alot!
-                    dist = np_sum(np_abs(profile[r1] - profile[r2]))
-                    alphas[(r1,r2)] = dist
-                    score += dist
-        return score / sampleSize
+        index = int(np_around(float(nullLoops+1)*confidence))
+        return (T_scores[0], np_sort(T_scores[1:])[index])
 
-    def calculateMerAlphaPart(self, RI1, RI2, profile, alphas):
-        """Calculate one part of an alpha score
+    def meanPairDists(self, RI1, RI2, pairDists, dim, RS, allPairs=False, same=False, sampleSize=2000):
+        """Mean distance between the points in each row of RI1 and the points in the same row of RI2
 
-        All vs all complete
+        If allPairs is set we use all vs all, otherwise sampleSize random pairs
+        per row. Set same when RI1 is RI2 so sampled pairs never match a point
+        with itself
         """
-        lr1 = len(RI1)
-        lr2 = len(RI2)
-        score = 0.0
-        for r1 in RI1:
-            for r2 in RI2:
-                try:
-                    score += alphas[(r1,r2)]
-                except KeyError:
-                    try:
-                        score += alphas[(r2,r1)]
-                    except KeyError:
-                        dist = np_sum(np_abs(profile[r1] - profile[r2]))
-                        alphas[(r1,r2)] = dist
-                        score += dist
-        return score / (lr1*lr2)
-
+        (num_rows, n1) = np_shape(RI1)
+        n2 = np_shape(RI2)[1]
+        if allPairs:
+            I1 = RI1[:,:,np_newaxis]
+            I2 = RI2[:,np_newaxis,:]
+            width = n1 * n2
+        else:
+            rows = np_arange(num_rows)[:,np_newaxis]
+            c1 = RS.randint(n1, size=(num_rows, sampleSize))
+            if same:
+                # skip over the diagonal
+                c2 = RS.randint(n2-1, size=(num_rows, sampleSize))
+                c2 += (c2 >= c1)
+            else:
+                c2 = RS.randint(n2, size=(num_rows, sampleSize))
+            I1 = RI1[rows, c1]
+            I2 = RI2[rows, c2]
+            width = sampleSize
+
+        # work through the rows in blocks so memory stays in check
+        block_size = max(1, DIST_BUDGET / (width * dim))
+        means = np_zeros(num_rows)
+        for start in range(0, num_rows, block_size):
+            dists = pairDists(I1[start:start+block_size], I2[start:start+block_size])
+            means[start:start+block_size] = np_mean(np_reshape(dists, (len(dists), -1)), axis=1)
+        return means
 
     def calculateMerAlphaTScore(self, RI1, RI2, profile, alphas):
         """Measure the goodness of the separation into lists
@@ -1800,187 +1965,6 @@ class RefineEngine:
         inters /= (lr1*lr2)
         return inters/(R1_intras + R2_intras)
 
-
-#-----------------------------
-# MERGE TESTING BASED ON COVERAGE
-
-    def testMergeCoverage(self,
-                          bid1,
-                          bid2,
-                          maxSample = 200,
-                          confidence=0.97,
-                          verbose=False):
-        """Determine if a merge based on kmer PCAs makes sense in coverage land
-
-        Calculates a t-score which measures the coverage separation of the two groups
-        Higher t-scores indicate greater separation between the groups.
-        """
-        null_loops = 99
-        front_RIs = self.BM.bins[bid1].rowIndices
-        rear_RIs = self.BM.bins[bid2].rowIndices
-
-        front_RIs_size = len(front_RIs)
-        rear_RIs_size = len(rear_RIs)
-
-        # generate a NULL distribution of alpha splits
-        x = np_concatenate([front_RIs, rear_RIs])
-        shuffle(x)
-        x_size = len(x)
-
-        # sub sample the total space
-        if maxSample != 0:
-            front_sample_size = np_min([maxSample, front_RIs_size])
-            rear_sample_size = np_min([maxSample, rear_RIs_size])
-        else:
-            front_sample_size = front_RIs_size
-            rear_sample_size = rear_RIs_size
-
-        # we do different things here depending on the size of the samples
-        if front_sample_size < 64:
-            # We should brute force this guy
-            F_funct = self.calculateCovAlphaPart
-        else:
-            # take a sampling approach
-            F_funct = self.calculateCovAlphaPartSampleNoSame
-
-        if rear_sample_size < 64:
-            R_funct = self.calculateCovAlphaPart
-        else:
-            R_funct = self.calculateCovAlphaPartSampleNoSame
-
-        if front_sample_size * rear_sample_size < 2000:
-            C_funct = self.calculateCovAlphaPart
-        else:
-            C_funct = self.calculateCovAlphaPartSample
-        covAlphas={}
-
-        # test the given split against it
-        if maxSample != 0:
-            shuffle(front_RIs)
-            shuffle(rear_RIs)
-            FRI = front_RIs[:front_sample_size]
-            RRI = rear_RIs[:rear_sample_size]
-        else:
-            FRI = front_RIs
-            RRI = rear_RIs
-        test_T_score = C_funct(FRI,RRI,covAlphas) / ( F_funct(FRI,FRI,covAlphas) + R_funct(RRI,RRI,covAlphas))
-
-        T_scores = []
-        index_array = np_arange(x_size)
-        fsi = np_arange(front_sample_size)
-        rsi = np_arange(front_sample_size, front_sample_size+rear_sample_size)
-        for i in range(null_loops):
-            # select two sets of bins at random
-            shuffle(index_array)
-            FRI = x[index_array[fsi]]
-            RRI = x[index_array[rsi]]
-            T_scores.append(C_funct(FRI,RRI,covAlphas) / ( F_funct(FRI,FRI,covAlphas) + R_funct(RRI,RRI,covAlphas)))
-
-        T_scores = sorted(T_scores)
-        index = int(np_around(float(null_loops+1)*confidence))
-
-        return (test_T_score, T_scores[index])
-
-    def calculateCovAlphaPartSampleNoSame(self, RI1, RI2, alphas, sampleSize=2000):
-        """Calculate one part of an alpha score
-
-        Subsample of all vs all, assumes RI1 == RI2
-        """
-        lr1 = len(RI1)
-        lr2 = len(RI2)
-        score = 0.0
-        samples_selected = {}
-        num_samples_complete = 0
-        while num_samples_complete < sampleSize:
-            combo = (randint(lr1), randint(lr2))
-            while (combo in samples_selected) or (combo[0] == combo[1]):
-                combo = (randint(lr1), randint(lr2))
-            samples_selected[combo] = True
-            r1 = RI1[combo[0]]
-            r2 = RI2[combo[1]]
-            num_samples_complete += 1
-            try:
-                # try to pull the value out
-                score += alphas[(r1,r2)]
-            except KeyError:
-                try:
-                    # try to pull the value out
-                    score += alphas[(r1,r2)]
-                except KeyError:
-                    # calculate it if it's not there...
-                    # inline this becuase we call it alot!
-                    try:
-                        ang = np_arccos(np_dot(self.PM.covProfiles[r1],self.PM.covProfiles[r2]) /
-                                        (self.PM.normCoverages[r1]*self.PM.normCoverages[r2]))
-                    except FloatingPointError:
-                        ang = 0.0
-                    alphas[(r1,r2)] = ang
-                    score += ang
-        return score / sampleSize
-
-    def calculateCovAlphaPartSample(self, RI1, RI2, alphas, sampleSize=2000):
-        """Calculate one part of an alpha score
-
-        Subsample of all vs all, assumes RI1 != RI2
-        """
-        lr1 = len(RI1)
-        lr2 = len(RI2)
-        score = 0.0
-        samples_selected = {}
-        num_samples_complete = 0
-        while num_samples_complete < sampleSize:
-            combo = (randint(lr1), randint(lr2))
-            while combo in samples_selected:
-                combo = (randint(lr1), randint(lr2))
-            samples_selected[combo] = True
-            r1 = RI1[combo[0]]
-            r2 = RI2[combo[1]]
-            num_samples_complete += 1
-            try:
-                # try to pull the value out
-                score += alphas[(r1,r2)]
-            except KeyError:
-                try:
-                    # try to pull the value out
-                    score += alphas[(r1,r2)]
-                except KeyError:
-                    # calculate it if it's not there...
-                    # inline this becuase we call it alot!
-                    try:
-                        ang = np_arccos(np_dot(self.PM.covProfiles[r1],self.PM.covProfiles[r2]) /
-                                        (self.PM.normCoverages[r1]*self.PM.normCoverages[r2]))
-                    except FloatingPointError:
-                        ang = 0.0
-                    alphas[(r1,r2)] = ang
-                    score += ang
-        return score / sampleSize
-
-    def calculateCovAlphaPart(self, RI1, RI2, alphas):
-        """Calculate one part of an alpha score
-
-        All vs all
-        """
-        lr1 = len(RI1)
-        lr2 = len(RI2)
-        score = 0.0
-        for r1 in RI1:
-            for r2 in RI2:
-                try:
-                    score += alphas[(r1,r2)]
-                except KeyError:
-                    try:
-                        score += alphas[(r2,r1)]
-                    except KeyError:
-                        try:
-                            ang = np_arccos(np_dot(self.PM.covProfiles[r1],self.PM.covProfiles[r2]) /
-                                            (self.PM.normCoverages[r1]*self.PM.normCoverages[r2]))
-                        except FloatingPointError:
-                            ang = 0.0
-                        alphas[(r1,r2)] = ang
-                        score += ang
-        return score / (lr1*lr2)
-
-
     def calculateCovAlphaTScore(self, RI1, RI2, alphas):
         """Measure the goodness of the separation into lists
 
@@ -2095,10 +2079,7 @@ class RefineEngine:
         print "    %d contigs unbinned" % total_unbinned
 
         # build the classifier on all the existing bins
-        (SS, minz, maxz, side) = self.buildSOM(timer,
-                                               maskBoundaries=True,
-                                               defineBins=True,
-                                               retrain=True)
+        (SS, minz, maxz, side) = self.getSOMClassifier(timer)
 
         print "    %s" % timer.getTimeStamp()
 
@@ -2175,6 +2156,7 @@ class RefineEngine:
         if(saveBins):
             print "Saving bins"
             self.BM.saveBins()
+            self.PM.setRecruited()
 
 #------------------------------------------------------------------------------
 # UI and IMAGE RENDERING
@@ -2247,6 +2229,78 @@ class RefineEngine:
 ###############################################################################
 ###############################################################################
 
+def trainSOMPatch(job):
+    """Train a patch of SOM weights on the contigs from one bin
+
+    Lives out here so it can be handed to a multiprocessing pool
+    """
+    (block, sweights, shifted_mask_points, small_side, radius) = job
+    # train on the set of dummy weights, fall back to the full SOM's
+    # radius if the patch is tiny (same as SOM.train does)
+    if small_side/3 != 0:
+        radius = small_side/3
+    return trainWeights(sweights,
+                        block,
+                        iterations=50,
+                        mask=shifted_mask_points,
+                        radius=radius,
+                        influenceRate=0.1)
+
+def testMergePair(job, GT=None, ET=None):
+    """Run the merge tests on a pair of bins
+
+    job is (profile1, profile2, kCutMedian, cCutMedian, exact) where each profile is
+    (binSize, contigLengths, kmerPCs, unitCoverageSamples, (kA, kCenter), kVol, (cA, cCenter), cVol)
+    and exact says to use the exact ellipsoid overlap test
+
+    Lives out here so it can be handed to a multiprocessing pool
+
+    returns (lengthsWrong, kDist, cDist, kIntersects, cIntersects), tests
+    which were never reached are None
+    """
+    (base, query, kCutMedian, cCutMedian, exact) = job
+    if GT is None:
+        GT = GrubbsTester()
+    if ET is None:
+        ET = EllipsoidTool()
+
+    # CONTIG LENGTH SANITY
+    # Test the smaller bin against the larger
+    if query[0] < base[0]:
+        lengths_wrong = GT.isMaxOutlier(np_median(query[1]), base[1])
+    else:
+        lengths_wrong = GT.isMaxOutlier(np_median(base[1]), query[1])
+    if lengths_wrong:
+        return (True, None, None, None, None)
+
+    # K and C SPACE SIMILARITY CHECK
+    # If the bins are highly similar in their coverage and kmer distances
+    # compared to other core bins than just merge them now
+    k_dist_bw = medianCdist(base[2], query[2], 'cityblock')
+    c_dist_bw = np_median(np_arccos(np_clip(np_dot(base[3], query[3].T), -1., 1.)))
+    if k_dist_bw < kCutMedian and c_dist_bw < cCutMedian:
+        return (False, k_dist_bw, c_dist_bw, None, None)
+
+    # KMER ELLIPSE OVERLAP
+    if base[5] <= query[5]:
+        k_intersects = ET.doesIntersect3D(query[4][0], query[4][1], base[4][0], base[4][1], exact=exact)
+    else:
+        k_intersects = ET.doesIntersect3D(base[4][0], base[4][1], query[4][0], query[4][1], exact=exact)
+    if not k_intersects:
+        return (False, k_dist_bw, c_dist_bw, False, None)
+
+    # MINIMUM BOUNDING COVERAGE ELLIPSOID
+    if base[7] <= query[7]:
+        c_intersects = ET.doesIntersect3D(query[6][0], query[6][1], base[6][0], base[6][1], exact=exact)
+    else:
+        c_intersects = ET.doesIntersect3D(base[6][0], base[6][1], query[6][0], query[6][1], exact=exact)
+    return (False, k_dist_bw, c_dist_bw, True, bool(c_intersects))
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
 class GrubbsTester:
     """Data and methods for performing Grubbs test
 
@@ -72,10 +72,12 @@ __status__ = "Released"
 ###############################################################################
 
 import sys
-from random import randrange, randint, random
+from random import randrange
 from math import log, exp
 import numpy as np
 from scipy.spatial.distance import cdist
+import scipy.ndimage as ndi
+from multiprocessing.pool import ThreadPool
 from PIL import Image, ImageDraw
 np.seterr(all='raise')
 
@@ -107,6 +109,11 @@ class SOM:
         self.boundaryMask = np.zeros((self.side,self.side))
         self.VS_flat = np.zeros((self.side,self.side))
 
+        # connected regions of the boundary mask, made on demand
+        self.regionLabels = None
+        self.regionOrder = None
+        self.regionStarts = None
+
         # bin assignments
         self.binAssignments = np.zeros((self.side,self.side)) # the 0 bin is 'not assigned'
 
@@ -153,11 +160,10 @@ class SOM:
         """
         # build a regions structure
         self.regions = TM(self.side, dimension=1)
-        for row in range(self.side):
-            for col in range(self.side):
-                self.regions.nodes[row,col] = self.classifyPoint(self.weights.nodes[row,col],
-                                                                 trainVector,
-                                                                 bids)
+        # every node goes to the bin whose training vector it best matches
+        best_bins = findBestMatches(targets=np.array(trainVector),
+                                    queries=self.weights.flatNodes)
+        self.regions.nodes[:,:,0] = np.array(bids)[best_bins].reshape((self.side, self.side))
 
     def classifyPoint(self, point, trainVector, bids):
         """Returns the bid of the best match to the trainVector
@@ -221,10 +227,18 @@ class SOM:
               influenceRate=0.4,
               mask=None,
               radius=0.,
-              silent=True
+              silent=True,
+              threads=1
               ):
         """Train the SOM
         Train vector is a list of numpy arrays
+        If given, mask is a tuple of (row, col) index arrays of the
+        only nodes which may be updated
+
+        Batch update: all best matches for an iteration are found in one go
+        and the neighbourhood deltas are accumulated straight onto the torus
+        using wrap-around indexing. Set threads > 1 to split the best match
+        search over a thread pool
         """
 
         if not silent:
@@ -235,161 +249,30 @@ class SOM:
 
         # we can use a dummy set of weights, or the *true* weights
         if weights is None:
-            replace_weights = True
             weights = self.weights.nodes
-            flat_nodes = self.weights.flatNodes
-            rows = self.side
-            cols = self.side
-        else:
-            shape = np.shape(weights)
-            rows = shape[0]
-            cols = shape[1]
-            flat_nodes = weights.reshape((rows*cols, self.dimension))
-            replace_weights = False
 
-        # over time we'll shrink the radius of nodes which
-        # are influenced by the current training node
-        time_constant = iterations/log(radius)
+            def onIteration(weights, i):
+                # keep the flat nodes in sync
+                self.weights.fixFlatNodes(weights=weights)
 
-        # we would ideally like to select guys from the training set at random
-        if(len(trainVector) <= vectorSubSet):
-            index_array = np.arange(len(trainVector))
-            cut_off = len(trainVector) # if less than 1000 training vectors, set this to suit
+                # make a tmp image, perhaps
+                if(weightImgFileNamePrefix != ""):
+                    filename = "%s_%04d.jpg" % (weightImgFileNamePrefix, i)
+                    print " writing: %s" % filename
+                    self.weights.renderSurface(filename)
         else:
-            rand_index_array = np.arange(len(trainVector))
-            cut_off = vectorSubSet
-
-        for i in range(1, iterations+1):
-            if not silent:
-                sys.stdout.write("\r    Iteration: % 4d of % 4d" % (i, iterations))
-                sys.stdout.flush()
-
-#--------
-# Make stamp
-            # gaussian decay on radius and amount of influence
-            radius_decaying=radius*exp(-1.0*i/time_constant)
-            if(radius_decaying < 2):
-                return weights
-
-            grad = -1 * influenceRate / radius_decaying
-            # we will make a "stamp" to speed things up
-            max_radius = int(radius_decaying)
-            q_stamp = np.zeros((max_radius+1,max_radius+1))
-
-            for row in range(0, max_radius+1):
-                for col in range(0, max_radius + 1):
-                    # now we check to see that the euclidean distance is less than
-                    # the specified distance.
-                    true_dist = np.sqrt( row**2 + col**2 )
-                    #if true_dist > 0.0:
-                    check_dist = np.round(true_dist+0.00001)
-                    if(check_dist <= radius_decaying):
-                        # influence is propotional to distance
-                        influence = true_dist*grad + influenceRate
-                        q_stamp[row, col] = influence
-                        q_stamp[col, row] = influence
-
-            # divide by 2, so we don't mess up the stamp
-            q_stamp[:,0] /= 2
-            q_stamp[0,:] /= 2
-            stamp = np.zeros((2*max_radius+1,2*max_radius+1))
-            # bottom right
-            stamp[max_radius:,max_radius:] += q_stamp
-            # top right
-            stamp[:max_radius+1,max_radius:] += np.rot90(q_stamp,1)
-            # top left
-            stamp[:max_radius+1,:max_radius+1] += np.rot90(q_stamp,2)
-            # bottom left
-            stamp[max_radius:,:max_radius+1] += np.rot90(q_stamp,3)
-            # center
-            stamp[max_radius, max_radius] = influenceRate
-
-
-            # now find where the useless info is and cull it from the stamp
-            max_vals = np.max(stamp, axis=0)
-            k = 0
-            while k < len(max_vals):
-                if max_vals[k] > 0.0:
-                    break
-                k += 1
-            if k < len(max_vals):
-                stamp = stamp[k:2*max_radius+1-k,k:2*max_radius+1-k]
-
-            # keep track of how big the stamp is now
-            stamp_side = len(stamp)
-            stamp_radius = int((stamp_side-1)/2)
-
-            # if there are more than vectorSubSet training vecs
-            # take a random selection
-            if(len(trainVector) > vectorSubSet):
-                np.random.shuffle(rand_index_array)
-                index_array = rand_index_array[:cut_off]
-#--------
-# Make worksheet
-            worksheet = np.zeros(self.dimension*rows*cols*9).reshape((rows*3,
-                                                                      cols*3,
-                                                                      self.dimension))
-            worksheet[0:rows,0:cols] = weights
-            worksheet[0:rows,cols:cols*2] = weights
-            worksheet[0:rows,cols*2:cols*3] = weights
-            worksheet[rows:rows*2,0:cols] = weights
-            worksheet[rows:rows*2,cols:cols*2] = weights
-            worksheet[rows:rows*2,cols*2:cols*3] = weights
-            worksheet[rows*2:rows*3,0:cols] = weights
-            worksheet[rows*2:rows*3,cols:cols*2] = weights
-            worksheet[rows*2:rows*3,cols*2:cols*3] = weights
-
-            # make a set of "delta nodes"
-            # these contain the changes to the set of grid nodes
-            # and we will add their values to the grid nodes
-            # once we have input all the training nodes
-            deltasheet = np.zeros_like(worksheet)
-
-            for j in index_array:
-                # find the best match between then training vector and the
-                # current grid, inlined for greater speed
-                loc = np.argmin(cdist(flat_nodes, [trainVector[j]]))
-                row = int(loc/cols)
-                col = loc-(row*cols)
-
-                # row col represent the center of the stamp
-                weights_patch = worksheet[rows+row-stamp_radius:rows+row+stamp_radius+1,
-                                          cols+col-stamp_radius:cols+col+stamp_radius+1]
-                weights_patch = -1*(weights_patch - trainVector[j])
-                #print row, col, rows, cols, stamp_radius, np.shape(weights_patch), np.shape(weights_patch[:,:,0]), np.shape(stamp), np.shape(deltasheet[rows+row-stamp_radius:rows+row+stamp_radius+1,cols+col-stamp_radius:cols+col+stamp_radius+1])
-                weights_patch[:,:,0] *= stamp
-                weights_patch[:,:,1] *= stamp
-                weights_patch[:,:,2] *= stamp
-                weights_patch[:,:,3] *= stamp
-
-                deltasheet[rows+row-stamp_radius:rows+row+stamp_radius+1,
-                           cols+col-stamp_radius:cols+col+stamp_radius+1] += weights_patch
-
-            # now fold the deltas and update the weights
-            deltasheet[:,cols:2*cols] += deltasheet[:,0:cols]
-            deltasheet[:,cols:2*cols] += deltasheet[:,2*cols:3*cols]
-            deltasheet[rows:2*rows,cols:2*cols] += deltasheet[0:rows,cols:2*cols]
-            deltasheet[rows:2*rows,cols:2*cols] += deltasheet[2*rows:3*rows,cols:2*cols]
-
-            # add the deltas to the grid nodes and clip to keep between 0 and 1
-            if mask is None:
-                weights = np.clip(weights + deltasheet[rows:2*rows,cols:2*cols], 0, 1)
-            else:
-                delta_fold = deltasheet[rows:2*rows,cols:2*cols]
-                for (r,c) in mask.keys():
-                    weights[r,c] = np.clip(weights[r,c] + delta_fold[r,c], 0, 1)
-                    flat_nodes = weights.reshape((rows*cols, self.dimension))
-
-            if replace_weights == True:
-                flat_nodes = self.weights.fixFlatNodes(weights=weights)
-
-            # make a tmp image, perhaps
-            if(weightImgFileNamePrefix != ""):
-                filename = "%s_%04d.jpg" % (weightImgFileNamePrefix, i)
-                print " writing: %s" % filename
-                self.weights.renderSurface(filename)
-
-        return weights
+            onIteration = None
+
+        return trainWeights(weights,
+                            trainVector,
+                            iterations=iterations,
+                            vectorSubSet=vectorSubSet,
+                            influenceRate=influenceRate,
+                            mask=mask,
+                            radius=radius,
+                            silent=silent,
+                            threads=threads,
+                            onIteration=onIteration)
 
     def makeBoundaryMask(self, plotMaskFile=""):
         """Make a mask for cutting out boundaries"""
@@ -398,6 +281,7 @@ class SOM:
 #        self.VS_flat = np.array([[int(j) for j in i] for i in np.array(VS[:,:,0] + VS[:,:,1] + VS[:,:,2] + VS[:,:,3])*250]).reshape((self.side, self.side))
         self.VS_flat = np.array(VS[:,:,0] + VS[:,:,1] + VS[:,:,2] + VS[:,:,3]).reshape((self.side, self.side)) * 250
         self.boundaryMask = np.where(self.VS_flat > self.maskCutoff, 1., 0.)
+        self.regionLabels = None
 
         if plotMaskFile != "":
             self.renderBoundaryMask(plotMaskFile)
@@ -418,16 +302,14 @@ class SOM:
 
         if mask is None:
             mask = self.boundaryMask
-        for r in range(rows):
-            for c in range(cols):
-                if mask[r,c] == 1:
-                    # on the boundary, mask as -1's
-                    weights[r,c] = [-1.]*self.dimension
-                elif addNoise:
-                    if randint(10) <= noise_targets:
-                        # add some noise
-                        noise_amount = random() * max_noise + 1.0
-                        weights[r,c] *= noise_amount
+        on_boundary = (mask == 1)
+        # on the boundary, mask as -1's
+        weights[on_boundary] = -1.
+        if addNoise:
+            # add some noise to a random selection of the rest
+            noisy = ~on_boundary & (np.random.randint(10, size=(rows,cols)) <= noise_targets)
+            noise_amount = np.random.random(np.sum(noisy)) * max_noise + 1.0
+            weights[noisy] *= noise_amount[:,np.newaxis]
         if doFlat:
             self.weights.fixFlatNodes()
 
@@ -454,113 +336,160 @@ class SOM:
             self.renderBoundaryMask("S3.png", colMap=rcols)
 
         # now clean up the mask
-        for r in range(self.side):
-            for c in range(self.side):
-                if self.boundaryMask[r,c] == 0 and self.binAssignments[r,c] == 0:
-                    # unmasked AND unassigned
-                    self.boundaryMask[r,c] = 1
+        # unmasked AND unassigned
+        self.boundaryMask[(self.boundaryMask == 0) & (self.binAssignments == 0)] = 1
+        self.regionLabels = None
         if render:
             self.renderBoundaryMask("S4.png", colMap=rcols)
 
     def expandAssign(self, startR, startC, bid, binProfileMap):
         """Based on floodfill, add more points to a bin assignment"""
         # get all the points within this region
-        points = self.floodFill(startR, startC, self.boundaryMask)
-        collision_bid = 0
-        for (r,c) in points.keys():
-            if self.binAssignments[r,c] != 0:
-                if self.binAssignments[r,c] != bid:
-                    # we have already assigned this point to a bin
-                    # most likely we need to set the mask cutoff higher, but just for this region
-                    collision_bid = self.binAssignments[r,c]
-                    #print "\n", (r,c), "already assigned to bin %d, trying to reassign to bin %d" % (collision_bid, bid)
-                    re_calc_mask = True
-                    break
-            self.binAssignments[r,c] = bid
-
-        if collision_bid != 0:
-            resolved = False
-            [crow, ccol] = self.weights.bestMatch(binProfileMap[collision_bid])   # where the old bin's floodfill started
-            mc = self.maskCutoff
-            # we can't do anything if we can't lower the cutoff...
-            while mc >= 2:
-                # rebuild the mask with a new cutoff
-                mc = mc/2
-                mask = np.copy(self.boundaryMask)
-                for (r,c) in points.keys():
-                    if self.VS_flat[r,c] > mc:
-                        mask[r,c] = 1.
-                    else:
-                        mask[r,c] = 0.
-                #self.renderBoundaryMask("MASK_%d_%d_%f.png" % (bid, collision_bid, mc), mask)
-                collision_points = self.floodFill(crow, ccol, mask)
-                new_points = self.floodFill(startR, startC, mask)
-                #print len(collision_points.keys()), len(new_points.keys())
-                #print collision_points.keys()[0] in new_points
-                if len(collision_points.keys()) == 0 or len(new_points.keys()) == 0:
+        labels = self.getRegionLabels()
+        region = labels[startR, startC]
+        if region == 0:
+            # we started on the boundary
+            return
+        points = self.getRegionPoints(region)
+        current = self.binAssignments[points]
+        clashes = np.nonzero((current != 0) & (current != bid))[0]
+        if len(clashes) == 0:
+            self.binAssignments[points] = bid
+            return
+
+        # we have already assigned some of these points to a bin
+        # most likely we need to set the mask cutoff higher, but just for this region
+        collision_bid = current[clashes[0]]
+        free = (current == 0)
+        self.binAssignments[points[0][free], points[1][free]] = bid
+
+        resolved = False
+        [crow, ccol] = self.weights.bestMatch(binProfileMap[collision_bid])   # where the old bin's floodfill started
+        collision_inside = (labels[crow, ccol] == region)
+        mc = self.maskCutoff
+        # we can't do anything if we can't lower the cutoff...
+        while mc >= 2:
+            # rebuild the mask with a new cutoff, only the clashing
+            # region can change so that's all we relabel
+            mc = mc/2
+            sub_mask = np.ones_like(self.boundaryMask)
+            sub_mask[points] = np.where(self.VS_flat[points] > mc, 1., 0.)
+            sub_labels = self.labelRegions(sub_mask)
+            new_region = sub_labels[startR, startC]
+            if collision_inside:
+                collision_region = sub_labels[crow, ccol]
+                if collision_region == 0:
                     continue
-                # there should be no overlap
-                if collision_points.keys()[0] not in new_points:
-                    # we have resolved the issue
-                    resolved = True
-                    # now we need to fix the binAssignments and boundary mask
-                    self.boundaryMask = mask
-                    for (r,c) in points.keys():
-                        if (r,c) in new_points:
-                            # assign this point to the new bid
-                            self.binAssignments[r,c] = bid
-                        elif (r,c) in collision_points:
-                            # point in the new mask
-                            self.binAssignments[r,c] = collision_bid
-                        else:
-                            self.binAssignments[r,c] = 0.
-                    break
-
-            if not resolved:
-                print "Cannot repair map, bin %d may be incorrectly merged with bin %d" % (bid, collision_bid)
-                return
+            else:
+                # the old bin lives outside this region and nothing
+                # outside this region has changed
+                if labels[crow, ccol] == 0:
+                    continue
+                collision_region = -1
+            if new_region == 0:
+                continue
+            # there should be no overlap
+            if new_region != collision_region:
+                # we have resolved the issue
+                resolved = True
+                # now we need to fix the binAssignments and boundary mask
+                point_labels = sub_labels[points]
+                self.boundaryMask[points] = sub_mask[points]
+                self.binAssignments[points] = np.where(point_labels == new_region,
+                                                       bid,
+                                                       np.where(point_labels == collision_region,
+                                                                collision_bid,
+                                                                0.))
+                # splice the new regions into the labelling
+                self.regionLabels[points] = np.where(point_labels > 0,
+                                                     point_labels + labels.max(),
+                                                     0)
+                self.regionOrder = None
+                break
+        if not resolved:
+            print "Cannot repair map, bin %d may be incorrectly merged with bin %d" % (bid, collision_bid)
+            return
 
     def makeBinMask(self, profile, fileName="", dim=False):
-        """Return a mask of the region this profile falls in"""
+        """Return a mask of the region this profile falls in
+
+        The mask is returned as a tuple of (row, col) index arrays
+        """
         [r, c] = self.weights.bestMatch(profile)
-        points = self.floodFill(r, c, self.boundaryMask)
+        points = self.floodFill(r, c)
         if fileName != "":
             ret_mask = np.ones_like(self.boundaryMask)
-            for (r,c) in points.keys():
-                ret_mask[r,c] = 0
+            ret_mask[points] = 0
             self.renderBoundaryMask(fileName, mask=ret_mask)
-
         return points
 
-    def floodFill(self, startR, startC, mask):
-        """Return all points affected by a flood fill operation at the given point"""
-        points = {}
-        toFill = set()
-        toFill.add((startR, startC))
-        seen = {(startR, startC) : True}
-        while len(toFill) != 0:
-            (r,c) = toFill.pop()
-            if mask[r,c] == 1:
+    def floodFill(self, startR, startC, mask=None):
+        """Return all points in the same region as the given point
+
+        Points are returned as a tuple of (row, col) index arrays. Lookups
+        against the boundary mask use the cached region labels
+        """
+        if mask is None or mask is self.boundaryMask:
+            region = self.getRegionLabels()[startR, startC]
+            if region == 0:
                 # we are at the boundary of a region
-                continue
+                return (np.array([], dtype=int), np.array([], dtype=int))
+            return self.getRegionPoints(region)
 
-            points[(r,c)] = [r,c]
-
-            # don't forget we're on a torus
-            if r == 0: rm1 = self.side - 1
-            else: rm1 = r - 1
-            if c == 0: cm1 = self.side - 1
-            else: cm1 = c - 1
-            if r == self.side - 1: rp1 = 0
-            else: rp1 = r + 1
-            if c == self.side - 1:cp1 = 0
-            else: cp1 = c + 1
-            if (rm1,c) not in seen: toFill.add((rm1,c)); seen[(rm1,c)] = True
-            if (rp1,c) not in seen: toFill.add((rp1,c)); seen[(rp1,c)] = True
-            if (r,cm1) not in seen: toFill.add((r,cm1)); seen[(r,cm1)] = True
-            if (r,cp1) not in seen: toFill.add((r,cp1)); seen[(r,cp1)] = True
+        labels = self.labelRegions(mask)
+        if labels[startR, startC] == 0:
+            return (np.array([], dtype=int), np.array([], dtype=int))
+        return np.nonzero(labels == labels[startR, startC])
 
-        return points
+    def labelRegions(self, mask):
+        """Label the connected unmasked regions of a mask
+
+        Returns an int array shaped like the mask. Masked points are 0 and
+        every other point holds the id of the region it belongs to
+        """
+        (labels, num_labels) = ndi.label(mask != 1)
+
+        # don't forget we're on a torus, regions which touch across
+        # the edges are the same region
+        roots = np.arange(num_labels+1)
+        edge_pairs = set(zip(labels[0,:], labels[-1,:]) + zip(labels[:,0], labels[:,-1]))
+        for (l1, l2) in edge_pairs:
+            if l1 == 0 or l2 == 0:
+                continue
+            while roots[l1] != l1:
+                l1 = roots[l1]
+            while roots[l2] != l2:
+                l2 = roots[l2]
+            if l1 != l2:
+                roots[max(l1, l2)] = min(l1, l2)
+
+        # point everyone at their root
+        flat_roots = roots[roots]
+        while np.any(flat_roots != roots):
+            roots = flat_roots
+            flat_roots = roots[roots]
+        return roots[labels]
+
+    def getRegionLabels(self):
+        """Get (and cache) the region labels of the boundary mask"""
+        if self.regionLabels is None:
+            self.regionLabels = self.labelRegions(self.boundaryMask)
+            self.regionOrder = None
+        return self.regionLabels
+
+    def getRegionPoints(self, region):
+        """Return the (row, col) index arrays of the points in a region"""
+        labels = self.getRegionLabels()
+        if self.regionOrder is None:
+            # sort the points by label so lookups are a simple slice
+            flat_labels = labels.ravel()
+            self.regionOrder = np.argsort(flat_labels, kind='mergesort')
+            self.regionStarts = np.searchsorted(flat_labels[self.regionOrder],
+                                                np.arange(flat_labels.max()+2))
+        if region < 0 or region+1 >= len(self.regionStarts):
+            return (np.array([], dtype=int), np.array([], dtype=int))
+        flat_points = self.regionOrder[self.regionStarts[region]:self.regionStarts[region+1]]
+        return np.unravel_index(flat_points, labels.shape)
 
     def secondsToStr(self, t):
         rediv = lambda ll,b : list(divmod(ll[0],b)) + ll[1:]
@@ -666,3 +595,203 @@ class SOM:
 ###############################################################################
 ###############################################################################
 ###############################################################################
+
+def trainWeights(weights,
+                 trainVector,
+                 iterations=1000,
+                 vectorSubSet=1000,
+                 influenceRate=0.4,
+                 mask=None,
+                 radius=0.,
+                 silent=True,
+                 threads=1,
+                 onIteration=None
+                 ):
+    """Train a (rows, cols, dimension) array of SOM weights
+
+    This is the guts of SOM.train. It lives out here so a patch of weights
+    can be trained without making a whole SOM. If given, mask is a tuple
+    of (row, col) index arrays of the only nodes which may be updated and
+    onIteration(weights, iteration) is called after every update
+    """
+    (rows, cols, dimension) = np.shape(weights)
+    flat_nodes = weights.reshape((rows*cols, dimension))
+
+    # work out which nodes we're allowed to update
+    if mask is not None:
+        mask_array = np.zeros((rows,cols), dtype=bool)
+        mask_array[mask] = True
+
+    train_array = np.array(trainVector, dtype=float).reshape((len(trainVector), dimension))
+
+    # over time we'll shrink the radius of nodes which
+    # are influenced by the current training node
+    time_constant = iterations/log(radius)
+
+    # we would ideally like to select guys from the training set at random
+    if(len(trainVector) <= vectorSubSet):
+        index_array = np.arange(len(trainVector))
+        cut_off = len(trainVector) # if less than 1000 training vectors, set this to suit
+    else:
+        rand_index_array = np.arange(len(trainVector))
+        cut_off = vectorSubSet
+
+    pool = None
+    if threads > 1:
+        pool = ThreadPool(threads)
+
+    try:
+        for i in range(1, iterations+1):
+            if not silent:
+                sys.stdout.write("\r    Iteration: % 4d of % 4d" % (i, iterations))
+                sys.stdout.flush()
+
+#--------
+# Make stamp
+            # gaussian decay on radius and amount of influence
+            radius_decaying=radius*exp(-1.0*i/time_constant)
+            if(radius_decaying < 2):
+                return weights
+
+            stamp = makeStamp(radius_decaying, influenceRate)
+
+            # keep track of how big the stamp is now
+            stamp_side = len(stamp)
+            stamp_radius = int((stamp_side-1)/2)
+            stamp_offsets = np.arange(-stamp_radius, stamp_radius+1)
+
+            # if there are more than vectorSubSet training vecs
+            # take a random selection
+            if(len(trainVector) > vectorSubSet):
+                np.random.shuffle(rand_index_array)
+                index_array = rand_index_array[:cut_off]
+
+#--------
+# Find best matches
+            # the weights only change at the end of each iteration
+            # so we can find all the best matches at once
+            locs = findBestMatches(targets=flat_nodes,
+                                   queries=train_array[index_array],
+                                   pool=pool,
+                                   threads=threads)
+
+            # many training vectors land on the same node. Group them
+            # so we only apply the stamp once per node:
+            # sum_j stamp * (v_j - w) == stamp * (sum_j v_j - hits * w)
+            hits = np.bincount(locs, minlength=rows*cols)
+            hit_locs = np.nonzero(hits)[0]
+            vec_sums = np.zeros((rows*cols, dimension))
+            for d in range(dimension):
+                vec_sums[:,d] = np.bincount(locs,
+                                            weights=train_array[index_array,d],
+                                            minlength=rows*cols)
+
+#--------
+# Accumulate deltas
+            # make a set of "delta nodes"
+            # these contain the changes to the set of grid nodes
+            # and we will add their values to the grid nodes
+            # once we have input all the training nodes
+            deltas = np.zeros((rows, cols, dimension))
+            # a stamp wider than the grid wraps onto itself, so we
+            # need unbuffered adds to get the folding right
+            self_overlap = (stamp_side > rows) or (stamp_side > cols)
+            for loc in hit_locs:
+                row = int(loc/cols)
+                col = loc-(row*cols)
+
+                # row col represent the center of the stamp, wrap around the torus
+                patch_index = np.ix_((stamp_offsets + row) % rows,
+                                     (stamp_offsets + col) % cols)
+                weights_patch = vec_sums[loc] - hits[loc] * weights[patch_index]
+                if self_overlap:
+                    # bincount sums repeated indices for us
+                    flat_index = (patch_index[0] * cols + patch_index[1]).ravel()
+                    patch_deltas = weights_patch * stamp[:,:,np.newaxis]
+                    for d in range(dimension):
+                        deltas[:,:,d] += np.bincount(flat_index,
+                                                     weights=patch_deltas[:,:,d].ravel(),
+                                                     minlength=rows*cols).reshape((rows, cols))
+                else:
+                    deltas[patch_index] += weights_patch * stamp[:,:,np.newaxis]
+
+            # add the deltas to the grid nodes and clip to keep between 0 and 1
+            if mask is None:
+                weights = np.clip(weights + deltas, 0, 1)
+            else:
+                weights[mask_array] = np.clip(weights[mask_array] + deltas[mask_array], 0, 1)
+            flat_nodes = weights.reshape((rows*cols, dimension))
+
+            if onIteration is not None:
+                onIteration(weights, i)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return weights
+
+def makeStamp(radiusDecaying, influenceRate):
+    """Make the neighbourhood "stamp" we press onto the torus around
+    each best match"""
+    grad = -1 * influenceRate / radiusDecaying
+    max_radius = int(radiusDecaying)
+
+    # now we check to see that the euclidean distance is less than
+    # the specified distance. Influence is propotional to distance
+    (q_rows, q_cols) = np.indices((max_radius+1,max_radius+1))
+    true_dist = np.sqrt(q_rows**2 + q_cols**2)
+    q_stamp = np.where(np.round(true_dist+0.00001) <= radiusDecaying,
+                       true_dist*grad + influenceRate,
+                       0.)
+
+    # divide by 2, so we don't mess up the stamp
+    q_stamp[:,0] /= 2
+    q_stamp[0,:] /= 2
+    stamp = np.zeros((2*max_radius+1,2*max_radius+1))
+    # bottom right
+    stamp[max_radius:,max_radius:] += q_stamp
+    # top right
+    stamp[:max_radius+1,max_radius:] += np.rot90(q_stamp,1)
+    # top left
+    stamp[:max_radius+1,:max_radius+1] += np.rot90(q_stamp,2)
+    # bottom left
+    stamp[max_radius:,:max_radius+1] += np.rot90(q_stamp,3)
+    # center
+    stamp[max_radius, max_radius] = influenceRate
+
+    # now find where the useless info is and cull it from the stamp
+    useful = np.nonzero(np.max(stamp, axis=0) > 0.0)[0]
+    if len(useful) > 0:
+        k = useful[0]
+        stamp = stamp[k:2*max_radius+1-k,k:2*max_radius+1-k]
+    return stamp
+
+def findBestMatches(targets, queries, pool=None, threads=1, blockSize=4000000):
+    """Return the index of the closest target for each query
+
+    Training uses the flat SOM nodes as targets and training vectors as
+    queries, regionalise goes the other way. The distance matrix is built
+    in blocks of at most blockSize entries so memory stays bounded on big
+    maps. Blocks are farmed out to pool if one is given
+    """
+    num_queries = len(queries)
+    if num_queries == 0:
+        return np.array([], dtype=int)
+    step = max(1, int(blockSize / len(targets)))
+    if pool is not None:
+        # make sure every thread gets some work
+        step = max(1, min(step, (num_queries + threads - 1) // threads))
+    blocks = [queries[k:k+step] for k in range(0, num_queries, step)]
+
+    def argminBlock(block):
+        return np.argmin(cdist(block, targets), axis=1)
+
+    if pool is None:
+        return np.concatenate([argminBlock(block) for block in blocks])
+    return np.concatenate(pool.map(argminBlock, blocks))
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    test_pca.py                                                              #
+#                                                                             #
+#    Check the chunked covariance PCA against the full SVD                    #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import unittest
+import numpy as np
+
+from groopm.mstore import ContigParser
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class TestPCAKSigs(unittest.TestCase):
+    """method='cov' should give the same PCs as method='svd' up to sign"""
+    def setUp(self):
+        RS = np.random.RandomState(42)
+        # a few strong directions plus noise so more than one PC is kept
+        basis = RS.standard_normal((3, 20))
+        self.kSigs = np.dot(RS.standard_normal((500, 3)) * [5., 3., 2.], basis) + RS.standard_normal((500, 20)) * 0.1
+        self.CP = ContigParser()
+
+    def test_cov_matches_svd(self):
+        (svd_pcs, svd_var) = self.CP.PCAKSigs(self.kSigs, method='svd')
+        (cov_pcs, cov_var) = self.CP.PCAKSigs(self.kSigs, method='cov')
+        svd_pcs = np.array(svd_pcs)
+        cov_pcs = np.array(cov_pcs)
+
+        self.assertEqual(np.shape(svd_pcs), np.shape(cov_pcs))
+        for i in range(np.shape(svd_pcs)[1]):
+            # the sign of each PC is arbitrary
+            sign = np.sign(np.dot(svd_pcs[:,i], cov_pcs[:,i]))
+            self.assertTrue(np.allclose(svd_pcs[:,i], sign * cov_pcs[:,i], atol=1e-6))
+        self.assertTrue(np.allclose(svd_var, cov_var))
+
+    def test_input_is_not_changed(self):
+        kSigs = np.copy(self.kSigs)
+        self.CP.PCAKSigs(kSigs, method='cov')
+        self.assertTrue(np.array_equal(kSigs, self.kSigs))
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+if __name__ == '__main__':
+    unittest.main()
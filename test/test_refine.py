@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    test_refine.py                                                           #
+#                                                                             #
+#    Check the vectorised merge tests against the old per pair loops          #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import unittest
+import numpy as np
+
+from groopm.refine import RefineEngine
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class Holder:
+    """Just enough of a PM / BM / Bin for the merge tests"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def covAlphaPart(RI1, RI2, covProfiles, normCoverages):
+    """The old all vs all calculateCovAlphaPart loop"""
+    score = 0.0
+    for r1 in RI1:
+        for r2 in RI2:
+            try:
+                score += np.arccos(np.dot(covProfiles[r1],covProfiles[r2]) /
+                                   (normCoverages[r1]*normCoverages[r2]))
+            except FloatingPointError:
+                pass
+    return score / (len(RI1)*len(RI2))
+
+class TestMergeCoverage(unittest.TestCase):
+    """The given split's t-score should match the old loops"""
+    def setUp(self):
+        RS = np.random.RandomState(7)
+        self.covProfiles = RS.uniform(1., 10., (12, 4))
+        # the DB hands these back as a column
+        self.normCoverages = np.array([[np.linalg.norm(c)] for c in self.covProfiles])
+        PM = Holder(covProfiles=self.covProfiles, normCoverages=self.normCoverages)
+        # uneven bins so a broadcast slip can't hide
+        self.front = np.arange(5)
+        self.rear = np.arange(5, 12)
+        BM = Holder(PM=PM, bins={1 : Holder(rowIndices=self.front),
+                                 2 : Holder(rowIndices=self.rear)})
+        self.RE = RefineEngine(None, BM=BM)
+
+    def test_t_score_matches_loops(self):
+        (t_score, null_score) = self.RE.testMergeCoverage(1, 2, maxSample=0)
+        inters = covAlphaPart(self.front, self.rear, self.covProfiles, self.normCoverages)
+        front_intras = covAlphaPart(self.front, self.front, self.covProfiles, self.normCoverages)
+        rear_intras = covAlphaPart(self.rear, self.rear, self.covProfiles, self.normCoverages)
+        self.assertTrue(np.allclose(t_score, inters / (front_intras + rear_intras)))
+
+    def test_flat_norms_give_the_same_answer(self):
+        column = self.RE.testMergeCoverage(1, 2)
+        self.RE.PM.normCoverages = np.ravel(self.normCoverages)
+        self.assertTrue(np.allclose(column, self.RE.testMergeCoverage(1, 2)))
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+if __name__ == '__main__':
+    unittest.main()